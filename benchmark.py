@@ -0,0 +1,379 @@
+import os
+import sys
+import json
+import time
+import shutil
+import datetime
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import scipy
+import kernels
+import object_tracking
+from numpy.lib.stride_tricks import sliding_window_view
+from stats import FrameStats
+from synthetic import synthetic_frames
+
+
+###################################################
+# BENCHMARKS OF THE TRACKING ON SYNTHETIC STORM FIELDS
+# Each case generates moving storms on a grid (see synthetic.synthetic_frames) and
+# times label_storms, ffttrack, interpolate_speeds, track_storms (Tracker.step, with
+# the times of its stages) and write_storms separately and end to end, with the settings of the
+# example in wrapper.py. Results are written to a JSON file, compare reports the
+# cases that became slower than in an earlier results file. compare_compact tracks
+# the same frames in float64 and float32 (compact_dtypes in wrapper.py) and reports
+# how far the displacements and tracks differ, compare_backends checks that the
+# numba backend gives the same tracks as the numpy backend.
+###################################################
+
+# Tracking settings of wrapper.py, fftpixels and halosq are derived from them as in wrapper.py
+default_settings = {'dt': 5., 'threshold': 3., 'minpixel': 4., 'squarelength': 100., 'rafraction': 0.01,
+                    'dd_tolerance': 3., 'halopixel': 5., 'lapthresh': 0.6, 'under_t': False, 'misval': -999,
+                    'compact': False, 'backend': 'numpy'}
+
+
+def make_grid(shape):
+    """
+    Grid coordinates centred on (0, 0), as in wrapper.py
+    :param shape: Grid shape (rows, columns)
+    :type shape: tuple
+    :return: xmat, ymat
+    :rtype: tuple
+    """
+    rows, cols = shape
+    return np.meshgrid(range(-(cols // 2), cols - cols // 2), range(-(rows // 2), rows - rows // 2))
+
+
+def summarise(times):
+    """
+    :param times: Times in seconds
+    :type times: list
+    :return: Number, median, mean and minimum of the times
+    :rtype: dict
+    """
+    if len(times) == 0:
+        return {'n': 0}
+    return {'n': len(times), 'median': float(np.median(times)), 'mean': float(np.mean(times)),
+            'min': float(np.min(times))}
+
+
+def make_tracker(xmat, ymat, par, compact, backend='numpy'):
+    """
+    :param xmat: meshgrid of x-coordinates
+    :type xmat: ndarray
+    :param ymat: meshgrid of y-coordinates
+    :type ymat: ndarray
+    :param par: Tracking settings, see default_settings
+    :type par: dict
+    :param compact: float32 displacement calculation (compact_dtypes in wrapper.py)
+    :type compact: bool
+    :param backend: Tracking backend (tracking_backend in wrapper.py)
+    :type backend: str
+    :return: Tracker with the settings
+    :rtype: object_tracking.Tracker
+    """
+    return object_tracking.Tracker(xmat, ymat, squarelength=par['squarelength'], rafraction=par['rafraction'],
+                                   dd_tolerance=par['dd_tolerance'], halopixel=par['halopixel'],
+                                   lapthresh=par['lapthresh'], misval=par['misval'], under_threshold=par['under_t'],
+                                   dt=par['dt'], compact=compact, backend=backend)
+
+
+def benchmark_case(shape, nstorms, frames=5, seed=0, fft_squares=64, settings=None, **generator):
+    """
+    Track synthetic frames and time each function
+    :param shape: Grid shape (rows, columns), both must be multiples of squarelength
+    :type shape: tuple
+    :param nstorms: Number of storms in the first frame
+    :type nstorms: int
+    :param frames: Number of frames
+    :type frames: int
+    :param seed: Seed of the storm generator
+    :type seed: int
+    :param fft_squares: Number of squares correlated one by one with ffttrack in each frame
+    :type fft_squares: int
+    :param settings: Tracking settings replacing those of default_settings
+    :type settings: dict
+    :param generator: Other arguments of synthetic_frames, e.g. radius, speed, split_rate, merge_rate
+    :return: Record of the case: times in seconds per call, mean stage times of track_storms and summed counters
+    :rtype: dict
+    """
+    par = dict(default_settings, **(settings or {}))
+    struct2d = np.ones((3, 3))
+    xmat, ymat = make_grid(shape)
+    tracker = make_tracker(xmat, ymat, par, par['compact'], par['backend'])
+    squarehalf, fftpixels, xint, yint = tracker.squarehalf, tracker.fftpixels, tracker.xint, tracker.yint
+    rng = np.random.default_rng(seed)
+    IMAGES_DIR = tempfile.mkdtemp(prefix='benchmark_') + os.sep
+    init_time = datetime.datetime(2012, 8, 25, 14, 5)
+
+    seconds = {name: [] for name in ['label_storms', 'ffttrack', 'interpolate_speeds', 'track_storms',
+                                     'write_storms', 'end_to_end']}
+    stages = {}
+    counters = {}
+    numstorms = []
+    OldLabels = None
+    try:
+        for nt, var in enumerate(synthetic_frames(frames, shape=shape, nstorms=nstorms, seed=seed, **generator)):
+            # Data are loaded as float32 in wrapper.py
+            var = var.astype(np.float32)
+            start = time.perf_counter()
+            NewLabels = object_tracking.label_storms(var, par['minpixel'], par['threshold'], struct2d,
+                                                     par['under_t'])
+            seconds['label_storms'].append(time.perf_counter() - start)
+            now_time = init_time + datetime.timedelta(minutes=par['dt'] * nt)
+            framestats = FrameStats(enabled=nt > 0)
+            tracked = time.perf_counter()
+            NewData, newwas = tracker.step(var, NewLabels, now_time, stats=framestats)[:2]
+            written = time.perf_counter()
+            object_tracking.write_storms('%04d' % nt, init_time, now_time, 'Rainfall rate > ' + str(par['threshold']),
+                                         par['squarelength'], par['rafraction'], newwas, NewData, False,
+                                         par['misval'], IMAGES_DIR)
+            done = time.perf_counter()
+            seconds['write_storms'].append(done - written)
+            numstorms.append(len(NewData))
+            # The first frame only initialises the storms
+            if nt > 0:
+                seconds['track_storms'].append(written - tracked)
+                seconds['end_to_end'].append(done - start)
+                for name, value in framestats.timers.items():
+                    stages[name] = stages.get(name, 0.) + value / (frames - 1)
+                for name, value in framestats.counters.items():
+                    counters[name] = counters.get(name, 0) + value
+
+                # Squares of the masks correlated one at a time
+                oldmask = np.where(OldLabels >= 1, 1, 0)
+                newmask = np.where(NewLabels >= 1, 1, 0)
+                oldsquares = sliding_window_view(oldmask, (2 * squarehalf, 2 * squarehalf))[
+                             ::squarehalf, ::squarehalf][:np.size(xint, 0), :np.size(xint, 1)]
+                newsquares = sliding_window_view(newmask, (2 * squarehalf, 2 * squarehalf))[
+                             ::squarehalf, ::squarehalf][:np.size(xint, 0), :np.size(xint, 1)]
+                # Only squares with enough storm pixels in both masks are correlated, as in track_storms
+                passing = np.flatnonzero((np.sum(oldsquares, axis=(2, 3)) >= fftpixels) &
+                                         (np.sum(newsquares, axis=(2, 3)) >= fftpixels))
+                corx, cory = np.unravel_index(rng.choice(passing, min(fft_squares, np.size(passing)),
+                                                         replace=False), np.shape(xint))
+                for kk in range(np.size(corx)):
+                    start = time.perf_counter()
+                    object_tracking.ffttrack(oldsquares[corx[kk], cory[kk]], newsquares[corx[kk], cory[kk]], 1)
+                    seconds['ffttrack'].append(time.perf_counter() - start)
+
+                # Displacements of all squares, with some missing
+                buu = rng.normal(3, 1, np.shape(xint))
+                bvv = rng.normal(2, 1, np.shape(xint))
+                buu[rng.random(np.shape(xint)) < 0.2] = np.nan
+                start = time.perf_counter()
+                object_tracking.interpolate_speeds(xint, yint, xmat, ymat, buu, bvv)
+                seconds['interpolate_speeds'].append(time.perf_counter() - start)
+            OldLabels = NewLabels
+    finally:
+        shutil.rmtree(IMAGES_DIR, ignore_errors=True)
+
+    return {'grid': list(shape), 'nstorms': nstorms, 'frames': frames, 'seed': seed, 'generator': generator,
+            'storms_per_frame': float(np.mean(numstorms)),
+            'seconds': {name: summarise(times) for name, times in seconds.items()},
+            'stages': stages, 'counters': counters}
+
+
+def track_links(StormData, OldStormData):
+    """
+    :param StormData: Storms of an image
+    :type StormData: object_tracking.StormTable
+    :param OldStormData: Storms of the previous image
+    :type OldStormData: object_tracking.StormTable
+    :return: Index of the previous storm each storm continues (or split off from, for a child), -1 for new storms.
+    Unlike the ids these do not depend on the number of new storms in earlier images.
+    :rtype: ndarray
+    """
+    previous = {was: ns for ns, was in enumerate(OldStormData.was.tolist())}
+    return np.array([previous.get(was, previous.get(child, -1))
+                     for was, child in zip(StormData.was.tolist(), StormData.child.tolist())], dtype=int)
+
+
+def compare_compact(shape, nstorms, frames=5, seed=0, settings=None, **generator):
+    """
+    Track the same frames with float64 and float32 (compact) displacement calculations
+    :param shape: Grid shape (rows, columns), both must be multiples of squarelength
+    :type shape: tuple
+    :param nstorms: Number of storms in the first frame
+    :type nstorms: int
+    :param frames: Number of frames
+    :type frames: int
+    :param seed: Seed of the storm generator
+    :type seed: int
+    :param settings: Tracking settings replacing those of default_settings
+    :type settings: dict
+    :param generator: Other arguments of synthetic_frames
+    :return: Largest and mean absolute difference of the displacement fields in pixels, largest difference of the
+    storm displacements (dx, dy), fraction of storms linked to the same previous storm (see track_links) and
+    number of storms tracked
+    :rtype: dict
+    """
+    par = dict(default_settings, **(settings or {}))
+    struct2d = np.ones((3, 3))
+    xmat, ymat = make_grid(shape)
+    trackers = [make_tracker(xmat, ymat, par, False), make_tracker(xmat, ymat, par, True)]
+    maxfield, sumfield, numfield, maxstorm, same, numstorms = 0., 0., 0, 0., 0, 0
+    init_time = datetime.datetime(2012, 8, 25, 14, 5)
+    for nt, var in enumerate(synthetic_frames(frames, shape=shape, nstorms=nstorms, seed=seed, **generator)):
+        var = var.astype(np.float32)
+        labels = object_tracking.label_storms(var, par['minpixel'], par['threshold'], struct2d, par['under_t'])
+        now_time = init_time + datetime.timedelta(minutes=par['dt'] * nt)
+        # Each tracker keeps the labels until its next step, so both get their own copy
+        full, compact = [tracker.step(var, labels.copy(), now_time) for tracker in trackers]
+        if nt > 0:
+            for field, compact_field in [(full.newumat, compact.newumat), (full.newvmat, compact.newvmat)]:
+                difference = np.abs(np.asarray(field, dtype=float) - compact_field)
+                maxfield = max(maxfield, float(np.max(difference)))
+                sumfield, numfield = sumfield + float(np.sum(difference)), numfield + np.size(difference)
+            maxstorm = max(maxstorm, float(np.max(np.abs(full.StormData.dx - compact.StormData.dx), initial=0.)),
+                           float(np.max(np.abs(full.StormData.dy - compact.StormData.dy), initial=0.)))
+            same += int(np.count_nonzero(track_links(full.StormData, previous[0]) ==
+                                         track_links(compact.StormData, previous[1])))
+            numstorms += len(full.StormData)
+        previous = (full.StormData, compact.StormData)
+    return {'grid': list(shape), 'nstorms': nstorms, 'frames': frames, 'seed': seed,
+            'max_field_difference': maxfield, 'mean_field_difference': sumfield / max(numfield, 1),
+            'max_storm_difference': maxstorm, 'same_links': same / max(numstorms, 1), 'storms': numstorms}
+
+
+def compare_backends(fields, settings=None, backend='numba'):
+    """
+    Track the same images with the numpy backend and another backend
+    :param fields: 2D fields of consecutive images, e.g. from synthetic_frames or loaded with user_functions.loadfile
+    :type fields: iterable
+    :param settings: Tracking settings replacing those of default_settings
+    :type settings: dict
+    :param backend: Backend compared with numpy
+    :type backend: str
+    :return: Numbers of images and storms, and (image number, name) of the first array that differs, None if the
+    storms, their lineage, the tracked ids and lifetimes on the grid and the next new ids are all the same
+    :rtype: dict
+    """
+    par = dict(default_settings, **(settings or {}))
+    struct2d = np.ones((3, 3))
+    trackers = None
+    numstorms = 0
+    init_time = datetime.datetime(2012, 8, 25, 14, 5)
+    for nt, var in enumerate(fields):
+        if trackers is None:
+            xmat, ymat = make_grid(np.shape(var))
+            trackers = [make_tracker(xmat, ymat, par, par['compact'], 'numpy'),
+                        make_tracker(xmat, ymat, par, par['compact'], backend)]
+        labels = object_tracking.label_storms(var, par['minpixel'], par['threshold'], struct2d, par['under_t'])
+        now_time = init_time + datetime.timedelta(minutes=par['dt'] * nt)
+        full, other = [tracker.step(var, labels.copy(), now_time) for tracker in trackers]
+        numstorms += len(full.StormData)
+        names = object_tracking.StormTable.columns + [name + suffix for name in object_tracking.StormTable.lineage
+                                                      for suffix in ['_offsets', '_values']]
+        compared = [(name, getattr(full.StormData, name), getattr(other.StormData, name)) for name in names]
+        compared += [(name, getattr(full, name), getattr(other, name)) for name in ['wasarray', 'lifearray', 'newwas']]
+        for name, first, second in compared:
+            if not np.array_equal(first, second):
+                return {'images': nt + 1, 'storms': numstorms, 'difference': (nt, name)}
+    return {'images': nt + 1, 'storms': numstorms, 'difference': None}
+
+
+def environment():
+    """
+    :return: Versions and machine of a benchmark run, with the git revision of the code if available
+    :rtype: dict
+    """
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                  capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {'date': datetime.datetime.now().isoformat(timespec='seconds'), 'revision': revision,
+            'python': sys.version.split()[0], 'numpy': np.__version__, 'scipy': scipy.__version__,
+            'numba': None if kernels.numba is None else kernels.numba.__version__,
+            'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+
+def run_benchmarks(cases, filename, **kwargs):
+    """
+    Run benchmark cases and write the results to a JSON file
+    :param cases: (shape, nstorms) of each case
+    :type cases: list
+    :param filename: JSON file of the results
+    :type filename: str
+    :param kwargs: Passed to benchmark_case
+    :return: Results, with the environment and the record of each case
+    :rtype: dict
+    """
+    results = {'environment': environment(), 'cases': []}
+    for shape, nstorms in cases:
+        record = benchmark_case(shape, nstorms, **kwargs)
+        results['cases'].append(record)
+        print(str(shape[0]) + 'x' + str(shape[1]), 'storms', nstorms, ' '.join(
+            name + '=' + str(round(times['median'], 4)) for name, times in record['seconds'].items()
+            if times['n'] > 0))
+        # Written after every case, so the finished cases are kept if a large case runs out of memory
+        with open(filename, 'w') as fw:
+            json.dump(results, fw, indent=1)
+    return results
+
+
+def compare(baseline, current, tolerance=1.1):
+    """
+    Compare the median times of the cases two results files have in common
+    :param baseline: JSON file of earlier results
+    :type baseline: str
+    :param current: JSON file of new results
+    :type current: str
+    :param tolerance: Cases slower than tolerance times the baseline are reported
+    :type tolerance: float
+    :return: List of (grid, nstorms, name, baseline median, current median, ratio) of slower functions
+    :rtype: list
+    """
+    with open(baseline) as fr:
+        old = {(tuple(case['grid']), case['nstorms']): case for case in json.load(fr)['cases']}
+    with open(current) as fr:
+        new = json.load(fr)['cases']
+    slower = []
+    for case in new:
+        key = (tuple(case['grid']), case['nstorms'])
+        if key not in old:
+            continue
+        for name, times in case['seconds'].items():
+            before = old[key]['seconds'].get(name, {'n': 0})
+            if times['n'] > 0 and before['n'] > 0 and times['median'] > tolerance * before['median']:
+                slower.append((key[0], key[1], name, before['median'], times['median'],
+                               times['median'] / before['median']))
+    return slower
+
+
+if __name__ == '__main__':
+    ##################################################################
+    # BENCHMARK SWEEPS
+    ##################################################################
+
+    # Grid sizes, with the storm density of the example data (about 40 storms on 300 * 400)
+    grid_sweep = [(300, 400), (1000, 1000), (2000, 2000), (4000, 4000)]
+    storm_density = 40. / (300 * 400)
+
+    # Numbers of storms on one grid
+    storm_sweep = [10, 100, 1000, 10000]
+    storm_grid = (2000, 2000)
+
+    # Frames per case and storm generator settings (see synthetic.synthetic_frames)
+    frames = 5
+    generator = {'split_rate': 0.02, 'merge_rate': 0.02}
+
+    # Tracking backend ('numpy', 'numba' or 'auto', see kernels.py)
+    backend = 'numpy'
+
+    # Results file, and an earlier results file to compare with (None for no comparison)
+    output_file = './benchmark.json'
+    baseline_file = None
+
+    cases = [(shape, int(round(storm_density * shape[0] * shape[1]))) for shape in grid_sweep]
+    cases = cases + [(storm_grid, nstorms) for nstorms in storm_sweep]
+    run_benchmarks(cases, output_file, frames=frames, settings={'backend': backend}, **generator)
+    if baseline_file is not None:
+        for grid, nstorms, name, before, after, ratio in compare(baseline_file, output_file):
+            print('Slower:', grid, 'storms', nstorms, name, round(before, 4), '->', round(after, 4),
+                  'x' + str(round(ratio, 2)))
+    if kernels.numba is not None:
+        print('numba backend:', compare_backends(synthetic_frames(frames, shape=storm_grid, nstorms=1000, **generator)))
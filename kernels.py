@@ -0,0 +1,349 @@
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+###################################################
+# OPTIONAL COMPILED KERNELS OF THE TRACKING LOOPS
+# The loops of track_storms that do not vectorise well (resolving advected pixels
+# that land on the same grid point, finding old storms in the halo of orphan storms,
+# matching new storms with overlapping old storms, cleaning up accreted ids and
+# splitting storms that share an id) are written here as plain loops over arrays
+# and compiled with numba if it is installed. track_storms uses them with
+# backend='numba', otherwise its NumPy code is used. Both backends give identical
+# results (see benchmark.compare_backends).
+###################################################
+
+if numba is None:
+    def jit(function):
+        return function
+else:
+    jit = numba.njit(cache=True)
+
+
+def resolve_backend(backend):
+    """
+    :param backend: 'numpy', 'numba', or 'auto' for numba if it is installed
+    :type backend: str
+    :return: Backend to use, 'numba' falls back to 'numpy' if numba is not installed
+    :rtype: str
+    """
+    if backend not in ['numpy', 'numba', 'auto']:
+        raise ValueError('Unknown tracking backend ' + str(backend) + ', use numpy, numba or auto')
+    if backend == 'numpy' or numba is None:
+        if backend == 'numba':
+            print('numba is not installed --- Using the numpy backend')
+        return 'numpy'
+    return 'numba'
+
+
+@jit
+def advect_owners(newind, pixstorm, newdist, fixed, size):
+    """
+    Storm owning each grid point after advection. Pixels are visited in storm order: a storm without movement
+    overwrites earlier storms, otherwise a storm only takes a grid point from a storm that is further away,
+    so the first storm in the list wins equal distances (as in advect_storms).
+    :param newind: Flat grid index of each advected pixel, grouped by storm in storm order
+    :type newind: ndarray
+    :param pixstorm: Storm index of each pixel (non-decreasing)
+    :type pixstorm: ndarray
+    :param newdist: Squared distance of each advected pixel to the centroid of its storm
+    :type newdist: ndarray
+    :param fixed: True for each storm without movement
+    :type fixed: ndarray
+    :param size: Number of grid points
+    :type size: int
+    :return: Storm index owning each grid point, -1 for none
+    :rtype: ndarray
+    """
+    owner = np.full(size, -1, dtype=np.int64)
+    ownerdist = np.zeros(size)
+    for kk in range(np.size(newind)):
+        target = newind[kk]
+        if owner[target] < 0 or fixed[pixstorm[kk]] or newdist[kk] < ownerdist[target]:
+            owner[target] = pixstorm[kk]
+            ownerdist[target] = newdist[kk]
+    return owner
+
+
+@jit
+def match_storms(candptr, candq, candhist, candsect, advx, advy, centroidx, centroidy, lapthresh, oldwas, oldlife,
+                 newwas, misval):
+    """
+    Match each new storm with the old storm it continues, or give it a new id (the matching loop of track_storms).
+    :param candptr: Candidate old storms of new storm ns are candq[candptr[ns]:candptr[ns + 1]]
+    :type candptr: ndarray
+    :param candq: Index of each candidate old storm, increasing for each new storm
+    :type candq: ndarray
+    :param candhist: Overlap fraction of each candidate
+    :type candhist: ndarray
+    :param candsect: Overlapping grid points of each candidate and the new storm
+    :type candsect: ndarray
+    :param advx: Centroid x of each advected old storm
+    :type advx: ndarray
+    :param advy: Centroid y of each advected old storm
+    :type advy: ndarray
+    :param centroidx: Centroid x of each new storm
+    :type centroidx: ndarray
+    :param centroidy: Centroid y of each new storm
+    :type centroidy: ndarray
+    :param lapthresh: Minimum overlap fraction
+    :type lapthresh: float
+    :param oldwas: Ids of the old storms
+    :type oldwas: ndarray
+    :param oldlife: Lifetimes of the old storms
+    :type oldlife: ndarray
+    :param newwas: Next new storm id
+    :type newwas: int
+    :param misval: Missing value
+    :type misval: int
+    :return:
+    was, ndarray Id of each new storm
+    life, ndarray Lifetime of each new storm
+    wasdist, ndarray Overlap with the continued old storm, misval for new ids
+    accstorm, ndarray New storm of each accreted id
+    accvalue, ndarray Accreted ids, the other old storms of new storms with several good overlaps
+    newwas, int Next new storm id
+    new_storms, int Number of new ids
+    merges, int Number of new storms with several good overlaps
+    :rtype: tuple
+    """
+    numstorms = np.size(candptr) - 1
+    was = np.zeros(numstorms, dtype=np.int64)
+    life = np.ones(numstorms, dtype=np.int64)
+    wasdist = np.full(numstorms, misval, dtype=np.int64)
+    accstorm = np.zeros(np.size(candq), dtype=np.int64)
+    accvalue = np.zeros(np.size(candq), dtype=np.int64)
+    numacc = 0
+    new_storms = 0
+    merges = 0
+    laps = np.zeros(np.size(candq), dtype=np.int64)
+    for ns in range(numstorms):
+        numlaps = 0
+        for kk in range(candptr[ns], candptr[ns + 1]):
+            if candhist[kk] >= lapthresh:
+                laps[numlaps] = kk
+                numlaps += 1
+        if numlaps == 0:
+            was[ns] = newwas
+            life[ns] = 1
+            newwas += 1
+            new_storms += 1
+            continue
+        if numlaps > 1:
+            merges += 1
+            # Largest overlap, then nearest advected centroid
+            maxsect = candsect[laps[0]]
+            for ll in range(1, numlaps):
+                maxsect = max(maxsect, candsect[laps[ll]])
+            kmax = np.zeros(numlaps, dtype=np.int64)
+            numkmax = 0
+            for ll in range(numlaps):
+                if candsect[laps[ll]] == maxsect:
+                    kmax[numkmax] = ll
+                    numkmax += 1
+            if numkmax > 1:
+                lapdist = np.zeros(numkmax)
+                for ll in range(numkmax):
+                    qq = candq[laps[kmax[ll]]]
+                    lapdist[ll] = np.sqrt((centroidx[ns] - advx[qq]) ** 2 + (centroidy[ns] - advy[qq]) ** 2)
+                mindist = lapdist.min()
+                kkmax = -1
+                numkkmax = 0
+                for ll in range(numkmax):
+                    if lapdist[ll] == mindist:
+                        if numkkmax == 0:
+                            kkmax = kmax[ll]
+                        numkkmax += 1
+                # If still not left with one cell, the first one is used as an index into kmax (as in track_storms)
+                if numkkmax > 1:
+                    if kkmax >= numkmax:
+                        raise IndexError('index out of bounds in the tie-break of equal overlaps')
+                    kkmax = kmax[kkmax]
+            else:
+                kkmax = kmax[0]
+            kindex = laps[kkmax]
+            for ll in range(numlaps):
+                if laps[ll] != kindex:
+                    accstorm[numacc] = ns
+                    accvalue[numacc] = oldwas[candq[laps[ll]]]
+                    numacc += 1
+        else:
+            kindex = laps[0]
+        was[ns] = oldwas[candq[kindex]]
+        life[ns] = oldlife[candq[kindex]] + 1
+        wasdist[ns] = candsect[kindex]
+    return was, life, wasdist, accstorm[:numacc], accvalue[:numacc], newwas, new_storms, merges
+
+
+@jit
+def halo_pairs(QuvL, xs, ys, centroidx, centroidy, orphans, halosq):
+    """
+    Advected old storm pixels within the halo of orphan storms. Only the box around each centroid is searched,
+    with the same strict halo test as track_storms.
+    :param QuvL: Old storm labels advected onto the new grid
+    :type QuvL: ndarray
+    :param xs: Increasing x-coordinates of the grid columns (xmat[0, :])
+    :type xs: ndarray
+    :param ys: Increasing y-coordinates of the grid rows (ymat[:, 0])
+    :type ys: ndarray
+    :param centroidx: Centroid x of each new storm
+    :type centroidx: ndarray
+    :param centroidy: Centroid y of each new storm
+    :type centroidy: ndarray
+    :param orphans: Indices of the orphan storms
+    :type orphans: ndarray
+    :param halosq: Square of radius of halo
+    :type halosq: float
+    :return:
+    pairstorm, ndarray Orphan storm of each pixel within a halo
+    pairlabel, ndarray Advected old storm label of the pixel
+    :rtype: tuple
+    """
+    radius = np.sqrt(halosq)
+    numpairs = 0
+    for counting in (True, False):
+        if not counting:
+            pairstorm = np.zeros(numpairs, dtype=np.int64)
+            pairlabel = np.zeros(numpairs, dtype=np.int64)
+            numpairs = 0
+        for ns in orphans:
+            row0 = np.searchsorted(ys, centroidy[ns] - radius - 1.)
+            row1 = np.searchsorted(ys, centroidy[ns] + radius + 1.)
+            col0 = np.searchsorted(xs, centroidx[ns] - radius - 1.)
+            col1 = np.searchsorted(xs, centroidx[ns] + radius + 1.)
+            for row in range(row0, row1):
+                for col in range(col0, col1):
+                    if QuvL[row, col] > 0 and (xs[col] - centroidx[ns]) ** 2 + (ys[row] - centroidy[ns]) ** 2 < halosq:
+                        if not counting:
+                            pairstorm[numpairs] = ns
+                            pairlabel[numpairs] = QuvL[row, col]
+                        numpairs += 1
+    return pairstorm, pairlabel
+
+
+def halo_search(QuvL, xmat, ymat, centroidx, centroidy, orphans, halosq):
+    """
+    halo_pairs on a grid with increasing or decreasing coordinates. Decreasing axes are flipped first,
+    since halo_pairs searches the coordinates with searchsorted.
+    :param QuvL: Old storm labels advected onto the new grid
+    :type QuvL: ndarray
+    :param xmat: meshgrid of x-coordinates, monotonic along the rows
+    :type xmat: ndarray
+    :param ymat: meshgrid of y-coordinates, monotonic along the columns
+    :type ymat: ndarray
+    :param centroidx: Centroid x of each new storm
+    :type centroidx: ndarray
+    :param centroidy: Centroid y of each new storm
+    :type centroidy: ndarray
+    :param orphans: Indices of the orphan storms
+    :type orphans: ndarray
+    :param halosq: Square of radius of halo
+    :type halosq: float
+    :return: See halo_pairs
+    :rtype: tuple
+    """
+    xs, ys = np.asarray(xmat)[0, :], np.asarray(ymat)[:, 0]
+    if xs[0] > xs[-1]:
+        xs, QuvL = xs[::-1], QuvL[:, ::-1]
+    if ys[0] > ys[-1]:
+        ys, QuvL = ys[::-1], QuvL[::-1]
+    return halo_pairs(np.ascontiguousarray(QuvL), np.ascontiguousarray(xs), np.ascontiguousarray(ys), centroidx,
+                      centroidy, orphans, halosq)
+
+
+@jit
+def clean_accreted(accptr, accvalues, wasnum, misval):
+    """
+    Remove accreted ids that are also ids of storms (the sanity check of track_storms). A removed id becomes misval,
+    the last id is replaced by the last remaining id, and a list without remaining ids becomes [misval].
+    :param accptr: Accreted ids of storm kk are accvalues[accptr[kk]:accptr[kk + 1]]
+    :type accptr: ndarray
+    :param accvalues: Accreted ids
+    :type accvalues: ndarray
+    :param wasnum: Sorted ids of the storms
+    :type wasnum: ndarray
+    :param misval: Missing value
+    :type misval: int
+    :return: Offsets and values of the cleaned lists
+    :rtype: tuple
+    """
+    numlists = np.size(accptr) - 1
+    newptr = np.zeros(numlists + 1, dtype=np.int64)
+    newvalues = np.zeros(np.size(accvalues), dtype=np.int64)
+    for kk in range(numlists):
+        start = newptr[kk]
+        numvalues = 0
+        last = misval
+        remaining = False
+        for ll in range(accptr[kk], accptr[kk + 1]):
+            value = accvalues[ll]
+            pos = np.searchsorted(wasnum, value)
+            if pos < np.size(wasnum) and wasnum[pos] == value:
+                value = misval
+            if value > misval:
+                last = value
+                remaining = True
+            newvalues[start + numvalues] = value
+            numvalues += 1
+        if remaining:
+            newvalues[start + numvalues - 1] = last
+        else:
+            newvalues[start] = misval
+            numvalues = 1
+        newptr[kk + 1] = start + numvalues
+    return newptr, newvalues[:newptr[numlists]]
+
+
+@jit
+def split_storms(was, wasdist, life, child, groupptr, members, newwas, misval):
+    """
+    Split groups of storms sharing an id (the split loop of track_storms): the storm with the largest overlap
+    keeps the id, the other storms get new ids and are children of it. was, wasdist, life and child are updated
+    in place.
+    :param was: Id of each storm
+    :type was: ndarray
+    :param wasdist: Overlap of each storm with the old storm of its id
+    :type wasdist: ndarray
+    :param life: Lifetime of each storm
+    :type life: ndarray
+    :param child: Id of the parent of each storm
+    :type child: ndarray
+    :param groupptr: Storms of group gg are members[groupptr[gg]:groupptr[gg + 1]]
+    :type groupptr: ndarray
+    :param members: Storm indices of the groups, increasing within a group, groups in order of their first storm
+    :type members: ndarray
+    :param newwas: Next new storm id
+    :type newwas: int
+    :param misval: Missing value
+    :type misval: int
+    :return:
+    parents, ndarray Parent storm of each group
+    children, ndarray New ids of the children of the groups, in group order
+    newwas, int Next new storm id
+    :rtype: tuple
+    """
+    numgroups = np.size(groupptr) - 1
+    parents = np.zeros(numgroups, dtype=np.int64)
+    children = np.zeros(np.size(members) - numgroups, dtype=np.int64)
+    numchildren = 0
+    for gg in range(numgroups):
+        kkmax = members[groupptr[gg]]
+        for kk in range(groupptr[gg] + 1, groupptr[gg + 1]):
+            if wasdist[members[kk]] > wasdist[kkmax]:
+                kkmax = members[kk]
+        parents[gg] = kkmax
+        for kk in range(groupptr[gg], groupptr[gg + 1]):
+            kkind = members[kk]
+            if kkind != kkmax:
+                child[kkind] = was[kkmax]
+                was[kkind] = newwas
+                life[kkind] = life[kkmax]
+                children[numchildren] = newwas
+                numchildren += 1
+                newwas += 1
+                wasdist[kkind] = misval
+    return parents, children, newwas
@@ -0,0 +1,148 @@
+import collections
+import datetime
+import numpy as np
+from netCDF4 import Dataset as ncfile
+from netCDF4 import num2date
+
+
+###################################################
+# NetCDFLoader READS A WINDOW OF A VARIABLE FROM NETCDF FILES
+# Files are kept open in a small cache of handles (least recently used files are
+# closed first), so the frames of a multi-frame file are read without opening it
+# again. Only the window is read from the file, it is scaled and turned to the
+# orientation of the tracking grid in one pass into a float32 buffer.
+###################################################
+
+class NetCDFLoader():
+    """Loads frames of a 2D (or time, 2D) variable from NetCDF files. A loader is not thread-safe,
+    use one loader per thread or process."""
+
+    def __init__(self, varname, window=(slice(None), slice(None)), scale=1., transpose=True, flip=True,
+                 time_name='time', handles=4, dtype=np.float32):
+        """
+
+        :param varname: Name of the variable
+        :type varname: str
+        :param window: Slices of the two grid dimensions of the variable to read
+        :type window: tuple
+        :param scale: The data are divided by scale
+        :type scale: float
+        :param transpose: Transpose the window, e.g. if the file is stored (x, y)
+        :type transpose: bool
+        :param flip: Reverse the first axis after transposing (rows from the top of the image)
+        :type flip: bool
+        :param time_name: Name of the time variable (with CF units) holding the time stamps of the frames
+        :type time_name: str
+        :param handles: Maximum number of open files
+        :type handles: int
+        :param dtype: Data type of the loaded fields
+        :type dtype: numpy dtype
+        """
+        self.varname = varname
+        self.window = tuple(window)
+        self.scale = scale
+        self.transpose = transpose
+        self.flip = flip
+        self.time_name = time_name
+        self.handles = handles
+        self.dtype = dtype
+        self.files = collections.OrderedDict()
+
+    def open(self, filename):
+        """
+        Handle of a file, opened if it is not in the cache
+        :param filename: NetCDF file
+        :type filename: str
+        :return: Open dataset
+        :rtype: netCDF4.Dataset
+        """
+        if filename in self.files:
+            self.files.move_to_end(filename)
+        else:
+            self.files[filename] = ncfile(filename)
+            while len(self.files) > self.handles:
+                self.files.popitem(last=False)[1].close()
+        return self.files[filename]
+
+    def num_frames(self, filename):
+        """
+        :param filename: NetCDF file
+        :type filename: str
+        :return: Number of frames in the file, 1 if the variable has no time dimension
+        :rtype: int
+        """
+        variable = self.open(filename).variables[self.varname]
+        return variable.shape[0] if variable.ndim > 2 else 1
+
+    def frame_time(self, filename, index=0):
+        """
+        Time stamp of a frame from the time variable of the file
+        :param filename: NetCDF file
+        :type filename: str
+        :param index: Frame in the file
+        :type index: int
+        :return: Time stamp, None if the file has no time variable with units
+        :rtype: datetime.datetime
+        """
+        nc = self.open(filename)
+        if self.time_name not in nc.variables or not hasattr(nc.variables[self.time_name], 'units'):
+            return None
+        times = nc.variables[self.time_name]
+        value = times[index] if times.ndim > 0 else times[...]
+        when = num2date(value, times.units, calendar=getattr(times, 'calendar', 'standard'),
+                        only_use_cftime_datetimes=False)
+        # Other calendars give cftime dates
+        return datetime.datetime(when.year, when.month, when.day, when.hour, when.minute, when.second)
+
+    def load(self, filename, index=0, out=None):
+        """
+        Read the window of one frame
+        :param filename: NetCDF file
+        :type filename: str
+        :param index: Frame in the file, for variables with a time dimension
+        :type index: int
+        :param out: Array to write the field into, so it can be reused between calls. New array if not given.
+        :type out: ndarray
+        :return:
+        field, ndarray with missing values (fill values of the file) set to nan
+        time stamp, datetime.datetime or None (see frame_time)
+        :rtype: tuple
+        """
+        variable = self.open(filename).variables[self.varname]
+        if variable.ndim > 2:
+            raw = variable[(index,) + self.window]
+        else:
+            raw = variable[self.window]
+        mask = np.ma.getmaskarray(raw) if np.ma.isMaskedArray(raw) else None
+        raw = np.ma.getdata(raw)
+        if self.transpose:
+            raw = raw.T
+            mask = None if mask is None else mask.T
+        if self.flip:
+            raw = raw[::-1]
+            mask = None if mask is None else mask[::-1]
+        if out is None:
+            out = np.empty(raw.shape, dtype=self.dtype)
+        np.divide(raw, self.scale, out=out, casting='unsafe')
+        if mask is not None and mask.any():
+            out[mask] = np.nan
+        return out, self.frame_time(filename, index)
+
+    def frames(self, filename, out=None):
+        """
+        Read all frames of a file in turn
+        :param filename: NetCDF file
+        :type filename: str
+        :param out: Array reused for every frame, so a frame must be used before the next one is read
+        :type out: ndarray
+        :return: Generator of (index, field, time stamp), see load
+        :rtype: generator
+        """
+        for index in range(self.num_frames(filename)):
+            field, when = self.load(filename, index=index, out=out)
+            yield index, field, when
+
+    def close(self):
+        """Close all open files"""
+        while len(self.files) > 0:
+            self.files.popitem(last=False)[1].close()
@@ -1,11 +1,20 @@
 import os
+import functools
+import collections
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy import interpolate
+from scipy import sparse
+from scipy import fft
+from scipy import spatial
+from scipy.sparse import csgraph
 import scipy.ndimage as ndimage
 import datetime
 from os.path import isfile, isdir
 import matplotlib.pyplot as plt
-import warnings
+from concurrent.futures import ThreadPoolExecutor
+from stats import FrameStats
+import kernels
 
 
 class StormS():
@@ -13,7 +22,8 @@ class StormS():
     Future release could relate StormS and write_storms functions for easier management and user adaptation."""
 
     def __init__(self, jj, StormLabels, var, xmat, ymat, newwas, newumat, newvmat, num_dt, misval, doradar,
-                 under_threshold, extra_thresh=[], storm_history=False, string=None, rarray=[], azarray=[]):
+                 under_threshold, extra_thresh=[], storm_history=False, string=None, rarray=[], azarray=[],
+                 properties=None):
         """
 
         :param jj:
@@ -50,39 +60,47 @@ class StormS():
         :type rarray: ndarray
         :param azarray:
         :type azarray: ndarray
+        :param properties: Properties of all storms as returned by storm_properties, indexed by jj - 1
+        :type properties: dict
         """
         if string == None:  # initialise to default values
-            C = np.where(StormLabels == jj)
+            # Properties of all storms are normally calculated in one pass by track_storms,
+            # otherwise calculate them here for this storm only
+            if properties is None:
+                ns = 0
+                properties = storm_properties(np.where(StormLabels == jj, 1, 0), var, xmat, ymat, under_threshold,
+                                              newumat=newumat if storm_history else None,
+                                              newvmat=newvmat if storm_history else None, num_dt=num_dt,
+                                              extra_thresh=extra_thresh)
+            else:
+                ns = int(jj) - 1
             # Storm number
             self.storm = int(jj)
             # Number of grid points occupied
-            self.area = int(np.size(C, 1))
+            self.area = int(properties['area'][ns])
             # Max/min value of tracking variable in storm depending on whether threshold is under or over
-            if under_threshold:
-                self.extreme = np.min(var[C])
-            else:
-                self.extreme = np.max(var[C])
+            self.extreme = properties['extreme'][ns]
             # Mean value of tracking variable in storm
-            self.meanvar = np.mean(var[C])
+            self.meanvar = properties['meanvar'][ns]
             # Area count of extra thresholds
             # TODO: Implement under_threshold to check if value is below/above extra_thresh
             if len(extra_thresh) > 0:
-                self.extra_area = [(var[C] < a).sum() for a in extra_thresh]
+                self.extra_area = [extra_area[ns] for extra_area in properties['extra_area']]
             # Centroid coordinates
-            self.centroidx = np.mean(xmat[C])
-            self.centroidy = np.mean(ymat[C])
+            self.centroidx = properties['centroidx'][ns]
+            self.centroidy = properties['centroidy'][ns]
             # Westernmost and northernmost grid box positions, storm box width and height
-            self.boxleft = np.min(xmat[C])
-            self.boxup = np.max(ymat[C])
-            self.boxwidth = np.max(xmat[C]) - np.min(xmat[C])
-            self.boxheight = np.max(ymat[C]) - np.min(ymat[C])
+            self.boxleft = properties['boxleft'][ns]
+            self.boxup = properties['boxup'][ns]
+            self.boxwidth = properties['boxwidth'][ns]
+            self.boxheight = properties['boxheight'][ns]
             # Storm created with lifetime of 1
             self.life = 1
             # If there is a storm history, label old storm number and displacement vectors
             if storm_history:
                 self.was = int(jj)
-                self.dx = np.mean(newumat[C]) / num_dt
-                self.dy = np.mean(newvmat[C]) / num_dt
+                self.dx = properties['dx'][ns]
+                self.dy = properties['dy'][ns]
             # First image to be considered, so no dx or dy or previous label
             else:
                 self.was = newwas
@@ -94,111 +112,752 @@ class StormS():
             self.wasdist = misval
             self.accreted = [misval]
             if doradar:
-                self.rangel = np.min(rarray[C])
-                self.rangeu = np.max(rarray[C])
-                if np.min(rarray[C]) == 0:
-                    self.azimuthl = 0.
-                    self.azimuthu = 360.
-                elif (np.min(azarray[C]) == 0) & (np.max(azarray[C]) > 180):
-                    azxy = np.where((xmat == np.round(self.centroidx)) & (ymat == np.round(self.centroidy)))
-                    azoffset = np.fmod(np.round(azarray[azxy]) + 180., 360.)
-                    aznotind = np.where((StormLabels == jj) & (azarray < azoffset))
-                    if np.size(aznotind) == 0:
-                        self.azimuthl = 0.
-                        self.azimuthu = 360.
-                    elif np.max(azarray[aznotind]) > azoffset - 1.:
-                        self.azimuthl = 0.
-                        self.azimuthu = 360.
-                    else:
-                        azleftind = np.where((StormLabels == jj) & (azarray >= azoffset))
-                        if np.size(azleftind) == 0:
-                            self.azimuthl = np.min(azarray[aznotind])
-                            self.azimuthu = np.max(azarray[aznotind])
-                        else:
-                            self.azimuthl = np.min(azarray[azleftind])
-                            self.azimuthu = np.max(azarray[aznotind])
-                else:
-                    self.azimuthl = np.min(azarray[C])
-                    self.azimuthu = np.max(azarray[C])
+                self.rangel, self.rangeu, self.azimuthl, self.azimuthu = radar_extents(
+                    jj, StormLabels, xmat, ymat, self.centroidx, self.centroidy, rarray, azarray)
 
         # Use string which is line in save file to initialise if available
         else:
+            # Fields of the line written by write_storms, split once
+            tokens = string.split()
+            fields = dict(token.split('=', 1) for token in tokens[2:])
             self.storm = int(jj)
-            self.area = int([d for d in string.split() if d.startswith('area=')][0].replace('area=', ''))
-            self.extreme = float([d for d in string.split() if d.startswith('extreme=')][0].replace('extreme=', ''))
-            self.meanvar = float([d for d in string.split() if d.startswith('meanv=')][0].replace('meanv=', ''))
+            self.was = int(tokens[1])
+            self.area = int(fields['area'])
+            self.extreme = float(fields['extreme'])
+            self.meanvar = float(fields['meanv'])
             if len(extra_thresh) > 0:
-                self.extra_area = [int([d for d in string.split() if d.startswith('area<' + str(e))][0].split('=')[-1])
-                                   for e in extra_thresh]
-            self.centroidx = float(
-                [d for d in string.split() if d.startswith('centroid=')][0].replace('centroid=', '').split(',')[0])
-            self.centroidy = float(
-                [d for d in string.split() if d.startswith('centroid=')][0].replace('centroid=', '').split(',')[1])
-            self.life = int([d for d in string.split() if d.startswith('life=')][0].replace('life=', ''))
-            self.was = int(string.split()[1])
-            self.dx = float([d for d in string.split() if d.startswith('dx=')][0].replace('dx=', ''))
-            self.dy = float([d for d in string.split() if d.startswith('dy=')][0].replace('dy=', ''))
-            self.parent = [int(p) for p in
-                           [d for d in string.split() if d.startswith('parent=')][0].replace('parent=', '').split(',')]
-            self.child = [int(p) for p in
-                          [d for d in string.split() if d.startswith('child=')][0].replace('child=', '').split(',')]
-            self.accreted = [int(p) for p in
-                             [d for d in string.split() if d.startswith('accreted=')][0].replace('accreted=', '').split(
-                                 ',')]
-            box = [d for d in string.split() if d.startswith('box=')][0].replace('box=', '').split(',')
-            self.boxleft = float(box[0])
-            self.boxup = float(box[1])
-            self.boxheight = float(box[2])
-            self.boxwidth = float(box[3])
+                self.extra_area = [int(fields['area<' + str(e)]) for e in extra_thresh]
+            self.centroidx, self.centroidy = [float(c) for c in fields['centroid'].split(',')]
+            self.life = int(fields['life'])
+            # Integers stay integers (dx=0 dy=0 of a first image), so write_storms writes them back the same
+            self.dx = string_number(fields['dx'])
+            self.dy = string_number(fields['dy'])
+            # write_storms writes the id of the storm this one split from as parent=
+            # and the ids of the storms that split off this one as child=
+            self.child = int(fields['parent'])
+            self.parent = [int(p) for p in fields['child'].split(',')]
+            self.accreted = [int(p) for p in fields['accreted'].split(',')]
+            self.wasdist = misval
+            box = fields['box'].split(',')
+            self.boxleft, self.boxup, self.boxwidth, self.boxheight = [string_number(b) for b in box]
             if doradar:
-                self.range = float([d for d in string.split() if d.startswith('range=')][0].replace('range=', ''))
-                self.azimuthl = float(
-                    [d for d in string.split() if d.startswith('azimuth=')][0].replace('azimuth=', '')[0])
-                self.azimuthu = ([d for d in string.split() if d.startswith('azimuth=')][0].replace('azimuth=', '')[1])
+                self.rangel, self.rangeu = [float(r) for r in fields['range'].split(',')]
+                self.azimuthl, self.azimuthu = [float(a) for a in fields['azimuth'].split(',')]
+
+
+def string_number(value):
+    """Integer from a string of a history file, or float if it is not an integer"""
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+class StormTable():
+    """Columnar table of the storm objects of one timestep, storm ns has label ns + 1.
+    Every property is a typed array with one element per storm. The lists of storm ids in accreted and parent
+    are offset-encoded: the ids of storm ns are accreted_values[accreted_offsets[ns]:accreted_offsets[ns + 1]].
+    Indexing or iterating the table gives StormView objects with the attributes of StormS, for code written
+    for lists of StormS objects. New properties can be added as columns (see __init__ and write_storms)."""
 
-    def inherit_properties(self, jj, OldStormData, kindex, QuvL, StormLabels, qhist, lapthresh, misval,
-                           single_overlap=False):
+    # Properties with one value per storm
+    columns = ['storm', 'was', 'area', 'centroidx', 'centroidy', 'boxleft', 'boxup', 'boxwidth', 'boxheight', 'life',
+               'dx', 'dy', 'meanvar', 'extreme', 'child', 'wasdist']
+    # Radar range and azimuth extents, only stored if doradar
+    radar_columns = ['rangel', 'rangeu', 'azimuthl', 'azimuthu']
+    # Lists of storm ids, offset-encoded
+    lineage = ['accreted', 'parent']
+
+    def __init__(self, numstorms, misval, extra_thresh=[], doradar=False):
         """
-        TODO: Inherits properties from previous timestep
-        :param jj:
-        :type jj:
-        :param OldStormData:
-        :type OldStormData:
-        :param kindex:
-        :type kindex:
-        :param QuvL:
-        :type QuvL:
-        :param StormLabels:
-        :type StormLabels:
-        :param qhist:
-        :type qhist:
-        :param lapthresh:
-        :type lapthresh:
-        :param misval:
-        :type misval:
-        :param single_overlap:
-        :type single_overlap:
-        :return:
-        :rtype:
+
+        :param numstorms: Number of storms
+        :type numstorms: int
+        :param misval: Preferred value to used for missing values.
+        :type misval: int
+        :param extra_thresh: Extra thresholds with an area count for each storm
+        :type extra_thresh: list
+        :param doradar: Store radar range and azimuth extents
+        :type doradar: bool
         """
-        self.was = OldStormData[kindex].was
-        self.life = OldStormData[kindex].life + 1
-        # TODO: What is wasdist? Number of overlapping gridsquares between advected storm and current storm?
-        self.wasdist = np.size(np.where((QuvL == kindex + 1) & (StormLabels == jj)), 1)
-        qind = kindex + 1
-
-        # Code below is only required when multiple clouds overlap
-        if not (single_overlap):
-            alllaps = np.where(qhist[1:] >= lapthresh)
-            for kkind in range(np.size(alllaps, 1)):
-                allindex = np.squeeze(alllaps[0][kkind])
-                # Don't add original storm number into accreted list!
-                if allindex == kindex:
-                    continue
-                if self.accreted[-1] == misval:
-                    self.accreted[-1] = OldStormData[allindex].was
-                else:
-                    self.accreted.append(OldStormData[allindex].was)
+        self.misval = misval
+        self.extra_thresh = list(extra_thresh)
+        self.doradar = doradar
+        # Storm number
+        self.storm = np.arange(1, numstorms + 1)
+        # Tracked storm id
+        self.was = np.zeros(numstorms, dtype=int)
+        # Number of grid points occupied
+        self.area = np.zeros(numstorms, dtype=int)
+        # Centroid coordinates
+        self.centroidx = np.zeros(numstorms)
+        self.centroidy = np.zeros(numstorms)
+        # Westernmost and northernmost grid box positions, storm box width and height
+        self.boxleft = np.zeros(numstorms)
+        self.boxup = np.zeros(numstorms)
+        self.boxwidth = np.zeros(numstorms)
+        self.boxheight = np.zeros(numstorms)
+        # Storm created with lifetime of 1
+        self.life = np.ones(numstorms, dtype=int)
+        # Displacement per timestep
+        self.dx = np.zeros(numstorms)
+        self.dy = np.zeros(numstorms)
+        # Mean and max/min value of tracking variable in storm
+        self.meanvar = np.zeros(numstorms)
+        self.extreme = np.zeros(numstorms)
+        # No information on parent, child, distance to previous location etc.
+        self.child = np.full(numstorms, misval, dtype=int)
+        self.wasdist = np.full(numstorms, misval, dtype=int)
+        # Area count of extra thresholds
+        self.extra_area = np.zeros((numstorms, len(self.extra_thresh)), dtype=int)
+        if doradar:
+            for name in self.radar_columns:
+                setattr(self, name, np.zeros(numstorms))
+        for name in self.lineage:
+            setattr(self, name + '_offsets', np.arange(numstorms + 1))
+            setattr(self, name + '_values', np.full(numstorms, misval, dtype=int))
+
+    @classmethod
+    def from_properties(cls, properties, misval, extra_thresh=[], doradar=False):
+        """
+        Table of new storms from the output of storm_properties. Columns keep the data types of the properties.
+        :param properties: Properties of all storms as returned by storm_properties
+        :type properties: dict
+        :param misval: Preferred value to used for missing values.
+        :type misval: int
+        :param extra_thresh: Extra thresholds used by storm_properties
+        :type extra_thresh: list
+        :param doradar: Store radar range and azimuth extents
+        :type doradar: bool
+        :return: Storm table
+        :rtype: StormTable
+        """
+        table = cls(np.size(properties['area']), misval, extra_thresh=extra_thresh, doradar=doradar)
+        for name in ['area', 'centroidx', 'centroidy', 'boxleft', 'boxup', 'boxwidth', 'boxheight', 'meanvar',
+                     'extreme', 'dx', 'dy']:
+            if name in properties:
+                setattr(table, name, np.asarray(properties[name]))
+        if len(table.extra_thresh) > 0:
+            table.extra_area = np.stack(properties['extra_area'], axis=1)
+        return table
+
+    @classmethod
+    def from_storms(cls, storms, misval, extra_thresh=[], doradar=False):
+        """
+        Table from a list of StormS objects (or StormView objects).
+        :param storms: Storms, storm ns must have label ns + 1
+        :type storms: list
+        :param misval: Preferred value to used for missing values.
+        :type misval: int
+        :param extra_thresh: Extra thresholds with an area count for each storm
+        :type extra_thresh: list
+        :param doradar: Store radar range and azimuth extents
+        :type doradar: bool
+        :return: Storm table
+        :rtype: StormTable
+        """
+        table = cls(len(storms), misval, extra_thresh=extra_thresh, doradar=doradar)
+        if len(storms) == 0:
+            return table
+        for name in cls.columns + (cls.radar_columns if doradar else []):
+            setattr(table, name, np.array([getattr(storm, name) for storm in storms]))
+        if len(table.extra_thresh) > 0:
+            table.extra_area = np.array([storm.extra_area for storm in storms], dtype=int)
+        for name in cls.lineage:
+            table.set_lineage(name, {ns: getattr(storms[ns], name) for ns in range(len(storms))})
+        return table
+
+    def get_lineage(self, name, ns):
+        """
+        List of storm ids of one storm
+        :param name: 'accreted' or 'parent'
+        :type name: str
+        :param ns: Storm index
+        :type ns: int
+        :return: Storm ids
+        :rtype: list
+        """
+        offsets = getattr(self, name + '_offsets')
+        return getattr(self, name + '_values')[offsets[ns]:offsets[ns + 1]].tolist()
+
+    def set_lineage(self, name, lists):
+        """
+        Replace the lists of storm ids of some storms, the lists of all other storms are kept.
+        :param name: 'accreted' or 'parent'
+        :type name: str
+        :param lists: New lists of storm ids, by storm index
+        :type lists: dict
+        """
+        if len(lists) == 0:
+            return
+        offsets = getattr(self, name + '_offsets')
+        values = getattr(self, name + '_values')
+        changed = np.zeros(len(self), dtype=bool)
+        changed[list(lists.keys())] = True
+        lengths = np.diff(offsets)
+        newlengths = lengths.copy()
+        for ns in lists:
+            newlengths[ns] = len(lists[ns])
+        newoffsets = np.concatenate(([0], np.cumsum(newlengths)))
+        newvalues = np.empty(newoffsets[-1], dtype=values.dtype)
+        # Unchanged lists are copied in one go, they keep their order
+        newvalues[np.repeat(~changed, newlengths)] = values[np.repeat(~changed, lengths)]
+        for ns in lists:
+            newvalues[newoffsets[ns]:newoffsets[ns + 1]] = lists[ns]
+        setattr(self, name + '_offsets', newoffsets)
+        setattr(self, name + '_values', newvalues)
+
+    def __len__(self):
+        return np.size(self.storm)
+
+    def __getitem__(self, ns):
+        if ns < 0:
+            ns = ns + len(self)
+        if not 0 <= ns < len(self):
+            raise IndexError('storm index out of range')
+        return StormView(self, ns)
+
+    def __iter__(self):
+        for ns in range(len(self)):
+            yield StormView(self, ns)
+
+
+class StormView():
+    """StormS-compatible view of one storm of a StormTable. Attributes are read from and written to the table.
+    accreted and parent are returned as new lists, assign a list to change them. Other attributes (not columns
+    of the table) are set on the view only, as on a StormS object, and are not kept by the table."""
+
+    def __init__(self, table, ns):
+        object.__setattr__(self, 'table', table)
+        object.__setattr__(self, 'ns', ns)
+
+    def __getattr__(self, name):
+        table = object.__getattribute__(self, 'table')
+        ns = object.__getattribute__(self, 'ns')
+        if name in StormTable.lineage:
+            return table.get_lineage(name, ns)
+        if name == 'extra_area':
+            return table.extra_area[ns].tolist()
+        column = table.__dict__.get(name)
+        if isinstance(column, np.ndarray) and np.ndim(column) == 1:
+            return column[ns]
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in StormTable.lineage:
+            self.table.set_lineage(name, {self.ns: list(value)})
+        elif name == 'extra_area':
+            self.table.extra_area[self.ns] = value
+        elif isinstance(self.table.__dict__.get(name), np.ndarray):
+            getattr(self.table, name)[self.ns] = value
+        else:
+            object.__setattr__(self, name, value)
+
+
+###################################################
+# radar_extents CALCULATES RANGE AND AZIMUTH EXTENTS
+# OF A STORM FOR A SINGLE SITE RADAR
+###################################################
+
+def radar_extents(jj, StormLabels, xmat, ymat, centroidx, centroidy, rarray, azarray):
+    """
+    Range and azimuth extents of storm jj. Storms at the radar have azimuths (0, 360), storms crossing
+    north have azimuthl > azimuthu.
+    :param jj: Storm label
+    :type jj: int
+    :param StormLabels: Storm labels
+    :type StormLabels: ndarray
+    :param xmat: meshgrid of x-coordinates
+    :type xmat: ndarray
+    :param ymat: meshgrid of y-coordinates
+    :type ymat: ndarray
+    :param centroidx: Centroid x-coordinate of storm
+    :type centroidx: float
+    :param centroidy: Centroid y-coordinate of storm
+    :type centroidy: float
+    :param rarray: Radar ranges
+    :type rarray: ndarray
+    :param azarray: Radar azimuths
+    :type azarray: ndarray
+    :return: rangel, rangeu, azimuthl, azimuthu
+    :rtype: tuple
+    """
+    C = np.where(StormLabels == jj)
+    rangel = np.min(rarray[C])
+    rangeu = np.max(rarray[C])
+    if np.min(rarray[C]) == 0:
+        azimuthl = 0.
+        azimuthu = 360.
+    elif (np.min(azarray[C]) == 0) & (np.max(azarray[C]) > 180):
+        azxy = np.where((xmat == np.round(centroidx)) & (ymat == np.round(centroidy)))
+        azoffset = np.fmod(np.round(azarray[azxy]) + 180., 360.)
+        aznotind = np.where((StormLabels == jj) & (azarray < azoffset))
+        if np.size(aznotind) == 0:
+            azimuthl = 0.
+            azimuthu = 360.
+        elif np.max(azarray[aznotind]) > azoffset - 1.:
+            azimuthl = 0.
+            azimuthu = 360.
+        else:
+            azleftind = np.where((StormLabels == jj) & (azarray >= azoffset))
+            if np.size(azleftind) == 0:
+                azimuthl = np.min(azarray[aznotind])
+                azimuthu = np.max(azarray[aznotind])
+            else:
+                azimuthl = np.min(azarray[azleftind])
+                azimuthu = np.max(azarray[aznotind])
+    else:
+        azimuthl = np.min(azarray[C])
+        azimuthu = np.max(azarray[C])
+    return rangel, rangeu, azimuthl, azimuthu
+
+
+###################################################
+# RadarGeometry HOLDS THE RANGE AND AZIMUTH OF EVERY GRID POINT FOR A SINGLE SITE RADAR
+# AND CALCULATES THE EXTENTS OF ALL STORMS IN ONE PASS OVER THE LABELLED PIXELS,
+# WITH THE SAME RESULTS AS radar_extents FOR EACH STORM
+###################################################
+
+class RadarGeometry():
+    """Radar range and azimuth of a grid, with the grid indices of the x- and y-coordinates"""
+
+    def __init__(self, xmat, ymat, rarray=None, azarray=None):
+        """
+
+        :param xmat: meshgrid of x-coordinates
+        :type xmat: ndarray
+        :param ymat: meshgrid of y-coordinates
+        :type ymat: ndarray
+        :param rarray: Radar ranges, distance from the radar at (0, 0) if not given
+        :type rarray: ndarray
+        :param azarray: Radar azimuths in degrees, clockwise from the y-axis if not given
+        :type azarray: ndarray
+        """
+        if rarray is None:
+            rarray = np.sqrt(xmat ** 2 + ymat ** 2)
+        if azarray is None:
+            azarray = np.rad2deg(np.arctan2(xmat, ymat)) % 360.0
+            azarray[np.isnan(azarray)] = 0
+        self.rarray = np.asarray(rarray, dtype=float)
+        self.azarray = np.asarray(azarray, dtype=float)
+        # Column of each x-coordinate and row of each y-coordinate, to find the pixel at a rounded centroid
+        self.column = {x: col for col, x in enumerate(np.asarray(xmat)[0].tolist())}
+        self.row = {y: row for row, y in enumerate(np.asarray(ymat)[:, 0].tolist())}
+
+    def extents(self, StormLabels, centroidx, centroidy):
+        """
+        Range and azimuth extents of all storms. Storms at the radar have azimuths (0, 360), storms crossing
+        north have azimuthl > azimuthu.
+        :param StormLabels: Storm labels 1..N, as returned by label_storms
+        :type StormLabels: ndarray
+        :param centroidx: Centroid x-coordinates of the storms
+        :type centroidx: ndarray
+        :param centroidy: Centroid y-coordinates of the storms
+        :type centroidy: ndarray
+        :return: rangel, rangeu, azimuthl, azimuthu, arrays with element ns for storm ns + 1
+        :rtype: tuple
+        """
+        labels = np.ravel(StormLabels)
+        flatind = np.flatnonzero(labels)
+        flatind = flatind[np.argsort(labels[flatind], kind='stable')]
+        area = np.bincount(labels[flatind].astype(np.intp))[1:]
+        if np.size(area) == 0:
+            return np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0)
+        starts = np.concatenate(([0], np.cumsum(area)[:-1])).astype(np.intp)
+        rC = np.ravel(self.rarray)[flatind]
+        azC = np.ravel(self.azarray)[flatind]
+        rangel = np.minimum.reduceat(rC, starts)
+        rangeu = np.maximum.reduceat(rC, starts)
+        azimuthl = np.minimum.reduceat(azC, starts)
+        azimuthu = np.maximum.reduceat(azC, starts)
+
+        # Storms at the radar cover all azimuths
+        full = rangel == 0
+        # Storms with pixels north of the radar (azimuth 0) and azimuths over 180 may cross north. Azimuths are
+        # split at the opposite of the (rounded) azimuth of the centroid: azimuths below it are east of north
+        crossing = np.flatnonzero(~full & (azimuthl == 0) & (azimuthu > 180))
+        if np.size(crossing) > 0:
+            azoffset = np.zeros(np.size(area))
+            for ns in crossing:
+                azcentre = self.azarray[self.row[float(np.round(centroidy[ns]))],
+                                        self.column[float(np.round(centroidx[ns]))]]
+                azoffset[ns] = np.fmod(np.round(azcentre) + 180., 360.)
+            below = azC < np.repeat(azoffset, area)
+            numbelow = np.add.reduceat(below.astype(int), starts)
+            maxbelow = np.maximum.reduceat(np.where(below, azC, -np.inf), starts)
+            minbelow = np.minimum.reduceat(np.where(below, azC, np.inf), starts)
+            minabove = np.minimum.reduceat(np.where(below, np.inf, azC), starts)
+            # No pixels east of north, or storm reaching the opposite azimuth: all azimuths
+            full[crossing] = (numbelow[crossing] == 0) | (maxbelow[crossing] > azoffset[crossing] - 1.)
+            split = crossing[~full[crossing]]
+            azimuthl[split] = np.where(numbelow[split] == area[split], minbelow[split], minabove[split])
+            azimuthu[split] = maxbelow[split]
+        azimuthl[full] = 0.
+        azimuthu[full] = 360.
+        return rangel, rangeu, azimuthl, azimuthu
+
+
+###################################################
+# storm_properties CALCULATES THE PROPERTIES OF ALL LABELLED OBJECTS IN ONE PASS
+# LABELLED PIXELS ARE SORTED BY LABEL ONCE AND EACH PROPERTY IS A REDUCTION
+# OVER THE CONTIGUOUS GROUP OF PIXELS BELONGING TO EACH LABEL
+###################################################
+
+def storm_properties(StormLabels, var, xmat, ymat, under_threshold, newumat=None, newvmat=None, num_dt=1,
+                     extra_thresh=[]):
+    """
+    Calculate object properties for all labels 1..N at once, instead of one full-grid search per object.
+    Labels must be consecutive and each label must occupy at least one grid point (as returned by label_storms).
+    :param StormLabels: Integer array of storm labels, 0 for background
+    :type StormLabels: ndarray
+    :param var: Variable in a 2D grid used for tracking
+    :type var: ndarray
+    :param xmat: meshgrid of x-coordinates
+    :type xmat: ndarray
+    :param ymat: meshgrid of y-coordinates
+    :type ymat: ndarray
+    :param under_threshold: Is the variable of interest smaller than a threshold
+    :type under_threshold: bool
+    :param newumat: Displacement in x-direction, dx and dy are only calculated if given
+    :type newumat: ndarray
+    :param newvmat: Displacement in y-direction
+    :type newvmat: ndarray
+    :param num_dt: Number of timesteps between old and new
+    :type num_dt: float
+    :param extra_thresh: Extra thresholds for which the area under each threshold is counted
+    :type extra_thresh: list
+    :return: Dictionary of property arrays, element ns holds the properties of storm ns + 1
+    :rtype: dict
+    """
+    labels = np.ravel(StormLabels)
+    # Flat indices of labelled pixels, grouped by label and in raster order within each label
+    flatind = np.flatnonzero(labels)
+    order = np.argsort(labels[flatind], kind='stable')
+    flatind = flatind[order]
+    area = np.bincount(labels[flatind].astype(np.intp))[1:]
+    starts = np.concatenate(([0], np.cumsum(area)[:-1])).astype(np.intp)
+
+    properties = {'area': area}
+    if np.size(area) == 0:
+        for key in ['extreme', 'meanvar', 'centroidx', 'centroidy', 'boxleft', 'boxup', 'boxwidth', 'boxheight',
+                    'dx', 'dy']:
+            properties[key] = np.zeros(0)
+        properties['extra_area'] = [np.zeros(0, dtype=int) for a in extra_thresh]
+        return properties
+
+    varC = np.ravel(np.asarray(var))[flatind]
+    xC = np.ravel(xmat)[flatind]
+    yC = np.ravel(ymat)[flatind]
+    if under_threshold:
+        properties['extreme'] = np.minimum.reduceat(varC, starts)
+    else:
+        properties['extreme'] = np.maximum.reduceat(varC, starts)
+    properties['meanvar'] = np.add.reduceat(varC.astype(float), starts) / area
+    properties['extra_area'] = [np.add.reduceat((varC < a).astype(int), starts) for a in extra_thresh]
+    properties['centroidx'] = np.add.reduceat(xC.astype(float), starts) / area
+    properties['centroidy'] = np.add.reduceat(yC.astype(float), starts) / area
+    xmin = np.minimum.reduceat(xC, starts)
+    ymin = np.minimum.reduceat(yC, starts)
+    ymax = np.maximum.reduceat(yC, starts)
+    properties['boxleft'] = xmin
+    properties['boxup'] = ymax
+    properties['boxwidth'] = np.maximum.reduceat(xC, starts) - xmin
+    properties['boxheight'] = ymax - ymin
+    if newumat is not None and newvmat is not None:
+        properties['dx'] = np.add.reduceat(np.ravel(newumat)[flatind].astype(float), starts) / area / num_dt
+        properties['dy'] = np.add.reduceat(np.ravel(newvmat)[flatind].astype(float), starts) / area / num_dt
+
+    return properties
+
+
+def new_storm_table(properties, StormLabels, xmat, ymat, misval, doradar, extra_thresh=[], rarray=[], azarray=[],
+                    radar=None):
+    """
+    Table of new storms from their properties, with radar extents if doradar.
+    :param properties: Properties of all storms as returned by storm_properties
+    :type properties: dict
+    :param StormLabels: Storm labels
+    :type StormLabels: ndarray
+    :param xmat: meshgrid of x-coordinates
+    :type xmat: ndarray
+    :param ymat: meshgrid of y-coordinates
+    :type ymat: ndarray
+    :param misval: Preferred value to used for missing values.
+    :type misval: int
+    :param doradar: For calculating radar range and azimuth if real-time tracking with a single site radar
+    :type doradar: bool
+    :param extra_thresh: Extra thresholds used by storm_properties
+    :type extra_thresh: list
+    :param rarray: Radar ranges
+    :type rarray: ndarray
+    :param azarray: Radar azimuths
+    :type azarray: ndarray
+    :param radar: Radar geometry of the grid, made from rarray and azarray if not given
+    :type radar: RadarGeometry
+    :return: Storm table
+    :rtype: StormTable
+    """
+    StormData = StormTable.from_properties(properties, misval, extra_thresh=extra_thresh, doradar=doradar)
+    if doradar:
+        if radar is None:
+            radar = RadarGeometry(xmat, ymat, rarray, azarray)
+        StormData.rangel, StormData.rangeu, StormData.azimuthl, StormData.azimuthu = radar.extents(
+            StormLabels, StormData.centroidx, StormData.centroidy)
+    return StormData
+
+
+###################################################
+# advect_storms MOVES ALL LABELLED PIXELS OF THE OLD STORMS AT ONCE
+# IF SEVERAL STORMS LAND ON THE SAME PIXEL, THE STORM WITH THE CLOSEST
+# CENTROID IS KEPT. STORMS WITHOUT DISPLACEMENT OVERWRITE EARLIER STORMS.
+# EQUAL DISTANCES KEEP THE STORM THAT COMES FIRST IN OldStormData.
+###################################################
+
+def advect_storms(OldStormData, OldStormLabels, newumat, newvmat, xmat, ymat, backend='numpy'):
+    """
+    Advect old storm labels onto the new grid with the mean displacement of each storm.
+    Pixels moved outside the domain are dropped.
+    :param OldStormData: Storms of the previous timestep, storm ns has label ns + 1
+    :type OldStormData: StormTable
+    :param OldStormLabels: Old storm labels
+    :type OldStormLabels: ndarray
+    :param newumat: Displacement in x-direction on the full grid
+    :type newumat: ndarray
+    :param newvmat: Displacement in y-direction on the full grid
+    :type newvmat: ndarray
+    :param xmat: meshgrid of x-coordinates
+    :type xmat: ndarray
+    :param ymat: meshgrid of y-coordinates
+    :type ymat: ndarray
+    :param backend: 'numba' to resolve pixels landing on the same grid point with a compiled loop (see kernels)
+    :type backend: str
+    :return:
+    QuvL, ndarray Old storm labels at their advected positions
+    AdvectedStorms, ndarray Centroid x, centroid y and area of each advected storm (zeros if none left)
+    :rtype: tuple
+    """
+    nrows, ncols = np.shape(OldStormLabels)
+    QuvL = np.zeros(OldStormLabels.shape, dtype=OldStormLabels.dtype)
+    AdvectedStorms = np.zeros([len(OldStormData), 3])
+    if len(OldStormData) == 0:
+        return QuvL, AdvectedStorms
+    storms = OldStormData.storm.astype(np.intp)
+    centroidx = OldStormData.centroidx
+    centroidy = OldStormData.centroidy
+
+    # Pixels of each old storm, grouped by storm in the order of OldStormData and in raster order within a storm
+    labels = np.ravel(OldStormLabels).astype(np.intp)
+    stormlut = np.full(max(labels.max(), storms.max()) + 1, -1, dtype=np.intp)
+    stormlut[storms] = np.arange(len(storms))
+    flatind = np.flatnonzero(stormlut[labels] >= 0)
+    flatind = flatind[np.argsort(stormlut[labels[flatind]], kind='stable')]
+    pixstorm = stormlut[labels[flatind]]
+    if np.size(flatind) == 0:
+        return QuvL, AdvectedStorms
+
+    # Mean displacement of each storm
+    present, starts, area = np.unique(pixstorm, return_index=True, return_counts=True)
+    dx = np.zeros(len(storms))
+    dy = np.zeros(len(storms))
+    dx[present] = np.add.reduceat(np.ravel(newumat)[flatind].astype(float), starts) / area
+    dy[present] = np.add.reduceat(np.ravel(newvmat)[flatind].astype(float), starts) / area
+    # If no storm movement, new label positions are same as old label positions for considered storm
+    fixed = (dx == 0.0) & (dy == 0.0)
+
+    newxind = flatind // ncols + np.around(dy).astype(np.intp)[pixstorm]
+    newyind = flatind % ncols + np.around(dx).astype(np.intp)[pixstorm]
+    # If exceeds spatial domain boundaries, do nothing
+    inside = (newxind >= 0) & (newxind < nrows) & (newyind >= 0) & (newyind < ncols)
+    newind = (newxind * ncols + newyind)[inside]
+    pixstorm = pixstorm[inside]
+
+    if backend == 'numba':
+        # One pass over the pixels in storm order, with the same rules as below
+        newdist = (np.ravel(xmat)[newind] - centroidx[pixstorm]) ** 2 + \
+                  (np.ravel(ymat)[newind] - centroidy[pixstorm]) ** 2
+        owner = kernels.advect_owners(newind, pixstorm, newdist, fixed, nrows * ncols)
+        newind = np.flatnonzero(owner >= 0)
+        pixstorm = owner[newind]
+    else:
+        # A storm without movement overwrites any storm earlier in the list,
+        # so only the last such storm and the storms after it compete for a pixel
+        pixfixed = fixed[pixstorm]
+        lastfixed = np.full(nrows * ncols, -1, dtype=np.intp)
+        np.maximum.at(lastfixed, newind[pixfixed], pixstorm[pixfixed])
+        compete = pixstorm >= lastfixed[newind]
+        newind = newind[compete]
+        pixstorm = pixstorm[compete]
+        # Label position with the storm that is closer, the first storm in the list wins equal distances
+        newdist = (np.ravel(xmat)[newind] - centroidx[pixstorm]) ** 2 + \
+                  (np.ravel(ymat)[newind] - centroidy[pixstorm]) ** 2
+        order = np.lexsort((pixstorm, newdist, newind))
+        newind = newind[order]
+        pixstorm = pixstorm[order]
+        first = np.concatenate(([True], newind[1:] != newind[:-1]))
+        newind = newind[first]
+        pixstorm = pixstorm[first]
+    QuvL.flat[newind] = storms[pixstorm]
+
+    # Centroid and area of each advected storm, from its pixels in raster order
+    order = np.lexsort((newind, pixstorm))
+    newind = newind[order]
+    present, starts, area = np.unique(pixstorm[order], return_index=True, return_counts=True)
+    AdvectedStorms[present, 0] = np.add.reduceat(np.ravel(xmat)[newind].astype(float), starts) / area
+    AdvectedStorms[present, 1] = np.add.reduceat(np.ravel(ymat)[newind].astype(float), starts) / area
+    AdvectedStorms[present, 2] = area
+
+    return QuvL, AdvectedStorms
+
+
+###################################################
+# overlap_matrix COUNTS THE GRID POINTS SHARED BY EACH PAIR OF
+# ADVECTED OLD STORM AND NEW STORM IN ONE PASS OVER THE GRID
+###################################################
+
+def overlap_matrix(QuvL, StormLabels, numold, numnew):
+    """
+    Sparse contingency matrix of overlapping grid points between advected old labels and new labels.
+    Only pairs that actually overlap are stored, so the matching cost scales with the number of overlapping pairs.
+    :param QuvL: Old storm labels advected onto the new grid
+    :type QuvL: ndarray
+    :param StormLabels: New storm labels
+    :type StormLabels: ndarray
+    :param numold: Largest old storm label
+    :type numold: int
+    :param numnew: Largest new storm label
+    :type numnew: int
+    :return: Matrix of shape (numold + 1, numnew + 1), element [q, jj] is the number of grid points
+    where old storm q overlaps new storm jj
+    :rtype: scipy.sparse.csc_matrix
+    """
+    lapmask = (StormLabels > 0) & (QuvL > 0)
+    codes = QuvL[lapmask].astype(np.int64) * (numnew + 1) + StormLabels[lapmask].astype(np.int64)
+    codes, counts = np.unique(codes, return_counts=True)
+    overlap = sparse.csc_matrix((counts, (codes // (numnew + 1), codes % (numnew + 1))),
+                                shape=(numold + 1, numnew + 1))
+    overlap.sort_indices()
+    return overlap
+
+
+###################################################
+# match_storms_compiled MATCHES NEW STORMS WITH ADVECTED OLD STORMS, CLEANS UP
+# ACCRETED IDS AND SPLITS STORMS SHARING AN ID WITH THE COMPILED LOOPS OF kernels
+# (backend='numba' of track_storms). The candidate old storms of every new storm
+# are collected first, from the overlap matrix or from the halo of orphan storms.
+###################################################
+
+def match_storms_compiled(StormData, OldStormData, overlap, QuvL, qarea, AdvectedStorms, xmat, ymat, halosq,
+                          lapthresh, misval, newwas, stats):
+    """
+    The matching, sanity check and splitting stages of track_storms with compiled loops, StormData is updated
+    in place with the same result.
+    :param StormData: New storms
+    :type StormData: StormTable
+    :param OldStormData: Old storms
+    :type OldStormData: StormTable
+    :param overlap: Overlap matrix of advected old storms and new storms (see overlap_matrix)
+    :type overlap: scipy.sparse.csc_matrix
+    :param QuvL: Old storm labels advected onto the new grid
+    :type QuvL: ndarray
+    :param qarea: Area of each advected old storm by label, 1 for storms advected out of the grid
+    :type qarea: ndarray
+    :param AdvectedStorms: Centroid x, centroid y and area of each advected old storm
+    :type AdvectedStorms: ndarray
+    :param xmat: meshgrid of x-coordinates, monotonic along the rows
+    :type xmat: ndarray
+    :param ymat: meshgrid of y-coordinates, monotonic along the columns
+    :type ymat: ndarray
+    :param halosq: Square of radius of halo in pixels to look for orphaned objects
+    :type halosq: float
+    :param lapthresh: Minimum overlap fraction
+    :type lapthresh: float
+    :param misval: Preferred value to used for missing values.
+    :type misval: int
+    :param newwas: Next new storm id
+    :type newwas: int
+    :param stats: Collects stage times and counts (see track_storms)
+    :type stats: stats.FrameStats
+    :return: Next new storm id
+    :rtype: int
+    """
+    numstorms = len(StormData)
+    centroidx = StormData.centroidx
+    centroidy = StormData.centroidy
+
+    # Candidates from the overlap matrix, column ns + 1 holds the old storms overlapping storm ns
+    col = np.repeat(np.arange(numstorms), np.diff(overlap.indptr[1:]))
+    candq = overlap.indices[overlap.indptr[1]:].astype(np.int64) - 1
+    candsect = overlap.data[overlap.indptr[1]:].astype(np.int64)
+    candhist = candsect / StormData.area[col].astype(float) + candsect / qarea[candq + 1]
+    maxhist = np.zeros(numstorms)
+    np.maximum.at(maxhist, col, candhist)
+
+    # Candidates of orphan storms are the advected old storm pixels within their halo
+    orphans = np.flatnonzero(maxhist < lapthresh)
+    stats.count('orphans', np.size(orphans))
+    keep = maxhist[col] >= lapthresh
+    col, candq, candsect, candhist = [col[keep]], [candq[keep]], [candsect[keep]], [candhist[keep]]
+    if np.size(orphans) > 0:
+        # (orphan storm, advected old storm label) of the pixels within the halo, counted for each pair
+        pairstorm, pairlabel = kernels.halo_search(QuvL, xmat, ymat, centroidx, centroidy, orphans, halosq)
+        numold = np.size(qarea)
+        codes, qcount = np.unique(pairstorm * numold + pairlabel, return_counts=True)
+        ns, qind = codes // numold, codes % numold - 1
+        # Overlapping grid points of the halo storms and the orphan storm itself, usually none
+        lapcodes = np.repeat(np.arange(np.size(overlap.indptr) - 1), np.diff(overlap.indptr)) * numold + \
+                   overlap.indices
+        pos = np.minimum(np.searchsorted(lapcodes, (ns + 1) * numold + qind + 1), max(np.size(lapcodes) - 1, 0))
+        sect = np.zeros(np.size(ns), dtype=np.int64)
+        if np.size(lapcodes) > 0:
+            sect = np.where(lapcodes[pos] == (ns + 1) * numold + qind + 1, overlap.data[pos], 0).astype(np.int64)
+        col.append(ns)
+        candq.append(qind)
+        candsect.append(sect)
+        candhist.append(qcount / StormData.area[ns].astype(float) + qcount / qarea[qind + 1])
+    col = np.concatenate(col)
+    order = np.argsort(col, kind='stable')
+    candptr = np.concatenate(([0], np.cumsum(np.bincount(col, minlength=numstorms))))
+    candq, candsect, candhist = [np.concatenate(cand)[order] for cand in [candq, candsect, candhist]]
+
+    was, life, wasdist, accstorm, accvalue, newwas, new_storms, merges = kernels.match_storms(
+        candptr, candq, candhist, candsect, AdvectedStorms[:, 0].copy(), AdvectedStorms[:, 1].copy(), centroidx,
+        centroidy, lapthresh, OldStormData.was.astype(np.int64), OldStormData.life.astype(np.int64), newwas, misval)
+    StormData.was[:] = was
+    StormData.life[:] = life
+    StormData.wasdist[:] = wasdist
+    stats.count('new_storms', new_storms)
+    stats.count('merges', merges)
+    stats.lap('matching')
+
+    # Accreted ids that are ids of storms are removed
+    if np.size(accstorm) > 0:
+        accreted, counts = np.unique(accstorm, return_counts=True)
+        accptr, accvalue = kernels.clean_accreted(np.concatenate(([0], np.cumsum(counts))), accvalue,
+                                                  np.unique(StormData.was).astype(np.int64), misval)
+        StormData.set_lineage('accreted', {ns: accvalue[accptr[kk]:accptr[kk + 1]].tolist()
+                                           for kk, ns in enumerate(accreted.tolist())})
+
+    # Groups of storms sharing an id, in order of their first storm
+    order = np.argsort(StormData.was, kind='stable')
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(StormData.was[order])) + 1))
+    sizes = np.diff(np.concatenate((starts, [numstorms])))
+    starts, sizes = starts[sizes > 1], sizes[sizes > 1]
+    first = np.argsort(order[starts])
+    starts, sizes = starts[first], sizes[first]
+    groupptr = np.concatenate(([0], np.cumsum(sizes)))
+    if np.size(sizes) > 0:
+        members = order[np.repeat(starts - groupptr[:-1], sizes) + np.arange(groupptr[-1])]
+        stats.count('splits', np.size(members) - np.size(sizes))
+        was, wasdist, life, child = [getattr(StormData, name).astype(np.int64)
+                                     for name in ['was', 'wasdist', 'life', 'child']]
+        parents, children, newwas = kernels.split_storms(was, wasdist, life, child, groupptr, members, newwas,
+                                                         misval)
+        StormData.was[:], StormData.wasdist[:], StormData.life[:], StormData.child[:] = was, wasdist, life, child
+        childptr = np.concatenate(([0], np.cumsum(sizes - 1)))
+        StormData.set_lineage('parent', {ns: children[childptr[kk]:childptr[kk + 1]].tolist()
+                                         for kk, ns in enumerate(parents.tolist())})
+    stats.lap('split_merge')
+    return newwas
 
 
 ###################################################################
@@ -231,11 +890,17 @@ def track_storms(OldStormData,
                  write_file_ID,
                  flagplot,
                  rarray=[],
-                 azarray=[]):
+                 azarray=[],
+                 spectra=None,
+                 radar=None,
+                 stats=None,
+                 plan=None,
+                 dtype=float,
+                 backend='numpy'):
     """
 
-    :param OldStormData:
-    :type OldStormData: list
+    :param OldStormData: Storms of the previous timestep (a list of StormS objects is converted)
+    :type OldStormData: StormTable
     :param var: Variable in a 2D grid used for tracking
     :type var: array-like
     :param newwas: Usually initialised at 1
@@ -287,8 +952,25 @@ def track_storms(OldStormData,
     :type rarray: ndarray
     :param azarray: Radar azimuths
     :type azarray: ndarray
+    :param spectra: Cache of square spectra, updated in place. On input it holds the spectra of the newbt squares
+    of the previous call, which are reused for the oldbt squares of this call, so oldbt must be the previous newbt.
+    On output it holds the spectra of the newbt squares of this call. Clear it when the tracking is re-initialised.
+    :type spectra: dict
+    :param radar: Radar geometry of the grid (see RadarGeometry), used instead of rarray and azarray
+    :type radar: RadarGeometry
+    :param stats: Collects the time of each tracking stage and counts of storms, squares, orphans, splits and merges
+    :type stats: stats.FrameStats
+    :param plan: Geometry precomputed for xmat, ymat and squarehalf (the displacement grid, the interpolation
+    weights and the radar geometry), used instead of building it in every call
+    :type plan: Tracker
+    :param dtype: Floating point type of the square spectra, correlations and displacement fields,
+    np.float32 halves their memory (see Tracker)
+    :type dtype: type
+    :param backend: 'numpy', or 'numba' for the compiled loops of kernels (advection, matching, splitting),
+    which give the same result. Requires numba, see kernels.resolve_backend.
+    :type backend: str
     :return:
-    StormData, list of StormS objects
+    StormData, StormTable of the storms
     newwas,
     StormLabels,
     newumat,
@@ -312,389 +994,506 @@ def track_storms(OldStormData,
     wasarray = 0 * StormLabels  # set up array of zeros.
     lifearray = 0 * StormLabels
     numstorms = StormLabels.max()
-    print('numstorms = ', numstorms)
-    StormData = []
+    if stats is None:
+        stats = FrameStats(enabled=False)
+    stats.mark()
+    stats.count('numstorms', numstorms)
+    stats.count('numold', len(OldStormData))
+
+    # Spectra of the previous newbt squares, keyed by (corx, cory, square length, window, grid shape, type)
+    previous_spectra = {}
+    if spectra is not None:
+        previous_spectra = dict(spectra)
+        spectra.clear()
+    StormData = StormTable(0, misval, extra_thresh=extra_thresh, doradar=doradar)
+    if plan is not None and radar is None:
+        radar = plan.radar
 
     # Case where there is no old storm data in the previous timestep
     if len(OldStormData) == 0:
-        waslabels = []
-        for ns in range(numstorms):
-            jj = ns + 1  # First storm is labelled 1, but python indices start at 0.
-            C = np.where(StormLabels == jj)
-            StormData += [
-                StormS(jj, StormLabels, var, xmat, ymat, newwas, 0, 0, num_dt, misval, doradar, under_threshold,
-                       extra_thresh=extra_thresh, storm_history=False, string=None, rarray=rarray, azarray=azarray)]
-            wasarray[C] = newwas
-            newwas = newwas + 1
-            lifearray[C] = 1
-            waslabels.append(StormData[ns].was)
+        properties = storm_properties(StormLabels, var, xmat, ymat, under_threshold, extra_thresh=extra_thresh)
+        StormData = new_storm_table(properties, StormLabels, xmat, ymat, misval, doradar, extra_thresh, rarray,
+                                    azarray, radar=radar)
+        # First storm is labelled 1 and gets the first new id
+        StormData.was = np.arange(newwas, newwas + numstorms)
+        # No displacement without a previous image, written as integers (dx=0 dy=0) like StormS does
+        StormData.dx = np.zeros(numstorms, dtype=int)
+        StormData.dy = np.zeros(numstorms, dtype=int)
+        newwas = newwas + numstorms
+        stats.count('new_storms', numstorms)
+        stats.lap('properties')
 
     # Case where there are OldStormLabels and current StormLabels
     # AND UPDATE UVLABEL IN OldStormData ACCORDINGLY
     # Estimate velocities using squares within domain
     elif np.max(OldStormLabels) > 0 and np.max(StormLabels) > 0:
+        if not isinstance(OldStormData, StormTable):
+            OldStormData = StormTable.from_storms(OldStormData, misval, extra_thresh=extra_thresh, doradar=doradar)
         # Initialise smaller grid box separated by squarehalf
-        xint, yint = np.meshgrid(range(xmat[0, 0] + squarehalf, xmat[0, -1], squarehalf),
-                                 range(ymat[0, 0] + squarehalf, ymat[-1, 0], squarehalf))
-        buu = np.full(xint.shape, np.NaN)
-        bvv = np.full(xint.shape, np.NaN)
-        bww = np.full(xint.shape, np.NaN)
-        for corx in range(0, int(np.size(xint, 0))):
-            if flagplot:
+        if plan is None:
+            xint, yint = np.meshgrid(range(xmat[0, 0] + squarehalf, xmat[0, -1], squarehalf),
+                                     range(ymat[0, 0] + squarehalf, ymat[-1, 0], squarehalf))
+        else:
+            xint, yint = plan.xint, plan.yint
+        buu = np.full(xint.shape, np.nan)
+        bvv = np.full(xint.shape, np.nan)
+        bww = np.full(xint.shape, np.nan)
+
+        # Storm mask fields within all smaller grid boxes, as views of shape (corx, cory, 2 * squarehalf, 2 * squarehalf)
+        oldsquares = sliding_window_view(oldbt, (2 * squarehalf, 2 * squarehalf))[
+                     ::squarehalf, ::squarehalf][:np.size(xint, 0), :np.size(xint, 1)]
+        newsquares = sliding_window_view(newbt, (2 * squarehalf, 2 * squarehalf))[
+                     ::squarehalf, ::squarehalf][:np.size(xint, 0), :np.size(xint, 1)]
+
+        # If there are too few storms, don't try to derive motion vectors.
+        newpass = np.sum(newsquares, axis=(2, 3)) >= fftpixels
+        corx, cory = np.nonzero((np.sum(oldsquares, axis=(2, 3)) >= fftpixels) & newpass)
+        squareshape = (2 * squarehalf, 2 * squarehalf)
+        stats.count('squares_correlated', np.size(corx))
+        stats.count('squares_rejected', np.size(newpass) - np.size(corx))
+
+        # Spectra of new squares. When caching, also transform the squares that only pass in the new mask,
+        # they will be needed as old squares in the next call
+        if spectra is None:
+            newcorx, newcory = corx, cory
+        else:
+            newcorx, newcory = np.nonzero(newpass)
+        newspec, newenergy = tile_spectra(newsquares[newcorx, newcory], tukey_window, dtype=dtype)
+        newpos = np.full(newpass.shape, -1)
+        newpos[newcorx, newcory] = np.arange(np.size(newcorx))
+        spec2 = newspec[newpos[corx, cory]]
+        energy2 = newenergy[newpos[corx, cory]]
+        if spectra is not None:
+            for kk in range(np.size(newcorx)):
+                spectra[(newcorx[kk], newcory[kk], squareshape, tukey_window, np.shape(newbt),
+                         np.dtype(dtype))] = (newspec[kk], newenergy[kk])
+
+        # Spectra of old squares, reused from the previous call where available
+        spec1 = np.empty_like(spec2)
+        energy1 = np.empty_like(energy2)
+        cached = np.zeros(np.size(corx), dtype=bool)
+        for kk in range(np.size(corx)):
+            key = (corx[kk], cory[kk], squareshape, tukey_window, np.shape(oldbt), np.dtype(dtype))
+            if key in previous_spectra:
+                spec1[kk], energy1[kk] = previous_spectra[key]
+                cached[kk] = True
+        spec1[~cached], energy1[~cached] = tile_spectra(oldsquares[corx[~cached], cory[~cached]], tukey_window,
+                                                        dtype=dtype)
+        stats.count('spectra_reused', np.count_nonzero(cached))
+
+        # Correlate all remaining squares at once
+        result = correlate_spectra(spec1, energy1, spec2, energy2, squareshape, return_corr=flagplot)
+        buu[corx, cory] = result[0]
+        bvv[corx, cory] = result[1]  # indices are upside down so need minus to get real-world dy-velocity
+        bww[corx, cory] = result[2]
+        stats.lap('motion_fft')
+
+        if flagplot:
+            for ncor in range(0, int(np.size(xint, 0))):
                 nij = -3
                 # fig, axs =
                 # plt.subplots(np.size(xint,1),3, figsize=(6,2*np.size(xint,1)), facecolor='w', edgecolor='k')
                 fig, axs = plt.subplots(int(0.5 * np.size(xint, 1)) + 1, 6, figsize=(6, np.size(xint, 1)),
                                         facecolor='w', edgecolor='k')
                 axs = axs.ravel()
-            for cory in range(0, int(np.size(xint, 1))):
-                if flagplot:
-                    nij += 3
-
-                # Extract storm mask fields within smaller grid box
-                oldsquare = oldbt[
-                            squarehalf * corx:squarehalf * corx + 2 * squarehalf,
-                            squarehalf * cory:squarehalf * cory + 2 * squarehalf]
-                newsquare = newbt[
-                            squarehalf * corx:squarehalf * corx + 2 * squarehalf,
-                            squarehalf * cory:squarehalf * cory + 2 * squarehalf]
-
-                # If there are too few storms, don't try to derive motion vectors.
-                if np.sum(oldsquare) < fftpixels or np.sum(newsquare) < fftpixels:
-                    buu[corx, cory] = np.NaN
-                    bvv[corx, cory] = np.NaN
-                    bww[corx, cory] = np.NaN
-                else:
-                    dx, dy, amplitude, corrval = ffttrack(oldsquare, newsquare, tukey_window)
-                    buu[corx, cory] = dx
-                    bvv[corx, cory] = dy  # indices are upside down so need minus to get real-world dy-velocity
-                    bww[corx, cory] = amplitude
-                    if flagplot:
-                        axs[nij].pcolormesh(oldsquare)
-                        axs[nij].set_title(str(int(np.sum(oldsquare))))
-                        axs[nij + 1].pcolormesh(newsquare)
-                        axs[nij + 1].set_title(str(int(np.sum(newsquare))))
-                        axs[nij + 2].pcolormesh(corrval)
-                        axs[nij + 2].set_title('(' + str(dx) + ',' + str(dy) + ')')
-            if flagplot:
-                plt.savefig(IMAGES_DIR + 'Correlations_' + write_file_ID + '_' + str(corx) + '.png')
+                for kk in np.flatnonzero(corx == ncor):
+                    nij = 3 * cory[kk]
+                    axs[nij].pcolormesh(oldsquares[ncor, cory[kk]])
+                    axs[nij].set_title(str(int(np.sum(oldsquares[ncor, cory[kk]]))))
+                    axs[nij + 1].pcolormesh(newsquares[ncor, cory[kk]])
+                    axs[nij + 1].set_title(str(int(np.sum(newsquares[ncor, cory[kk]]))))
+                    axs[nij + 2].pcolormesh(result[3][kk])
+                    axs[nij + 2].set_title('(' + str(result[0][kk]) + ',' + str(result[1][kk]) + ')')
+                plt.savefig(IMAGES_DIR + 'Correlations_' + write_file_ID + '_' + str(ncor) + '.png')
                 plt.close()
+            stats.lap('correlation_plots')
 
         # CHECK NEIGHBOURING VALUES FOR SMOOTHNESS
-        # Ignore warnings about mean over empty array in this section
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=RuntimeWarning)
-            for corx in range(0, int(np.size(xint, 0))):
-                for cory in range(0, int(np.size(xint, 1))):
-                    bu_nb = np.nan
-                    bv_nb = np.nan
-                    # Do nothing if displacement vector is nan
-                    if np.isnan(buu[corx, cory]) and np.isnan(bvv[corx, cory]):
-                        continue
-
-                    # Calculate mean of adjacent displacement vectors
-                    # Top edge
-                    if corx == 0:
-                        # Top left corner
-                        if cory == 0:
-                            bu_nb = np.nanmean([buu[0, 1], buu[1, 0], buu[1, 1]])
-                            bv_nb = np.nanmean([bvv[0, 1], bvv[1, 0], bvv[1, 1]])
-                        # Top right corner
-                        elif cory == int(np.size(xint, 1)) - 1:
-                            bu_nb = np.nanmean([buu[0, cory - 1], buu[1, cory], buu[1, cory - 1]])
-                            bv_nb = np.nanmean([bvv[0, cory - 1], bvv[1, cory], bvv[1, cory - 1]])
-                        else:
-                            bu_nb = np.nanmean(
-                                [buu[0, cory + 1], buu[0, cory - 1], buu[1, cory - 1], buu[1, cory], buu[1, cory + 1]])
-                            bv_nb = np.nanmean(
-                                [bvv[0, cory + 1], bvv[0, cory - 1], bvv[1, cory - 1], bvv[1, cory], bvv[1, cory + 1]])
-                    # Bottom edge
-                    elif corx == int(np.size(xint, 0)) - 1:
-                        # Bottom left corner
-                        if cory == 0:
-                            bu_nb = np.nanmean([buu[corx, 1], buu[corx - 1, 0], buu[corx - 1, 1]])
-                            bv_nb = np.nanmean([bvv[corx, 1], bvv[corx - 1, 0], bvv[corx - 1, 1]])
-                        # Bottom right corner
-                        elif cory == int(np.size(xint, 1)) - 1:
-                            bu_nb = np.nanmean([buu[corx, cory - 1], buu[corx - 1, cory], buu[corx - 1, cory - 1]])
-                            bv_nb = np.nanmean([bvv[corx, cory - 1], bvv[corx - 1, cory], bvv[corx - 1, cory - 1]])
-                        else:
-                            bu_nb = np.nanmean(
-                                [buu[corx, cory + 1], buu[corx, cory - 1], buu[corx - 1, cory - 1], buu[corx - 1, cory],
-                                 buu[corx - 1, cory + 1]])
-                            bv_nb = np.nanmean(
-                                [bvv[corx, cory + 1], bvv[corx, cory - 1], bvv[corx - 1, cory - 1], bvv[corx - 1, cory],
-                                 bvv[corx - 1, cory + 1]])
-                    # Right edge
-                    elif cory == int(np.size(xint, 1)) - 1:
-                        bu_nb = np.nanmean(
-                            [buu[corx, cory - 1], buu[corx - 1, cory], buu[corx - 1, cory - 1], buu[corx + 1, cory - 1],
-                             buu[corx + 1, cory]])
-                        bv_nb = np.nanmean(
-                            [bvv[corx, cory - 1], bvv[corx - 1, cory], bvv[corx - 1, cory - 1], bvv[corx + 1, cory - 1],
-                             bvv[corx + 1, cory]])
-                    # TODO: How about the left edge?
-                    # Everything else
-                    else:
-                        bu_nb = np.nanmean(
-                            [buu[corx, cory + 1], buu[corx, cory - 1], buu[corx - 1, cory - 1], buu[corx - 1, cory],
-                             buu[corx - 1, cory + 1], buu[corx + 1, cory - 1], buu[corx + 1, cory],
-                             buu[corx + 1, cory + 1]])
-                        bv_nb = np.nanmean(
-                            [bvv[corx, cory + 1], bvv[corx, cory - 1], bvv[corx - 1, cory - 1], bvv[corx - 1, cory],
-                             bvv[corx - 1, cory + 1], bvv[corx + 1, cory - 1], bvv[corx + 1, cory],
-                             bvv[corx + 1, cory + 1]])
-                    # Set to nan if displacement vector exceeds mean of adjacent displacement vector magnitude
-                    if np.abs(buu[corx, cory] - bu_nb) > dd_tolerance * num_dt:
-                        buu[corx, cory] = np.nan
-                    if np.abs(bvv[corx, cory] - bv_nb) > dd_tolerance * num_dt:
-                        bvv[corx, cory] = np.nan
+        # Calculate mean of adjacent displacement vectors, edges and corners only have fewer neighbours.
+        # All vectors are compared with the neighbouring vectors before any of them are removed.
+        bu_nb = neighbour_mean(buu)
+        bv_nb = neighbour_mean(bvv)
+        # Set to nan if displacement vector exceeds mean of adjacent displacement vector magnitude
+        urejected = np.abs(buu - bu_nb) > dd_tolerance * num_dt
+        vrejected = np.abs(bvv - bv_nb) > dd_tolerance * num_dt
+        buu[urejected] = np.nan
+        bvv[vrejected] = np.nan
+        stats.count('vectors_rejected', np.count_nonzero(urejected | vrejected))
+        stats.lap('smoothing')
 
         # ACTUAL DISPLACEMENT
         # Interpolate these displacements from displaced grid (xint, yint) onto the original grid (xmat, ymat)
-        newumat = interpolate_speeds(xint, yint, xmat, ymat, buu)
-        newvmat = interpolate_speeds(xint, yint, xmat, ymat, bvv)
+        newumat, newvmat = interpolate_speeds(xint, yint, xmat, ymat, buu, bvv,
+                                              weights=None if plan is None else plan.weights, dtype=dtype)
+        stats.lap('interpolation')
 
         # Assign displacement to each of the old storms.
-        newlabel = np.zeros(OldStormLabels.shape)
-        for ns in range(len(OldStormData)):
-            jj = OldStormData[ns].storm
-            labelind = np.where(OldStormLabels == jj)
-            dx = np.mean(newumat[labelind])
-            dy = np.mean(newvmat[labelind])
-            # If no storm movement, new label positions are same as old label positions for considered storm
-            if dx == 0.0 and dy == 0.0:
-                newlabel[labelind] = jj
-            else:
-                for ii in range(np.size(labelind, 1)):
-                    newyind = labelind[1][ii] + int(np.around(dx))
-                    newxind = labelind[0][ii] + int(np.around(dy))
-                    # If exceeds spatial domain boundaries, do nothing
-                    if newxind > np.size(newlabel, 0) - 1 \
-                            or newyind > np.size(newlabel, 1) - 1 or newxind < 0 or newyind < 0:
-                        continue
-                    # If new label position has already been occupied by a storm,
-                    # label position with the storm that is closer
-                    elif newlabel[newxind, newyind] > 0:
-                        nq = int(newlabel[newxind, newyind] - 1)
-                        olddist = (xmat[newxind, newyind] - OldStormData[nq].centroidx) ** 2 + (
-                                ymat[newxind, newyind] - OldStormData[nq].centroidy) ** 2
-                        newdist = (xmat[newxind, newyind] - OldStormData[ns].centroidx) ** 2 + (
-                                ymat[newxind, newyind] - OldStormData[ns].centroidy) ** 2
-                        if newdist < olddist:
-                            newlabel[newxind, newyind] = jj
-                    # Else, label with new storm position
-                    else:
-                        newlabel[newxind, newyind] = jj
-
         # Store temporary new labels and tabulate new storm data (Centroid location, size)
-        QuvL = newlabel
-        AdvectedStorms = np.zeros([len(OldStormData), 3])
-        for ns in range(len(OldStormData)):
-            jj = OldStormData[ns].storm
-            centrind = np.where(QuvL == jj)
-            if np.size(centrind, 1) == 0:
-                continue
-            else:
-                AdvectedStorms[ns][0] = np.mean(xmat[centrind])
-                AdvectedStorms[ns][1] = np.mean(ymat[centrind])
-                AdvectedStorms[ns][2] = int(np.size(centrind, 1))
+        QuvL, AdvectedStorms = advect_storms(OldStormData, OldStormLabels, newumat, newvmat, xmat, ymat,
+                                             backend=backend)
+        stats.lap('advection')
 
         ###################################################
         # NOW LOOP THROUGH StormData AND CHECK FOR OVERLAP WITH
         # ADVECTED OldStormData STORMS
         ###################################################
-        wasnum = np.zeros(len(StormData))
-        qbins = range(int(np.max(OldStormLabels)) + 2)
+        # Populate advected old storm area
         qarea = np.ones([int(np.max(OldStormLabels)) + 1])
-        qlife = np.ones([int(np.max(OldStormLabels)) + 1])
-        # Populate new storm area and life data
-        for qq in range(len(OldStormData)):
-            if AdvectedStorms[qq, 2] > 0:
-                qarea[qq + 1] = AdvectedStorms[qq, 2]
-            qlife[qq + 1] = OldStormData[qq].life
-
-        # Update StormData object list with new storms!
-        for ns in range(numstorms):
-            jj = ns + 1  # first storm is labelled 1, but python indeces start at 0.
-            C = np.where(StormLabels == jj)
-            StormData += [StormS(jj, StormLabels, var, xmat, ymat, newwas, newumat, newvmat, num_dt, misval, doradar,
-                                 under_threshold, extra_thresh=extra_thresh, storm_history=True, string=None,
-                                 rarray=rarray, azarray=azarray)]
-            wasarray[C] = int(jj)
-            lifearray[C] = 1
+        advected = np.flatnonzero(AdvectedStorms[:, 2] > 0)
+        qarea[advected + 1] = AdvectedStorms[advected, 2]
 
-            ###################################################
-            # CHECK OVERLAP WITH QHIST
-            # IF NO OVERLAP, THEN
-            # GENERATE (halo) km RADIUS AROUND CENTROID
-            # CHECK FOR OVERLAP WITHIN (halo) km OF CENTROID
-            ###################################################
-            qhist = (np.histogram(QuvL[np.where(StormLabels == jj)], qbins))[0][:] / float(StormData[ns].area) + \
-                    (np.histogram(QuvL[np.where(StormLabels == jj)], qbins))[0][:] / qarea[:]
-            # if nt==35 and jj==131:
-            #   raise ValueError("Check storm 131 (or 120)")
-
-            # Overlap less than threshold, so we use halo to check overlap
-            if np.max(qhist[1:]) < lapthresh:
-                newblob = 0 * xmat
-                blobind = np.where(
-                    (xmat - StormData[ns].centroidx) ** 2 + (ymat - StormData[ns].centroidy) ** 2 < halosq)
-                newblob[blobind] = newblob[blobind] + 1
-                qhist = (np.histogram(QuvL[np.where(newblob == 1)], qbins))[0][:] / float(StormData[ns].area) + \
-                        (np.histogram(QuvL[np.where(newblob == 1)], qbins))[0][:] / qarea[:]
-            ###################################################
-            # IF OVERLAP, THEN
-            # - INHERIT "WAS"
-            # - UPDATE "LIFE" AND "TRACK" AND "WASDIST"
-            # - INHERIT "dx" AND "dy" (ONLY UPDATE IF SINGLE OVERLAP)
-            ###################################################
-            if np.max(qhist[1:]) >= lapthresh:
-                numlaps = np.where(qhist[1:] >= lapthresh)
+        # Overlapping grid points of all (advected old storm, new storm) pairs
+        overlap = overlap_matrix(QuvL, StormLabels, int(np.max(OldStormLabels)), numstorms)
+        # Advected old storm pixels, indexed by a k-d tree when the halo of an orphan storm is first needed
+        haloind = np.flatnonzero(QuvL)
+        halotree = None
+        stats.lap('overlap')
+
+        # Update StormData table with new storms!
+        properties = storm_properties(StormLabels, var, xmat, ymat, under_threshold, newumat=newumat, newvmat=newvmat,
+                                      num_dt=num_dt, extra_thresh=extra_thresh)
+        StormData = new_storm_table(properties, StormLabels, xmat, ymat, misval, doradar, extra_thresh, rarray,
+                                    azarray, radar=radar)
+        centroidx = StormData.centroidx
+        centroidy = StormData.centroidy
+        stats.lap('properties')
+        if backend == 'numba':
+            newwas = match_storms_compiled(StormData, OldStormData, overlap, QuvL, qarea, AdvectedStorms, xmat,
+                                           ymat, halosq, lapthresh, misval, newwas, stats)
+        else:
+            # Accreted old storm ids of storms with multiple overlaps, by storm index
+            accreted = {}
+            for ns in range(numstorms):
+                jj = ns + 1  # first storm is labelled 1, but python indeces start at 0.
+
+                ###################################################
+                # CHECK OVERLAP WITH QHIST
+                # IF NO OVERLAP, THEN
+                # GENERATE (halo) km RADIUS AROUND CENTROID
+                # CHECK FOR OVERLAP WITHIN (halo) km OF CENTROID
+                # qind: INDICES OF OLD STORMS OVERLAPPING THIS STORM
+                # qhist: OVERLAP FRACTIONS OF THOSE OLD STORMS
+                ###################################################
+                qcol = slice(overlap.indptr[jj], overlap.indptr[jj + 1])
+                qind = overlap.indices[qcol] - 1
+                qhist = overlap.data[qcol] / float(StormData.area[ns]) + overlap.data[qcol] / qarea[qind + 1]
+
+                # Overlap less than threshold, so we use halo to check overlap
+                if np.max(qhist, initial=0.) < lapthresh:
+                    stats.count('orphans')
+                    if halotree is None:
+                        halotree = spatial.cKDTree(np.column_stack((np.ravel(xmat)[haloind], np.ravel(ymat)[haloind])))
+                    # Advected pixels within the halo. The search radius is widened slightly,
+                    # the exact (strict) halo test is applied to the pixels that are found.
+                    blobind = haloind[np.asarray(halotree.query_ball_point(
+                        [centroidx[ns], centroidy[ns]], np.sqrt(halosq) * (1. + 1e-9)), dtype=np.intp)]
+                    blobind = blobind[(np.ravel(xmat)[blobind] - centroidx[ns]) ** 2 +
+                                      (np.ravel(ymat)[blobind] - centroidy[ns]) ** 2 < halosq]
+                    qind, qcount = np.unique(np.ravel(QuvL)[blobind].astype(np.intp), return_counts=True)
+                    qind = qind - 1
+                    qhist = qcount / float(StormData.area[ns]) + qcount / qarea[qind + 1]
                 ###################################################
-                # IF MORE THAN ONE GOOD OVERLAP
-                # KEEP PROPERTIES OF STORM WITH LARGEST OVERLAP
-                # IF MORE THAN ONE LARGEST, KEEP NEAREST IN CENTROID
+                # IF OVERLAP, THEN
+                # - INHERIT "WAS"
+                # - UPDATE "LIFE" AND "TRACK" AND "WASDIST"
+                # - INHERIT "dx" AND "dy" (ONLY UPDATE IF SINGLE OVERLAP)
                 ###################################################
-                # More than one good overlap
-                if np.size(numlaps, 1) > 1:
-                    lapdist = np.zeros([np.size(numlaps, 1)])
-                    sectlap = np.zeros([np.size(numlaps, 1)])
-                    # Loop over overlaps
-                    for kkind in range(np.size(numlaps, 1)):
-                        qindex = np.squeeze(numlaps[0][kkind])
-                        lapdist[kkind] = np.sqrt((StormData[ns].centroidx - AdvectedStorms[qindex, 0]) ** 2 + (
-                                StormData[ns].centroidy - AdvectedStorms[qindex, 1]) ** 2)
-                        sectlap[kkind] = np.size(np.where((QuvL == qindex + 1) & (StormLabels == jj)), 1)
-                    kmax = np.where(sectlap == np.max(sectlap))
-                    # If equally large overlaps, use overlap distance as metric
-                    if np.size(kmax, 1) > 1:
-                        kkmax = kmax[0][np.where(lapdist[kmax[0][:]] == np.min(lapdist[kmax[0][:]]))]
-                        # If still not left with one cell, choose the first one...
-                        if np.size(kkmax) > 1:
-                            kkmax = kmax[0][kkmax[0]]
+                if np.max(qhist, initial=0.) >= lapthresh:
+                    numlaps = qind[qhist >= lapthresh]
+                    ###################################################
+                    # IF MORE THAN ONE GOOD OVERLAP
+                    # KEEP PROPERTIES OF STORM WITH LARGEST OVERLAP
+                    # IF MORE THAN ONE LARGEST, KEEP NEAREST IN CENTROID
+                    ###################################################
+                    # More than one good overlap
+                    if np.size(numlaps) > 1:
+                        stats.count('merges')
+                        lapdist = np.sqrt((centroidx[ns] - AdvectedStorms[numlaps, 0]) ** 2 + (
+                                centroidy[ns] - AdvectedStorms[numlaps, 1]) ** 2)
+                        sectlap = np.asarray(overlap[numlaps + 1, jj].todense()).ravel()
+                        kmax = np.where(sectlap == np.max(sectlap))
+                        # If equally large overlaps, use overlap distance as metric
+                        if np.size(kmax, 1) > 1:
+                            kkmax = kmax[0][np.where(lapdist[kmax[0][:]] == np.min(lapdist[kmax[0][:]]))]
+                            # If still not left with one cell, choose the first one...
+                            if np.size(kkmax) > 1:
+                                kkmax = kmax[0][kkmax[0]]
+                        else:
+                            kkmax = kmax[0][0]
+                        kindex = int(np.squeeze(numlaps[kkmax]))
+                        # Don't add original storm number into accreted list!
+                        accreted[ns] = [OldStormData.was[allindex] for allindex in numlaps if allindex != kindex]
+                    # Single overlap
                     else:
-                        kkmax = kmax[0][0]
-                    kindex = np.squeeze(numlaps[0][kkmax])
-                    StormData[ns].inherit_properties(jj, OldStormData, kindex, QuvL, StormLabels, qhist, lapthresh,
-                                                     misval, single_overlap=False)
-                    wasarray[C] = OldStormData[kindex].was
-                    lifearray[C] = StormData[ns].life
-                # Single overlap
-                else:
-                    zindex = np.squeeze(numlaps[0][0])
-                    lapdist = np.sqrt((StormData[ns].centroidx - OldStormData[zindex].centroidx) ** 2 + (
-                            StormData[ns].centroidy - OldStormData[zindex].centroidy) ** 2)
-                    StormData[ns].inherit_properties(jj, OldStormData, zindex, QuvL, StormLabels, qhist, lapthresh,
-                                                     misval, single_overlap=True)
-                    wasarray[C] = OldStormData[zindex].was
-                    lifearray[C] = StormData[ns].life
+                        kindex = numlaps[0]
+                    StormData.was[ns] = OldStormData.was[kindex]
+                    StormData.life[ns] = OldStormData.life[kindex] + 1
+                    # TODO: What is wasdist? Number of overlapping gridsquares between advected storm and current storm?
+                    StormData.wasdist[ns] = overlap[kindex + 1, jj]
 
+                ###################################################
+                # IF NO OVERLAP, THEN (NEW STORM)
+                # - "WAS" SET TO CURRENT MAX LABEL +1
+                # - UPDATE "LIFE" AND "TRACK" AND "WASDIST" FOR A NEW STORM
+                ###################################################
+                else:
+                    StormData.was[ns] = newwas
+                    StormData.life[ns] = 1
+                    newwas = newwas + 1
+                    stats.count('new_storms')
+            stats.lap('matching')
+            wasnum = set(StormData.was.tolist())
             ###################################################
-            # IF NO OVERLAP, THEN (NEW STORM)
-            # - "WAS" SET TO CURRENT MAX LABEL +1
-            # - UPDATE "LIFE" AND "TRACK" AND "WASDIST" FOR A NEW STORM
+            # QUICK SANITY CHECK
+            # ACCRETED SHOULD NEVER BE A VALUE
+            # SIMILAR TO EXISTING STORM ID
             ###################################################
-            else:
-                StormData[ns].was = newwas
-                wasarray[C] = newwas
-                StormData[ns].life = 1
-                lifearray[C] = 1
-                newwas = newwas + 1
-        wasnum = np.array([StormData[ns].was for ns in range(len(StormData))])
-        ###################################################
-        # QUICK SANITY CHECK
-        # ACCRETED SHOULD NEVER BE A VALUE
-        # SIMILAR TO EXISTING STORM ID
-        ###################################################
-        for ns in range(len(StormData)):
-            jj = StormData[ns].storm
-            # No need to check if there is no accretion
-            if StormData[ns].accreted[-1] == misval:
-                continue
-            else:
-                for acnum in range(np.size(StormData[ns].accreted)):
-                    acind = np.where((wasnum - StormData[ns].accreted[acnum]) == 0)
+            for ns in accreted:
+                for acnum in range(np.size(accreted[ns])):
                     # Duplicate between accreted storm and existing storm id
-                    if np.size(acind, 1) > 0:
-                        StormData[ns].accreted[acnum] = misval
+                    if accreted[ns][acnum] in wasnum:
+                        accreted[ns][acnum] = misval
                         # TODO: Raise error instead that algorithm is doing something odd?
-                # acnew=np.where(StormData[ns].accreted > misval)
                 # Clean up list by removing misvals
-                acnew = [aci for aci in StormData[ns].accreted if aci > misval]
+                acnew = [aci for aci in accreted[ns] if aci > misval]
                 if np.size(acnew) > 0:
-                    for acindex in range(np.size(acnew)):
-                        # TODO: acnum doesn't change in this for loop, is this correct?
-                        # TODO: Should this be StormData[ns].accreted = acnew
-                        StormData[ns].accreted[acnum] = acnew[acindex]
+                    # TODO: Only the last element is replaced (by the last remaining id), should this be acnew?
+                    accreted[ns][-1] = acnew[-1]
                 else:
-                    StormData[ns].accreted = [misval]
-        ###################################################
-        # TRACKING MERGING BREAKING
-        # MULTIPLE STORMS AT T (StormData) MAY HAVE SAME LABEL "WAS"
-        # FIND STORM WITH LARGEST OVERLAP AT T+1 WITH ADVECTED q(T)
-        # THIS IS THE "PARENT" STORM,
-        # "PARENT" VECTOR WITH INDICES OF NEW LABELS FOR "CHILD" STORMS
-        # STORMS WITH SAME WAS BUT FUTHER FROM CENTROID ARE "CHILD", VALUE "PARENT"
-        ###################################################
-        for ns in range(len(StormData)):
-            jj = StormData[ns].storm
-            # Check if new storm
-            # TODO: Should StormData[ns].wasdist be [misval] or misval?
-            if StormData[ns].wasdist == [misval]:
-                continue
-            wasind = np.where(wasnum == wasnum[ns])
-            wasseplength = 0
-            for kkind in range(np.size(wasind)):
-                if StormData[wasind[0][kkind]].wasdist == [misval]:
-                    continue
-                else:
-                    wasseplength = wasseplength + 1
-            wassep = np.zeros(wasseplength)
-            if np.size(wasind) > 1:
-                kkval = 0
-                for kkind in range(np.size(wasind)):
-                    if StormData[wasind[0][kkind]].wasdist == [misval]:
-                        continue
-                    else:
-                        # TODO: What is wassep? Only the zero-element is populated?
-                        wassep[kkval] = StormData[wasind[0][kkind]].wasdist
-                        kkval = kkval + 1
-            else:
-                wassep = StormData[wasind[0][0]].wasdist
-            ########################################
-            # WASSEP NOW CONTAINS ALL NON-ZERO OVERLAP VALUES
-            # FIND THE MAXIMUM (THIS WILL BE THE PARENT)
-            # ALL OTHER STORMS WILL BE THE CHILDREN
-            #########################################
-            kmax = np.where(wassep == np.max(wassep))
-            kkmax = np.min(kmax)
-            children = []
-            for kkind in range(np.size(wassep)):
-                if not kkind == kkmax:
-                    StormData[wasind[0][kkind]].child = StormData[wasind[0][kkmax]].was
-                    StormData[wasind[0][kkind]].was = newwas
-                    wasarray[np.where(StormLabels == wasind[0][kkind] + 1)] = newwas
-                    StormData[wasind[0][kkind]].life = StormData[wasind[0][kkmax]].life
-                    lifearray[np.where(StormLabels == wasind[0][kkind] + 1)] = StormData[wasind[0][kkmax]].life
-                    newwas = newwas + 1
-                    wasnum[wasind[0][kkind]] = StormData[wasind[0][kkind]].was
-                    children.append(StormData[wasind[0][kkind]].was)
-                    StormData[wasind[0][kkind]].wasdist = misval
+                    accreted[ns] = [misval]
+            StormData.set_lineage('accreted', accreted)
             ###################################################
-            # UPDATE PARENT STORM WITH CHILDREN
+            # TRACKING MERGING BREAKING
+            # MULTIPLE STORMS AT T (StormData) MAY HAVE SAME LABEL "WAS"
+            # FIND STORM WITH LARGEST OVERLAP AT T+1 WITH ADVECTED q(T)
+            # THIS IS THE "PARENT" STORM,
+            # "PARENT" VECTOR WITH INDICES OF NEW LABELS FOR "CHILD" STORMS
+            # STORMS WITH SAME WAS BUT FUTHER FROM CENTROID ARE "CHILD", VALUE "PARENT"
             ###################################################
-            if np.size(children) > 0:
-                StormData[wasind[0][kkmax]].parent = children
+            # Storms sharing a "was" are grouped once. Splitting a group only gives its members new unique ids,
+            # so groups are handled in order of their first storm, as when looping through the storms.
+            # TODO: New storms have wasdist misval but are never skipped, is this correct?
+            order = np.argsort(StormData.was, kind='stable')
+            bounds = np.flatnonzero(np.diff(StormData.was[order])) + 1
+            groups = [group for group in np.split(order, bounds) if np.size(group) > 1]
+            groups.sort(key=lambda group: group[0])
+            parent = {}
+            for wasind in groups:
+                ########################################
+                # WASDIST CONTAINS ALL OVERLAP VALUES
+                # FIND THE MAXIMUM (THIS WILL BE THE PARENT)
+                # ALL OTHER STORMS WILL BE THE CHILDREN
+                #########################################
+                kkmax = wasind[np.argmax(StormData.wasdist[wasind])]
+                stats.count('splits', np.size(wasind) - 1)
+                children = []
+                for kkind in wasind:
+                    if not kkind == kkmax:
+                        StormData.child[kkind] = StormData.was[kkmax]
+                        StormData.was[kkind] = newwas
+                        StormData.life[kkind] = StormData.life[kkmax]
+                        newwas = newwas + 1
+                        children.append(newwas - 1)
+                        StormData.wasdist[kkind] = misval
+                ###################################################
+                # UPDATE PARENT STORM WITH CHILDREN
+                ###################################################
+                parent[kkmax] = children
+            StormData.set_lineage('parent', parent)
+            stats.lap('split_merge')
+
+    # Fill tracked IDs and lifetimes on the grid with lookup tables indexed by storm label
+    if len(StormData) > 0:
+        waslut = np.concatenate(([0], StormData.was))
+        lifelut = np.concatenate(([0], StormData.life))
+        wasarray = waslut.astype(StormLabels.dtype)[StormLabels]
+        lifearray = lifelut.astype(StormLabels.dtype)[StormLabels]
+    stats.lap('grid')
 
     return StormData, newwas, StormLabels, newumat, newvmat, wasarray, lifearray
 
 
+###################################################################
+# Tracker KEEPS THE TRACKING SETTINGS, THE GEOMETRY PRECOMPUTED FOR THE GRID
+# AND THE STORMS OF THE PREVIOUS IMAGE, AND TRACKS ONE IMAGE AT A TIME WITH step
+###################################################################
+
+TrackStep = collections.namedtuple('TrackStep', ['StormData', 'newwas', 'StormLabels', 'newumat', 'newvmat',
+                                                 'wasarray', 'lifearray', 'num_dt'])
+
+
+class Tracker():
+    """Tracks storms through consecutive images. The settings are those of wrapper.py"""
+
+    def __init__(self, xmat, ymat, squarelength=100., rafraction=0.01, dd_tolerance=3., halopixel=5., lapthresh=0.6,
+                 misval=-999, under_threshold=False, dt=5., dt_tolerance=15., timediff=None, doradar=False,
+                 rarray=None, azarray=None, IMAGES_DIR='', flagplot=False, compact=False, backend='numpy'):
+        """
+
+        :param xmat: meshgrid of x-coordinates
+        :type xmat: ndarray
+        :param ymat: meshgrid of y-coordinates
+        :type ymat: ndarray
+        :param squarelength: The size in pixels of individual square regions for which displacement vectors
+        are calculated. Must divide the grid dimensions.
+        :type squarelength: float
+        :param rafraction: The minimum fractional cover of objects required to calculate displacement vectors
+        :type rafraction: float
+        :param dd_tolerance: The maximum difference (in number of pixels) allowed between adjacent displacement vectors
+        :type dd_tolerance: float
+        :param halopixel: Radius of halo in pixels for orphan storms
+        :type halopixel: float
+        :param lapthresh: Minimum overlap fraction required for objects to be considered
+        potentially the same between consecutive images
+        :type lapthresh: float
+        :param misval: Preferred value to used for missing values.
+        :type misval: int
+        :param under_threshold: Is the variable of interest smaller than a threshold
+        :type under_threshold: bool
+        :param dt: Time difference between consecutive images
+        :type dt: float
+        :param dt_tolerance: Maximum separation in time allowed between consecutive images, tracking starts again
+        after a larger separation
+        :type dt_tolerance: float
+        :param timediff: Time difference of two time stamps in the units of dt, given the arguments of both time stamps
+        (e.g. user_functions.timediff with (hour, minute) time stamps). If not given, time stamps are datetimes
+        and their difference is in minutes.
+        :type timediff: callable
+        :param doradar: For calculating radar range and azimuth if real-time tracking with a single site radar
+        :type doradar: bool
+        :param rarray: Radar ranges (see RadarGeometry)
+        :type rarray: ndarray
+        :param azarray: Radar azimuths
+        :type azarray: ndarray
+        :param IMAGES_DIR: Directory to output images from tracking algorithm
+        :type IMAGES_DIR: str
+        :param flagplot: For plotting fft correlations (testing only)
+        :type flagplot: bool
+        :param compact: Calculate the square spectra, correlations and displacement fields in float32 instead of
+        float64. Displacements and tracks agree with float64 up to rounding, see benchmark.compare_compact.
+        :type compact: bool
+        :param backend: 'numpy', 'numba' for the compiled loops of kernels (the same tracks, falls back to numpy if
+        numba is not installed), or 'auto' for numba if it is installed
+        :type backend: str
+        """
+        if np.fmod(np.size(xmat, 0), squarelength) != 0 or np.fmod(np.size(xmat, 1), squarelength) != 0:
+            raise ValueError('Your grid does not match a multiple of squares as defined by squarelength')
+        # The displacement grid, its interpolation weights and the numba halo search need sorted coordinates
+        if np.any(np.diff(xmat[0, :]) <= 0) or np.any(np.diff(ymat[:, 0]) <= 0):
+            raise ValueError('The coordinates xmat[0, :] and ymat[:, 0] must be increasing')
+        self.xmat = xmat
+        self.ymat = ymat
+        self.squarehalf = int(squarelength / 2)
+        self.fftpixels = squarelength ** 2 / int(1. / rafraction)
+        self.dd_tolerance = dd_tolerance
+        self.halosq = halopixel ** 2
+        self.lapthresh = lapthresh
+        self.misval = misval
+        self.under_threshold = under_threshold
+        self.dt = dt
+        self.dt_tolerance = dt_tolerance
+        self.timediff = timediff
+        self.doradar = doradar
+        self.IMAGES_DIR = IMAGES_DIR
+        self.flagplot = flagplot
+        self.dtype = np.float32 if compact else np.float64
+        self.backend = kernels.resolve_backend(backend)
+
+        # Geometry of the grid, the same for every image
+        self.xint, self.yint = np.meshgrid(range(xmat[0, 0] + self.squarehalf, xmat[0, -1], self.squarehalf),
+                                           range(ymat[0, 0] + self.squarehalf, ymat[-1, 0], self.squarehalf))
+        self.weights = (spline_weights(tuple(self.yint[:, 0]), tuple(ymat[:, 0])).astype(self.dtype, copy=False),
+                        spline_weights(tuple(self.xint[0, :]), tuple(xmat[0, :])).astype(self.dtype, copy=False))
+        self.radar = RadarGeometry(xmat, ymat, rarray, azarray) if doradar else None
+        self.reset()
+
+    def reset(self):
+        """Start tracking again, the next image gets new storms with ids from 1"""
+        self.StormData = []
+        self.StormLabels = None
+        self.mask = None
+        self.newwas = 1
+        self.timestamp = None
+        self.spectra = {}
+
+    def restore(self, StormData, StormLabels, newwas, timestamp):
+        """
+        Continue tracking from the storms of an image, e.g. from a checkpoint
+        :param StormData: Storms of the image
+        :type StormData: StormTable
+        :param StormLabels: Storm labels of the image, kept until the next step
+        :type StormLabels: ndarray
+        :param newwas: Next new storm id
+        :type newwas: int
+        :param timestamp: Time stamp of the image (see step)
+        """
+        self.reset()
+        self.StormData = StormData
+        self.StormLabels = StormLabels
+        self.newwas = newwas
+        self.timestamp = timestamp
+
+    def step(self, var, labels, timestamp, write_file_ID='', stats=None):
+        """
+        Track the storms of the next image. If the image is more than dt_tolerance after the previous image,
+        tracking is reset and the image is skipped (as in wrapper.py), the next image starts new storms.
+        :param var: Variable in a 2D grid used for tracking
+        :type var: ndarray
+        :param labels: Storm labels of var as returned by label_storms. The array is kept as the labels of the
+        previous image until the next step, so it must not be reused before then.
+        :type labels: ndarray
+        :param timestamp: Time stamp of the image, a datetime or a tuple of the arguments of timediff for one image
+        :param write_file_ID: Identifier of the image for plots of the correlations (with flagplot)
+        :type write_file_ID: str
+        :param stats: Collects the time of each tracking stage and counts of events (see track_storms)
+        :type stats: stats.FrameStats
+        :return: Storms, next new storm id, labels, displacements, tracked ids and lifetimes on the grid and the
+        number of dt since the previous image (None for the first image), or None if the image is skipped
+        :rtype: TrackStep
+        """
+        num_dt = None
+        oldmask, newmask = [], []
+        newmask_next = None
+        if self.StormLabels is not None:
+            # CHECK TIME DIFFERENCE BETWEEN CONSECUTIVE IMAGES
+            if self.timediff is None:
+                dtnow = (timestamp - self.timestamp).total_seconds() / 60.
+            else:
+                dtnow = self.timediff(*self.timestamp, *timestamp)
+            num_dt = dtnow / self.dt
+            if dtnow > self.dt_tolerance:
+                self.reset()
+                return None
+            # oldmask, newmask, USED FOR DERIVING (dx,dy), the new mask is the old mask of the next image
+            # THESE CAN BE CHANGED USING EXPERT KNOWLEDGE
+            # e.g. use raw data rather than binary masks,
+            # if displacement information is contained in structures within objects
+            # NB If raw data are used (i.e. not zeros and ones) then fftpixels needs to be changed to remain sensible
+            oldmask = (self.StormLabels >= 1).astype(np.uint8) if self.mask is None else self.mask
+            newmask = (labels >= 1).astype(np.uint8)
+            newmask_next = newmask
+        StormData, newwas, StormLabels, newumat, newvmat, wasarray, lifearray = track_storms(
+            self.StormData, var, self.newwas, labels, self.StormLabels if self.StormLabels is not None else [],
+            self.xmat, self.ymat, self.fftpixels, self.dd_tolerance, self.halosq, self.squarehalf, oldmask, newmask,
+            num_dt if num_dt is not None else [], self.lapthresh, self.misval, self.doradar, self.under_threshold,
+            self.IMAGES_DIR, write_file_ID, self.flagplot, spectra=self.spectra, stats=stats, plan=self,
+            dtype=self.dtype, backend=self.backend)
+        self.StormData = StormData
+        self.StormLabels = StormLabels
+        self.mask = newmask_next
+        self.newwas = newwas
+        self.timestamp = timestamp
+        return TrackStep(StormData, newwas, StormLabels, newumat, newvmat, wasarray, lifearray, num_dt)
+
+
 ###################################################
 # interpolate_speeds used for (dx,dy) calculation where no objects are identified.
+# Missing displacements are filled from neighbouring squares, then a cubic spline
+# maps the squares onto the full grid. The spline is linear in the data, so its
+# weights only depend on the grid geometry and are computed once (spline_weights).
 ###################################################
 
-def interpolate_speeds(xint, yint, xmat, ymat, buu):
+def interpolate_speeds(xint, yint, xmat, ymat, buu, bvv, weights=None, dtype=float):
     """
     Interpolate speeds from displaced grid xint, yint to original grid xmat, ymat
     :param xint:
@@ -705,22 +1504,87 @@ def interpolate_speeds(xint, yint, xmat, ymat, buu):
     :type xmat: ndarray
     :param ymat:
     :type ymat: ndarray
-    :param buu:
+    :param buu: Displacements in x-direction on displaced grid, nan where missing
     :type buu: ndarray
+    :param bvv: Displacements in y-direction on displaced grid, nan where missing
+    :type bvv: ndarray
+    :param weights: Spline weights (in y, in x) of the grids, looked up with spline_weights if not given
+    :type weights: tuple
+    :param dtype: Floating point type of the interpolation and the displacements on the original grid
+    :type dtype: type
     :return:
+    newumat, ndarray Displacements in x-direction on original grid
+    newvmat, ndarray Displacements in y-direction on original grid
+    :rtype: tuple
+    """
+    if weights is None:
+        weights = (spline_weights(tuple(yint[:, 0]), tuple(ymat[:, 0])),
+                   spline_weights(tuple(xint[0, :]), tuple(xmat[0, :])))
+    weightsy, weightsx = [np.asarray(weight, dtype=dtype) for weight in weights]
+    filled = np.stack([fill_speeds(buu), fill_speeds(bvv)]).astype(dtype, copy=False)
+    newmat = weightsy @ filled @ weightsx.T
+
+    return newmat[0], newmat[1]
+
+
+def fill_speeds(buu):
+    """
+    Fill missing displacements with the mean of neighbouring displacements, repeated until none are missing.
+    Fields with fewer than 4 valid displacements are set to zero.
+    :param buu: Displacements on displaced grid, nan where missing
+    :type buu: ndarray
+    :return: Displacements without missing values
+    :rtype: ndarray
+    """
+    if np.sum(~np.isnan(buu)) < 4:
+        return np.zeros(np.shape(buu))
+    filled = np.array(buu, dtype=float)
+    while np.isnan(filled).any():
+        bu_nb = neighbour_mean(filled)
+        gaps = np.isnan(filled) & ~np.isnan(bu_nb)
+        filled[gaps] = bu_nb[gaps]
+    return filled
+
+
+def neighbour_mean(buu):
+    """
+    Mean of the (up to 8) adjacent non-missing values of each element, nan if there are none.
+    :param buu: Field with nan where missing
+    :type buu: ndarray
+    :return: Mean of adjacent values
     :rtype: ndarray
     """
-    valid_mask = ~np.isnan(buu)
-    coords = np.array(np.nonzero(valid_mask)).T
-    values = buu[valid_mask]
-    if np.size(values) >= 4:
-        it = interpolate.LinearNDInterpolator(coords, values, fill_value=0)
-        filled = it(list(np.ndindex(buu.shape))).reshape(buu.shape)
-        fu = interpolate.interp2d(xint[0, :], yint[:, 0], filled, kind='cubic')
-        newumat = fu(xmat[0, :], ymat[:, 0])
+    kernel = np.ones((3, 3))
+    kernel[1, 1] = 0
+    valid = ~np.isnan(buu)
+    total = ndimage.convolve(np.where(valid, buu, 0.), kernel, mode='constant', cval=0.)
+    count = ndimage.convolve(valid.astype(float), kernel, mode='constant', cval=0.)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan)
+
+
+@functools.lru_cache(maxsize=8)
+def spline_weights(knots, points):
+    """
+    Weights of the cubic interpolating spline (not-a-knot) through knots, evaluated at points.
+    Points outside the knots take the value at the nearest knot.
+    Cached, so for a fixed grid geometry the weights are only calculated once.
+    :param knots: Increasing coordinates of the data
+    :type knots: tuple
+    :param points: Coordinates to interpolate to
+    :type points: tuple
+    :return: Read-only array of shape (len(points), len(knots)), interpolated = weights @ data
+    :rtype: ndarray
+    """
+    knots = np.asarray(knots, dtype=float)
+    points = np.clip(np.asarray(points, dtype=float), knots[0], knots[-1])
+    if np.size(knots) == 1:
+        weights = np.ones((np.size(points), 1))
     else:
-        newumat = np.zeros(np.shape(xmat))
-    return newumat
+        spline = interpolate.make_interp_spline(knots, np.eye(np.size(knots)), k=min(3, np.size(knots) - 1))
+        weights = spline(points)
+    weights.flags.writeable = False
+    return weights
 
 
 ###################################################
@@ -730,9 +1594,13 @@ def interpolate_speeds(xint, yint, xmat, ymat, buu):
 # BY EXPERIENCED USERS
 ###################################################
 
-def label_storms(bt, minarea, threshold, struct, under_threshold):
+def label_storms(bt, minarea, threshold, struct, under_threshold, output=None, tiles=1, workers=1):
     """
     Label contiguous features that have a minimum area in an array.
+    Features are labelled once, features smaller than minarea are then removed and the remaining labels
+    are renumbered consecutively (in the same order as labelling again would give) with a lookup table.
+    For large grids the rows can be split into strips that are labelled in parallel (see label_strips),
+    the labels are identical.
     :param bt: Field of data for identifying features
     :type bt: array_like
     :param minarea: Minimum number of grid points for feature to be identified
@@ -743,22 +1611,109 @@ def label_storms(bt, minarea, threshold, struct, under_threshold):
     :type struct: array_like
     :param under_threshold: True if labelled features are under threshold
     :type under_threshold: bool
+    :param output: Integer array with the shape of bt to write the labels into, so it can be reused
+    between calls. A new int32 array is used if not given.
+    :type output: ndarray
+    :param tiles: Number of strips of rows labelled separately
+    :type tiles: int
+    :param workers: Number of threads labelling strips
+    :type workers: int
     :return: An integer ndarray where each unique feature in input has a unique label in the returned array.
     :rtype: ndarray or int
     """
-    binbt = np.zeros_like(bt)
     if under_threshold:
-        binbt[np.where(bt < threshold)] = 1
+        binbt = np.asarray(bt) < threshold
     else:
-        binbt[np.where(bt > threshold)] = 1
-    id_regions, num_ids = ndimage.label(binbt, structure=struct)
-    id_sizes = np.array(ndimage.sum(binbt, id_regions, range(num_ids + 1)))
-    area_mask = (id_sizes < minarea)
-    binbt[area_mask[id_regions]] = 0
-    id_regions, num_ids = ndimage.label(binbt, structure=struct)
-    print('num_ids = ', num_ids)
+        binbt = np.asarray(bt) > threshold
+    if output is None:
+        output = np.empty(np.shape(bt), dtype=np.int32)
+    if tiles > 1:
+        return label_strips(binbt, minarea, struct, output, tiles, workers)
+    num_ids = ndimage.label(binbt, structure=struct, output=output)
+    id_sizes = np.bincount(output.ravel(), minlength=num_ids + 1)
+    area_mask = (id_sizes >= minarea)
+    area_mask[0] = False
+    relabel = np.zeros(num_ids + 1, dtype=output.dtype)
+    relabel[area_mask] = np.arange(1, np.count_nonzero(area_mask) + 1)
+    np.take(relabel, output, out=output)
 
-    return id_regions
+    return output
+
+
+###################################################
+# label_strips LABELS A LARGE GRID IN STRIPS OF ROWS
+# EACH STRIP IS LABELLED ON ITS OWN, FEATURES TOUCHING ACROSS
+# A SEAM (AS DEFINED BY struct) ARE JOINED AS CONNECTED COMPONENTS
+# OF A GRAPH OF STRIP LABELS. NUMBERING FEATURES BY THEIR FIRST
+# STRIP LABEL KEEPS THE ORDER OF LABELLING THE WHOLE GRID
+###################################################
+
+def label_strips(binbt, minarea, struct, output, tiles, workers=1):
+    """
+    Label contiguous features that have a minimum area in a 2D binary array, in strips of rows.
+    Gives the same labels as label_storms on the whole array.
+    :param binbt: Binary field of features
+    :type binbt: ndarray
+    :param minarea: Minimum number of grid points for feature to be identified
+    :type minarea: int
+    :param struct: A 3x3 structuring element that defines feature connections. struct must be centrosymmetric.
+    :type struct: array_like
+    :param output: C-contiguous integer array with the shape of binbt to write the labels into
+    :type output: ndarray
+    :param tiles: Number of strips
+    :type tiles: int
+    :param workers: Number of threads labelling strips
+    :type workers: int
+    :return: An integer ndarray where each unique feature in input has a unique label in the returned array.
+    :rtype: ndarray
+    """
+    struct = np.asarray(struct, dtype=bool)
+    nrows, ncols = np.shape(binbt)
+    rows = np.unique(np.linspace(0, nrows, min(tiles, nrows) + 1).astype(int))
+    strips = [slice(rows[kk], rows[kk + 1]) for kk in range(len(rows) - 1)]
+
+    def label_strip(strip):
+        num_ids = ndimage.label(binbt[strip], structure=struct, output=output[strip])
+        return num_ids, np.bincount(output[strip].ravel(), minlength=num_ids + 1)[1:]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        counted = list(pool.map(label_strip, strips))
+        # Strip labels are numbered after the labels of all strips above
+        offsets = np.cumsum([0] + [num_ids for num_ids, id_sizes in counted])
+        id_sizes = np.concatenate([[0]] + [id_sizes for num_ids, id_sizes in counted])
+
+        # Pairs of strip labels connected across each seam, for every connection to the next row in struct
+        upper, lower = [], []
+        for kk in range(1, len(strips)):
+            above = output[rows[kk] - 1] + np.where(output[rows[kk] - 1] > 0, offsets[kk - 1], 0)
+            below = output[rows[kk]] + np.where(output[rows[kk]] > 0, offsets[kk], 0)
+            for dc in np.flatnonzero(struct[2]) - 1:
+                pair_above = above[max(0, -dc):ncols - max(0, dc)]
+                pair_below = below[max(0, dc):ncols - max(0, -dc)]
+                joined = (pair_above > 0) & (pair_below > 0)
+                upper.append(pair_above[joined])
+                lower.append(pair_below[joined])
+        upper = np.concatenate([[0]] + upper).astype(np.intp)
+        lower = np.concatenate([[0]] + lower).astype(np.intp)
+        seams = sparse.coo_matrix((np.ones(np.size(upper)), (upper, lower)), shape=(offsets[-1] + 1,) * 2)
+        num_features, feature = csgraph.connected_components(seams, directed=False)
+
+        # Features are numbered in the order of their first strip label, small features are removed
+        feature_sizes = np.bincount(feature, weights=id_sizes, minlength=num_features)
+        first_ids = np.sort(np.unique(feature, return_index=True)[1])
+        area_mask = feature_sizes[feature[first_ids]] >= minarea
+        area_mask[0] = False
+        feature_label = np.zeros(num_features, dtype=output.dtype)
+        feature_label[feature[first_ids[area_mask]]] = np.arange(1, np.count_nonzero(area_mask) + 1)
+        relabel = feature_label[feature]
+
+        def relabel_strip(kk):
+            np.take(np.concatenate((relabel[:1], relabel[offsets[kk] + 1:offsets[kk + 1] + 1])), output[strips[kk]],
+                    out=output[strips[kk]])
+
+        list(pool.map(relabel_strip, range(len(strips))))
+
+    return output
 
 
 ##############################################################
@@ -774,6 +1729,9 @@ def label_storms(bt, minarea, threshold, struct, under_threshold):
 # dy = distance in y-direction from previous cell
 # amp = amplitude
 # ffv = full output, only needed for testing (if plotting with flagplot)
+#
+# ffttrack correlates a single pair of squares. track_storms correlates all squares of a frame
+# at once by stacking them and calling tile_spectra and correlate_spectra directly.
 ##############################################################
 
 def ffttrack(s1, s2, method):
@@ -792,63 +1750,124 @@ def ffttrack(s1, s2, method):
     ffv, ndarray Correlation field in real space
     :rtype: tuple
     """
-    leno = max(np.size(s1, 0), np.size(s1, 1))
+    spec1, energy1 = tile_spectra(np.asarray(s1)[np.newaxis], method)
+    spec2, energy2 = tile_spectra(np.asarray(s2)[np.newaxis], method)
+    dx, dy, amp, ffv = correlate_spectra(spec1, energy1, spec2, energy2, np.shape(s1), return_corr=True)
 
+    return int(dx[0]), int(dy[0]), amp[0], ffv[0]
+
+
+@functools.lru_cache(maxsize=None)
+def square_window(leno, method, dtype=float):
+    """
+    Window applied to squares of length leno before correlation, cached for each (leno, method, dtype).
+    The taper is applied along the x-direction (last axis) of a square.
+    :param leno: Length of square in pixels
+    :type leno: int
+    :param method: Use tukey window if 1, otherwise no window
+    :type method: int
+    :param dtype: Floating point type of the window
+    :type dtype: type
+    :return: Read-only window of length leno
+    :rtype: ndarray
+    """
     # Tukey window construction
     # https://www.mathworks.com/help/signal/ref/tukeywin.html
+    xhan = np.array(np.arange(0.5, leno + 0.5))
+    hann1 = np.ones([np.size(xhan)])
     if method == 1:
         alpha = max(0.1, 10.0 / leno)
-        xhan = np.array(np.arange(0.5, leno + 0.5))
-        hann1 = np.ones([np.size(xhan)])
         hann1[np.where(xhan < alpha * leno / 2.)] = 0.5 * (
                 1 + np.cos(np.pi * (2 * xhan[np.where(xhan < alpha * leno / 2.)] / (alpha * leno) - 1)))
         # TODO: Check if 2/alpha should be 2/(alpha*leno)
         hann1[np.where(xhan > leno * (1 - alpha / 2.))] = 0.5 * (1 + np.cos(
             np.pi * (2 * xhan[np.where(xhan > leno * (1 - alpha / 2.))] / (alpha * leno) - 2. / alpha + 1)))
-        hann2 = hann1.conj().transpose() * hann1
-    else:
-        xhan = np.array(np.arange(0.5, leno + 0.5))
-        hann1 = np.ones([np.size(xhan)])
-        hann2 = hann1.conj().transpose() * hann1
+    hann2 = (hann1.conj().transpose() * hann1).astype(dtype)
+    hann2.flags.writeable = False
+    return hann2
 
-    # FIND CONVOLUTION S1, S2 USING FFT
+
+def tile_spectra(squares, method, workers=-1, dtype=float):
+    """
+    Windowed, normalised Fourier spectra of a stack of squares
+    :param squares: Stack of squares with shape (number of squares, leny, lenx)
+    :type squares: ndarray
+    :param method: Use tukey window
+    :type method: int
+    :param workers: Number of threads used by scipy.fft, -1 for all CPUs
+    :type workers: int
+    :param dtype: Floating point type of the windowed squares, float32 squares give complex64 spectra
+    :type dtype: type
+    :return:
+    spectra, ndarray Real-input FFT of each windowed square with its mean removed
+    energy, ndarray Sum of squares of each windowed square with its mean removed
+    :rtype: tuple
+    """
+    leno = max(np.size(squares, 1), np.size(squares, 2))
 
     # Multiplication of signal by window in real space
-    b1 = s1 * hann2
-    b2 = s2 * hann2
+    bb = np.multiply(squares, square_window(leno, method, dtype), dtype=dtype)
 
     # Normalising signal
-    m1 = b1 - np.mean(b1)
-    m2 = b2 - np.mean(b2)
+    bb -= np.mean(bb, axis=(1, 2), keepdims=True)
+    energy = np.sum(bb ** 2, axis=(1, 2))
+
+    return fft.rfft2(bb, workers=workers), energy
 
-    normval = np.sqrt(np.sum(m1 ** 2) * np.sum(m2 ** 2))
+
+def correlate_spectra(spec1, energy1, spec2, energy2, shape, workers=-1, return_corr=False):
+    """
+    Displacement vectors from the cross-correlation of two stacks of square spectra (see tile_spectra)
+    :param spec1: Spectra of previous squares
+    :type spec1: ndarray
+    :param energy1: Energy of previous squares
+    :type energy1: ndarray
+    :param spec2: Spectra of next squares
+    :type spec2: ndarray
+    :param energy2: Energy of next squares
+    :type energy2: ndarray
+    :param shape: Shape (leny, lenx) of a square
+    :type shape: tuple
+    :param workers: Number of threads used by scipy.fft, -1 for all CPUs
+    :type workers: int
+    :param return_corr: Also return the correlation fields
+    :type return_corr: bool
+    :return:
+    dx, ndarray x-components of displacement vectors
+    dy, ndarray y-components of displacement vectors
+    amp, ndarray Normalised amplitudes of maximum correlation
+    ffv, ndarray Correlation fields in real space (only if return_corr)
+    :rtype: tuple
+    """
+    leno = max(shape)
+    normval = np.sqrt(energy1 * energy2)
 
     # Correlation in real space is multiplication of conjugate of one function and another function in Fourier space
-    # ffv = signal.fftconvolve(s1,s2,mode='same')
-    ffv = np.real(np.fft.ifft2(np.fft.fft2(m2) * (np.fft.fft2(m1)).conj()))
+    ffv = fft.irfft2(spec2 * spec1.conj(), s=shape, workers=workers)
 
-    val = np.max(ffv)
-    ind = np.where(ffv == val)
+    # First maximum in row-major order, as found by np.where(ffv == val). Correlations of storm masks often have
+    # several equal maxima that rounding in the FFT leaves slightly unequal, so values within the rounding error
+    # of the FFT (which grows with the energy of the squares and the log of their size) count as equal
+    flat = ffv.reshape(len(ffv), -1)
+    val = np.max(flat, axis=1)
+    tolerance = np.finfo(ffv.dtype).eps * np.log2(np.size(flat, 1)) * normval
+    ind = np.argmax(flat >= (val - tolerance)[:, np.newaxis], axis=1)
 
     # Displacement vectors
-    # print 'max ffv and ind -> ',val, ind
-    dx = ind[1][0]
-    dy = ind[0][0]
+    dy, dx = np.unravel_index(ind, shape)
 
     # If displcament vectors exceed half of grid square,
     # this may be due to aliasing and we subtract the length of square
     # 1hour -> 25km(leno/2) ; 5mins -> 2km(leno/10) : 10mins -> 4km(leno/5)
     cv = leno / 2  # Org. from Thorld = 25km
     # cv = leno/2 # For 200m grids = 20km
-    if dx > cv:
-        dx = dx - leno  # Org. from Thorld
-        # dx = dx - (cv*(dx/cv))
-    if dy > cv:
-        dy = dy - leno  # Org. from Thorld
-        # dy = dy - (cv*(dy/cv))
+    dx = np.where(dx > cv, dx - leno, dx)  # Org. from Thorld
+    dy = np.where(dy > cv, dy - leno, dy)  # Org. from Thorld
     amp = val / normval
 
-    return dx, dy, amp, ffv
+    if return_corr:
+        return dx, dy, amp, ffv
+    return dx, dy, amp
 
 
 ###################################################
@@ -867,32 +1886,24 @@ def write_storms(file_ID, init_time, now_time, label_method, squarelength, rafra
     fw.write('Squarelength=' + str(squarelength) + '\r\n')
     fw.write('Rafraction=' + str(rafraction) + '\r\n')
     fw.write('total number of tracked storms=' + str(newwas - 1) + '\r\n')
+    if not isinstance(StormData, StormTable):
+        StormData = StormTable.from_storms(StormData, misval, doradar=doradar)
     for ns in range(len(StormData)):
-        fw.write('storm ' + str(StormData[ns].was))
-        #       fw.write(' label=' + str(StormData[ns].storm)) # Matches storm to label in mask. Actually no need for this as it is the same as it matches the order of the storms.
-        fw.write(' area=' + str(StormData[ns].area))
-        fw.write(' centroid=' + str(round(StormData[ns].centroidx, 2)) + ',' + str(round(StormData[ns].centroidy, 2)))
-        fw.write(' box=' + str(StormData[ns].boxleft) + ',' + str(StormData[ns].boxup) + ',' + str(
-            StormData[ns].boxwidth) + ',' + str(StormData[ns].boxheight))
-        fw.write(' life=' + str(StormData[ns].life))
-        fw.write(' dx=' + str(round(StormData[ns].dx, 2)) + ' dy=' + str(round(StormData[ns].dy, 2)))
+        fw.write('storm ' + str(StormData.was[ns]))
+        #       fw.write(' label=' + str(StormData.storm[ns])) # Matches storm to label in mask. Actually no need for this as it is the same as it matches the order of the storms.
+        fw.write(' area=' + str(StormData.area[ns]))
+        fw.write(' centroid=' + str(round(StormData.centroidx[ns], 2)) + ',' + str(round(StormData.centroidy[ns], 2)))
+        fw.write(' box=' + str(StormData.boxleft[ns]) + ',' + str(StormData.boxup[ns]) + ',' + str(
+            StormData.boxwidth[ns]) + ',' + str(StormData.boxheight[ns]))
+        fw.write(' life=' + str(StormData.life[ns]))
+        fw.write(' dx=' + str(round(StormData.dx[ns], 2)) + ' dy=' + str(round(StormData.dy[ns], 2)))
 
         if doradar:
-            fw.write(' range=' + str(round(StormData[ns].rangel, 2)) + ',' + str(round(StormData[ns].rangeu, 2)))
-            fw.write(' azimuth=' + str(round(StormData[ns].azimuthl, 2)) + ',' + str(round(StormData[ns].azimuthu, 2)))
-        fw.write(' meanv=' + str(round(StormData[ns].meanvar, 2)))
-        fw.write(' extreme=' + str(round(StormData[ns].extreme, 2)) + ' accreted=')
-        if np.size(StormData[ns].accreted) > 1:
-            for acind in range(np.size(StormData[ns].accreted) - 1):
-                fw.write(str(StormData[ns].accreted[acind]) + ',')
-            fw.write(str(StormData[ns].accreted[np.size(StormData[ns].accreted) - 1]) + ' parent=')
-        else:
-            fw.write(str(StormData[ns].accreted[-1]) + ' parent=')
-        fw.write(str(StormData[ns].child) + ' child=')
-        if np.size(StormData[ns].parent) > 1:
-            for acind in range(np.size(StormData[ns].parent) - 1):
-                fw.write(str(StormData[ns].parent[acind]) + ',')
-            fw.write(str(StormData[ns].parent[np.size(StormData[ns].parent) - 1]) + '\r\n')
-        else:
-            fw.write(str(StormData[ns].parent[-1]) + '\r\n')
+            fw.write(' range=' + str(round(StormData.rangel[ns], 2)) + ',' + str(round(StormData.rangeu[ns], 2)))
+            fw.write(' azimuth=' + str(round(StormData.azimuthl[ns], 2)) + ',' + str(round(StormData.azimuthu[ns], 2)))
+        fw.write(' meanv=' + str(round(StormData.meanvar[ns], 2)))
+        fw.write(' extreme=' + str(round(StormData.extreme[ns], 2)))
+        fw.write(' accreted=' + ','.join(str(acc) for acc in StormData.get_lineage('accreted', ns)))
+        fw.write(' parent=' + str(StormData.child[ns]))
+        fw.write(' child=' + ','.join(str(par) for par in StormData.get_lineage('parent', ns)) + '\r\n')
     fw.close()
@@ -0,0 +1,100 @@
+import collections
+import itertools
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+###################################################
+# PIPELINE STAGES FOR THE WRAPPER LOOP
+# prefetch loads and labels the next images in a background thread while the
+# current image is tracked, OutputWorker writes and plots finished images in
+# another thread. Images are still tracked one after the other and output is
+# written in order, so the results are identical to the sequential loop.
+###################################################
+
+def prefetch(function, items, depth=2, workers=1):
+    """
+    Call function on each item in a thread pool, running up to depth items ahead of the consumer.
+    The call for item k + depth is started when the result of item k is requested, so a consumer that keeps
+    the results of items k - 1 and k has at most depth + 2 results in use at any time (e.g. label arrays).
+    :param function: Function of one item, e.g. loading and labelling an image
+    :type function: callable
+    :param items: Items in order
+    :type items: iterable
+    :param depth: Number of items prepared ahead
+    :type depth: int
+    :param workers: Number of threads. Loaders that are not thread-safe (e.g. netCDF4/HDF5) need a single thread
+    :type workers: int
+    :return: Generator of the results, in the order of items
+    :rtype: generator
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque(pool.submit(function, item) for item in itertools.islice(items, depth))
+        try:
+            while len(pending) > 0:
+                for item in itertools.islice(items, 1):
+                    pending.append(pool.submit(function, item))
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+class OutputWorker():
+    """Runs output tasks (writing, plotting, checkpoints) in order in a background thread. submit blocks when
+    maxsize tasks are waiting, so the output can fall behind the tracking by at most maxsize tasks. Arguments
+    are used when the task runs, so they must not be changed after submitting. An error in a task stops the
+    remaining tasks and is raised by the next submit or by close."""
+
+    def __init__(self, maxsize=8, threaded=True):
+        """
+
+        :param maxsize: Maximum number of waiting tasks
+        :type maxsize: int
+        :param threaded: Run tasks in a background thread, otherwise run them when submitted
+        (e.g. if tracking also plots with matplotlib, which is not thread-safe)
+        :type threaded: bool
+        """
+        self.tasks = queue.Queue(maxsize)
+        self.error = None
+        self.thread = None
+        if threaded:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            if self.error is None:
+                try:
+                    task[0](*task[1], **task[2])
+                except BaseException as err:
+                    self.error = err
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Run function(*args, **kwargs) after all tasks submitted before
+        :param function: Output task
+        :type function: callable
+        """
+        self.check()
+        if self.thread is None:
+            function(*args, **kwargs)
+        else:
+            self.tasks.put((function, args, kwargs))
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """Wait for all submitted tasks to finish"""
+        if self.thread is not None:
+            self.tasks.put(None)
+            self.thread.join()
+            self.thread = None
+        self.check()
@@ -0,0 +1,115 @@
+import os
+import time
+import numpy as np
+
+
+###################################################
+# REAL-TIME TRACKING OF A DATA DIRECTORY
+# watch_directory yields the files of a directory in order as they arrive, so
+# wrapper.py (with watch_data) keeps tracking new images with the tracker state
+# in memory. LatencyMonitor measures the time from the arrival of a file to the
+# output of its storms.
+###################################################
+
+def watch_directory(DATA_DIR, poll_interval=1., settle=0., idle_timeout=None, suffix=''):
+    """
+    Poll a directory for new files. Files already in the directory are yielded first, in sorted order.
+    Hidden files (e.g. files being written before they are renamed) are ignored. A file that is not settled yet
+    holds back the files sorting after it. A new file sorting before a file already yielded is late, it is
+    reported and skipped.
+    :param DATA_DIR: Directory of the input data
+    :type DATA_DIR: str
+    :param poll_interval: Seconds between scans of the directory
+    :type poll_interval: float
+    :param settle: A file is only yielded when it has not been modified for this many seconds,
+    for producers that do not write files atomically
+    :type settle: float
+    :param idle_timeout: Stop after this many seconds without new files, None to watch forever
+    :type idle_timeout: float
+    :param suffix: Only files ending with suffix are used
+    :type suffix: str
+    :return: Generator of file names (without DATA_DIR), in sorted order
+    :rtype: generator
+    """
+    last = None
+    seen = set()
+    last_new = time.time()
+    while True:
+        now = time.time()
+        new = []
+        with os.scandir(DATA_DIR) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.name.endswith(suffix) or entry.name in seen \
+                        or not entry.is_file():
+                    continue
+                new.append((entry.name, now - entry.stat().st_mtime >= settle))
+        found = False
+        for filename, settled in sorted(new):
+            if last is not None and filename < last:
+                print('File ' + filename + ' arrived after ' + last + ' and is skipped')
+                seen.add(filename)
+                continue
+            if not settled:
+                # Later files wait for this one, so the files are tracked in order
+                last_new = time.time()
+                break
+            seen.add(filename)
+            last = filename
+            found = True
+            yield filename
+        if found:
+            last_new = time.time()
+        elif idle_timeout is not None and time.time() - last_new > idle_timeout:
+            return
+        time.sleep(poll_interval)
+
+
+class LatencyMonitor():
+    """Latency of each image, from the time its file was last modified to the time its output is done"""
+
+    def __init__(self, target=None):
+        """
+
+        :param target: Latency target in seconds, images over target are reported
+        :type target: float
+        """
+        self.target = target
+        self.arrivals = {}
+        self.latencies = []
+
+    def arrived(self, key, filename):
+        """
+        Record the arrival of the file of an image
+        :param key: Image identifier, e.g. the image number
+        :param filename: Data file
+        :type filename: str
+        """
+        self.arrivals[key] = os.path.getmtime(filename)
+
+    def done(self, key):
+        """
+        Record that the output of an image is done
+        :param key: Image identifier used in arrived
+        :return: Latency in seconds
+        :rtype: float
+        """
+        latency = time.time() - self.arrivals.pop(key)
+        self.latencies.append(latency)
+        if self.target is not None and latency > self.target:
+            print('Latency of image ' + str(key) + ' is ' + str(round(latency, 2)) + ' s, over target of ' +
+                  str(self.target) + ' s')
+        return latency
+
+    def summary(self):
+        """
+        :return: Number of images, mean, median, 95th percentile and maximum latency in seconds,
+        and number of images over target
+        :rtype: dict
+        """
+        latencies = np.array(self.latencies)
+        if np.size(latencies) == 0:
+            return {'images': 0}
+        return {'images': int(np.size(latencies)), 'mean': float(np.mean(latencies)),
+                'median': float(np.median(latencies)), 'p95': float(np.percentile(latencies, 95)),
+                'max': float(np.max(latencies)),
+                'over_target': 0 if self.target is None else int(np.count_nonzero(latencies > self.target))}
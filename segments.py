@@ -0,0 +1,168 @@
+import os
+import collections
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from object_tracking import label_storms
+
+
+###################################################
+# PARALLEL TRACKING OF SEGMENTS OF THE FILE LIST
+# The file list is split at data gaps (where tracking starts again anyway) and,
+# for long stretches without gaps, at forced cut points. Segments are tracked
+# independently in a pool of processes and their storm ids are stitched in order:
+# a forced cut repeats the last image of a segment as the first image of the next
+# one, so the tracks running through it keep their ids and lifetimes.
+###################################################
+
+def split_segments(filetimes, timediff, dt_tolerance, max_length=None):
+    """
+    Split a file list into segments
+    :param filetimes: (hour, minute) of every file, see user_functions.filetime
+    :type filetimes: list
+    :param timediff: Time difference of two (hour, minute) pairs, see user_functions.timediff
+    :type timediff: callable
+    :param dt_tolerance: Maximum separation in time allowed between consecutive images
+    :type dt_tolerance: float
+    :param max_length: Maximum number of images in a segment (at least 2), None to only split at data gaps
+    :type max_length: int
+    :return: List of (start, stop, overlap), segment files are [start, stop) in the file list.
+    overlap is True if the first image is the last image of the previous segment (forced cut)
+    :rtype: list
+    """
+    if max_length is not None and max_length < 2:
+        raise ValueError('Segments must have at least 2 images to overlap')
+    segments = []
+    start = 0
+    for nt in range(1, len(filetimes) + 1):
+        if nt < len(filetimes) and timediff(*filetimes[nt - 1], *filetimes[nt]) <= dt_tolerance:
+            continue
+        # Data gap (or end of list), cut the images since the previous gap into overlapping segments
+        first = start
+        while True:
+            stop = nt if max_length is None else min(first + max_length, nt)
+            segments.append((first, stop, first > start))
+            if stop == nt:
+                break
+            first = stop - 1
+        start = nt
+    return segments
+
+
+def track_segment(filenames, settings):
+    """
+    Track the images of one segment from scratch, as the loop in wrapper.py
+    :param filenames: Files of the segment
+    :type filenames: list
+    :param settings: Settings, with the names of the variables in wrapper.py: loadfile, minpixel, threshold, struct2d,
+    under_t, tracker (object_tracking.Tracker, its time stamps are (hour, minute) as returned by loadfile).
+    Optionally label_tiles and label_workers
+    :type settings: dict
+    :return: List of (file_ID, newwas, StormData) for every image, with ids starting at 1
+    :rtype: list
+    """
+    tracker = settings['tracker']
+    tracker.reset()
+    frames = []
+    for filename in filenames:
+        var, file_ID, hourval, minval = settings['loadfile'](filename)
+        NewLabels = label_storms(var, settings['minpixel'], settings['threshold'], settings['struct2d'],
+                                 settings['under_t'], tiles=settings.get('label_tiles', 1),
+                                 workers=settings.get('label_workers', 1))
+        tracked = tracker.step(var, NewLabels, (hourval, minval))
+        if tracked is None:
+            # split_segments cuts at data gaps, so the time stamps of loadfile and filetime disagree
+            raise ValueError('Data are too far apart in time within a segment at ' + str(file_ID) +
+                             ', check that filetime gives the time stamps of loadfile')
+        frames.append((file_ID, tracked.newwas, tracked.StormData))
+    return frames
+
+
+def stitch_segment(frames, newwas, misval, overlap=None):
+    """
+    Replace the ids of a tracked segment by ids continuing those of the previous segments. Ids are changed in place.
+    :param frames: Output of track_segment
+    :type frames: list
+    :param newwas: Next new storm id after the previous segments
+    :type newwas: int
+    :param misval: Preferred value to used for missing values.
+    :type misval: int
+    :param overlap: Stitched storms of the last image of the previous segment if this segment starts with it
+    :type overlap: StormTable
+    :return:
+    frames, list of (file_ID, newwas, StormData) without the overlapping image
+    newwas, int Next new storm id after this segment
+    :rtype: tuple
+    """
+    numlocal = frames[-1][1]
+    idlut = np.zeros(numlocal, dtype=int)
+    lifelut = np.zeros(numlocal, dtype=int)
+    numfirst = 0
+    if overlap is not None:
+        # The first image was tracked with ids 1..n and lifetime 1, storm ns is storm ns of the overlapping image
+        numfirst = len(frames[0][2])
+        if numfirst != len(overlap):
+            raise ValueError('Overlapping image of ' + str(frames[0][0]) + ' has ' + str(numfirst) +
+                             ' storms, previous segment has ' + str(len(overlap)))
+        idlut[1:numfirst + 1] = overlap.was
+        lifelut[1:numfirst + 1] = overlap.life - 1
+        frames = frames[1:]
+    # Storms first seen later get new ids in the same order
+    idlut[numfirst + 1:] = np.arange(newwas, newwas + numlocal - numfirst - 1)
+
+    def stitched_ids(ids):
+        known = ids != misval
+        return np.where(known, idlut[np.where(known, ids, 0)], misval)
+
+    stitched = []
+    for file_ID, localwas, StormData in frames:
+        # A storm split off another one has the lifetime of that storm, so also its lifetime offset
+        split = StormData.child != misval
+        lifelut[StormData.was[split]] = lifelut[StormData.child[split]]
+        StormData.life = StormData.life + lifelut[StormData.was]
+        StormData.was = idlut[StormData.was]
+        StormData.child = stitched_ids(StormData.child)
+        for name in StormData.lineage:
+            setattr(StormData, name + '_values', stitched_ids(getattr(StormData, name + '_values')))
+        stitched.append((file_ID, newwas + localwas - numfirst - 1, StormData))
+    return stitched, newwas + numlocal - numfirst - 1
+
+
+def run_segments(filenames, settings, filetime, max_length=None, workers=None):
+    """
+    Track a file list in segments in a pool of processes (see split_segments). Unlike the loop in wrapper.py,
+    the image after a data gap starts new tracks instead of being skipped, and storm ids keep counting up.
+    :param filenames: Files in order
+    :type filenames: list
+    :param settings: Tracking settings, see track_segment
+    :type settings: dict
+    :param filetime: Time stamp (hour, minute) of a file without loading it, see user_functions.filetime
+    :type filetime: callable
+    :param max_length: Maximum number of images in a segment, None to only split at data gaps
+    :type max_length: int
+    :param workers: Number of processes, default the number of CPUs
+    :type workers: int
+    :return: Generator of (nt, file_ID, newwas, StormData) for every image in order, nt is the index in filenames
+    :rtype: generator
+    """
+    segments = split_segments([filetime(filename) for filename in filenames], settings['tracker'].timediff,
+                              settings['tracker'].dt_tolerance, max_length=max_length)
+    workers = os.cpu_count() if workers is None else workers
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        # Segments are submitted a few ahead of the one being stitched, to bound the memory of finished segments
+        ahead = 2 * workers
+        pending = collections.deque()
+        nextsegment = 0
+        newwas = 1
+        last = None
+        while nextsegment < len(segments) or len(pending) > 0:
+            while nextsegment < len(segments) and len(pending) < ahead:
+                start, stop, overlap = segments[nextsegment]
+                pending.append((segments[nextsegment], pool.submit(track_segment, filenames[start:stop], settings)))
+                nextsegment = nextsegment + 1
+            (start, stop, overlap), future = pending.popleft()
+            frames, newwas = stitch_segment(future.result(), newwas, settings['tracker'].misval,
+                                            overlap=last if overlap else None)
+            for nf in range(len(frames)):
+                yield (stop - len(frames) + nf,) + frames[nf]
+            last = frames[-1][2]
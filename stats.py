@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import contextlib
+from os.path import isdir, dirname
+
+
+###################################################
+# FrameStats COLLECTS STAGE TIMES AND COUNTERS OF ONE IMAGE
+# track_storms times its stages with lap (time since the previous lap) and counts
+# squares, orphans, splits and merges. A disabled FrameStats does nothing, so the
+# instrumentation costs a method call per stage when it is not used.
+###################################################
+
+class FrameStats():
+    """Named stage times (seconds) and counters of one image"""
+
+    def __init__(self, enabled=True):
+        """
+
+        :param enabled: Collect times and counts, otherwise all methods do nothing
+        :type enabled: bool
+        """
+        self.enabled = enabled
+        self.timers = {}
+        self.counters = {}
+        self.last = time.perf_counter() if enabled else None
+
+    def mark(self):
+        """Start timing the next stage now"""
+        if self.enabled:
+            self.last = time.perf_counter()
+
+    def lap(self, name):
+        """
+        Add the time since the previous lap (or mark) to a stage
+        :param name: Stage name
+        :type name: str
+        """
+        if self.enabled:
+            now = time.perf_counter()
+            self.timers[name] = self.timers.get(name, 0.) + now - self.last
+            self.last = now
+
+    def stage(self, name):
+        """
+        Context manager adding the time spent in a with block to a stage
+        :param name: Stage name
+        :type name: str
+        """
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.timed(name)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[name] = self.timers.get(name, 0.) + time.perf_counter() - start
+
+    def count(self, name, number=1):
+        """
+        Add to a counter
+        :param name: Counter name
+        :type name: str
+        :param number: Number added
+        :type number: int
+        """
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + int(number)
+
+    def record(self, **fields):
+        """
+        :param fields: Other fields of the record, e.g. the image number and file_ID
+        :return: Record with the fields, the stage times and the counters
+        :rtype: dict
+        """
+        record = dict(fields)
+        record['timers'] = dict(self.timers)
+        record['counters'] = dict(self.counters)
+        return record
+
+
+class StatsLog():
+    """Writes records of FrameStats as JSON lines"""
+
+    def __init__(self, filename, append=False):
+        """
+
+        :param filename: File of JSON lines
+        :type filename: str
+        :param append: Append to an existing file
+        :type append: bool
+        """
+        if dirname(filename) and not isdir(dirname(filename)):
+            os.makedirs(dirname(filename))
+        self.file = open(filename, 'a' if append else 'w')
+
+    def write(self, record):
+        """
+        :param record: Record of FrameStats.record
+        :type record: dict
+        """
+        self.file.write(json.dumps(record, default=str) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,528 @@
+import os
+import zipfile
+import datetime
+import numpy as np
+from os.path import isfile, isdir, dirname
+from object_tracking import StormTable, storm_properties, write_storms
+
+
+###################################################
+# OUTPUT BACKENDS FOR TRACKED STORMS
+# A writer is created once per run, write() is called for every image and close() at the end.
+# TextWriter writes one history_*.txt file per image (see object_tracking.write_storms).
+# NpzWriter appends the storm tables of all images to a single columnar .npz file,
+# buffering chunk_size images in memory and writing them as one batch.
+###################################################
+
+class TextWriter():
+    """Writes a history_{file_ID}.txt file for every image with write_storms."""
+
+    def __init__(self, init_time, label_method, squarelength, rafraction, doradar, misval, IMAGES_DIR):
+        """
+
+        :param init_time: Start date and time
+        :type init_time: datetime.datetime
+        :param label_method: Information on labelling
+        :type label_method: str
+        :param squarelength: The size in pixels of individual square regions for displacement vectors
+        :type squarelength: float
+        :param rafraction: The minimum fractional cover of objects required to calculate displacement vectors
+        :type rafraction: float
+        :param doradar: Write radar range and azimuth
+        :type doradar: bool
+        :param misval: Preferred value to used for missing values.
+        :type misval: int
+        :param IMAGES_DIR: Output directory
+        :type IMAGES_DIR: str
+        """
+        self.init_time = init_time
+        self.label_method = label_method
+        self.squarelength = squarelength
+        self.rafraction = rafraction
+        self.doradar = doradar
+        self.misval = misval
+        self.IMAGES_DIR = IMAGES_DIR
+
+    def write(self, file_ID, now_time, newwas, StormData):
+        """
+        Write the storms of one image
+        :param file_ID: File identifier of the image
+        :type file_ID: str
+        :param now_time: Date and time of the image
+        :type now_time: datetime.datetime
+        :param newwas: Next new storm id
+        :type newwas: int
+        :param StormData: Storms of the image
+        :type StormData: StormTable
+        """
+        write_storms(file_ID, self.init_time, now_time, self.label_method, self.squarelength, self.rafraction, newwas,
+                     StormData, self.doradar, self.misval, self.IMAGES_DIR)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class NpzWriter():
+    """Appends the storm tables of all images to a single .npz file. Every chunk of images is stored as one array
+    per column (chunk{n}/{column}), with a frame column indexing the per-image arrays (file_ID, time, newwas).
+    Use read_npz or npz_tables to read the file."""
+
+    def __init__(self, filename, init_time, label_method, squarelength, rafraction, doradar, misval, chunk_size=288,
+                 append=False):
+        """
+
+        :param filename: Output file
+        :type filename: str
+        :param init_time: Start date and time
+        :type init_time: datetime.datetime
+        :param label_method: Information on labelling
+        :type label_method: str
+        :param squarelength: The size in pixels of individual square regions for displacement vectors
+        :type squarelength: float
+        :param rafraction: The minimum fractional cover of objects required to calculate displacement vectors
+        :type rafraction: float
+        :param doradar: Write radar range and azimuth
+        :type doradar: bool
+        :param misval: Preferred value to used for missing values.
+        :type misval: int
+        :param chunk_size: Number of images buffered before they are written (288 is a day of 5-minute images)
+        :type chunk_size: int
+        :param append: Append to an existing file (e.g. when resuming a run) instead of replacing it
+        :type append: bool
+        """
+        self.filename = filename
+        self.doradar = doradar
+        self.misval = misval
+        self.chunk_size = chunk_size
+        self.buffer = []
+        if dirname(filename) and not isdir(dirname(filename)):
+            os.makedirs(dirname(filename))
+        if append and isfile(filename):
+            with zipfile.ZipFile(filename) as zf:
+                self.numchunks = len({name.split('/')[0] for name in zf.namelist() if name.startswith('chunk')})
+        else:
+            self.numchunks = 0
+            meta = {'misval': misval, 'init_time': np.datetime64(init_time, 's'), 'label_method': label_method,
+                    'squarelength': squarelength, 'rafraction': rafraction, 'doradar': doradar}
+            with zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+                write_arrays(zf, 'meta/', meta)
+
+    def write(self, file_ID, now_time, newwas, StormData):
+        """
+        Buffer the storms of one image, the buffer is written when it holds chunk_size images
+        :param file_ID: File identifier of the image
+        :type file_ID: str
+        :param now_time: Date and time of the image
+        :type now_time: datetime.datetime
+        :param newwas: Next new storm id
+        :type newwas: int
+        :param StormData: Storms of the image
+        :type StormData: StormTable
+        """
+        if not isinstance(StormData, StormTable):
+            StormData = StormTable.from_storms(StormData, self.misval, doradar=self.doradar)
+        self.buffer.append((file_ID, now_time, newwas, StormData))
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered images as one chunk"""
+        if len(self.buffer) == 0:
+            return
+        tables = [frame[3] for frame in self.buffer]
+        # Empty tables have default column types, so only use them if there are no storms at all
+        stormtables = [table for table in tables if len(table) > 0] or tables[:1]
+        arrays = {'file_ID': np.array([frame[0] for frame in self.buffer]),
+                  'time': np.array([np.datetime64(frame[1], 's') for frame in self.buffer]),
+                  'newwas': np.array([frame[2] for frame in self.buffer]),
+                  'frame': np.repeat(np.arange(len(tables)), [len(table) for table in tables])}
+        columns = StormTable.columns + (StormTable.radar_columns if self.doradar else [])
+        for name in columns + ['extra_area']:
+            arrays[name] = np.concatenate([getattr(table, name) for table in stormtables])
+        for name in StormTable.lineage:
+            # Offsets are stored as the length of the list of each storm
+            arrays[name + '_counts'] = np.concatenate([np.diff(getattr(table, name + '_offsets'))
+                                                       for table in stormtables])
+            arrays[name + '_values'] = np.concatenate([getattr(table, name + '_values') for table in stormtables])
+        with zipfile.ZipFile(self.filename, 'a', compression=zipfile.ZIP_DEFLATED) as zf:
+            write_arrays(zf, 'chunk%06d/' % self.numchunks, arrays)
+        self.numchunks = self.numchunks + 1
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+
+
+def write_arrays(zf, prefix, arrays):
+    """
+    Write arrays to an open zip file as .npy members, in the layout of np.savez
+    :param zf: Zip file opened for writing
+    :type zf: zipfile.ZipFile
+    :param prefix: Prefix of the member names
+    :type prefix: str
+    :param arrays: Arrays by name
+    :type arrays: dict
+    """
+    for name in arrays:
+        with zf.open(prefix + name + '.npy', 'w', force_zip64=True) as fh:
+            np.lib.format.write_array(fh, np.asarray(arrays[name]), allow_pickle=False)
+
+
+def make_writer(output_format, init_time, label_method, squarelength, rafraction, doradar, misval, IMAGES_DIR,
+                filename='storms.npz', append=False):
+    """
+    Output backend by name
+    :param output_format: 'text' for history_*.txt files, 'npz' for a single columnar .npz file in IMAGES_DIR
+    :type output_format: str
+    :param filename: Name of the .npz file
+    :type filename: str
+    :param append: Append to an existing .npz file
+    :type append: bool
+    :return: Writer
+    :rtype: TextWriter or NpzWriter
+    """
+    if output_format == 'text':
+        return TextWriter(init_time, label_method, squarelength, rafraction, doradar, misval, IMAGES_DIR)
+    elif output_format == 'npz':
+        return NpzWriter(IMAGES_DIR + filename, init_time, label_method, squarelength, rafraction, doradar, misval,
+                         append=append)
+    raise ValueError('Unknown output format: ' + str(output_format))
+
+
+###################################################
+# READERS FOR THE COLUMNAR .npz OUTPUT
+###################################################
+
+def read_npz(filename):
+    """
+    Read a file written by NpzWriter
+    :param filename: .npz file
+    :type filename: str
+    :return:
+    meta, dict Run information (misval, init_time, label_method, squarelength, rafraction, doradar)
+    frames, dict Arrays with one element per image (file_ID, time, newwas, numstorms)
+    storms, dict Arrays with one element per storm of all images, frame is the index of the image
+    (images written more than once, after resuming from a checkpoint, are only included once)
+    :rtype: tuple
+    """
+    meta, chunks = {}, {}
+    with np.load(filename) as npz:
+        for key in npz.files:
+            prefix, name = key.split('/')
+            if prefix == 'meta':
+                meta[name] = npz[key].item()
+            else:
+                chunks.setdefault(prefix, {})[name] = npz[key]
+    frames = {'file_ID': [], 'time': [], 'newwas': [], 'numstorms': []}
+    storms = {}
+    numframes = 0
+    for prefix in sorted(chunks):
+        chunk = chunks[prefix]
+        for name in ['file_ID', 'time', 'newwas']:
+            frames[name].append(chunk[name])
+        frames['numstorms'].append(np.bincount(chunk['frame'], minlength=np.size(chunk['newwas'])))
+        chunk['frame'] = chunk['frame'] + numframes
+        numframes = numframes + np.size(chunk['newwas'])
+        for name in chunk:
+            if name not in frames:
+                storms.setdefault(name, []).append(chunk[name])
+    frames = {name: np.concatenate(frames[name]) for name in frames if len(frames[name]) > 0}
+    storms = {name: np.concatenate(storms[name]) for name in storms}
+
+    # Images written again after resuming from a checkpoint: keep the last copy
+    if len(frames) > 0 and np.size(np.unique(frames['time'])) < np.size(frames['time']):
+        last = np.size(frames['time']) - 1 - np.unique(frames['time'][::-1], return_index=True)[1]
+        keep = np.zeros(np.size(frames['time']), dtype=bool)
+        keep[last] = True
+        stormkeep = keep[storms['frame']]
+        for name in StormTable.lineage:
+            storms[name + '_values'] = storms[name + '_values'][np.repeat(stormkeep, storms[name + '_counts'])]
+        storms = {name: storms[name] if name.endswith('_values') else storms[name][stormkeep] for name in storms}
+        storms['frame'] = (np.cumsum(keep) - 1)[storms['frame']]
+        frames = {name: frames[name][keep] for name in frames}
+    return meta, frames, storms
+
+
+def npz_tables(filename):
+    """
+    Iterate over the images in a file written by NpzWriter
+    :param filename: .npz file
+    :type filename: str
+    :return: Generator of (file_ID, now_time, newwas, StormData) for every image
+    :rtype: generator
+    """
+    meta, frames, storms = read_npz(filename)
+    misval = int(meta['misval'])
+    doradar = bool(meta['doradar'])
+    starts = np.concatenate(([0], np.cumsum(frames['numstorms'])))
+    lineage = {}
+    for name in StormTable.lineage:
+        lineage[name] = np.concatenate(([0], np.cumsum(storms[name + '_counts'])))
+    for nf in range(np.size(frames['newwas'])):
+        start, stop = starts[nf], starts[nf + 1]
+        StormData = StormTable(stop - start, misval, doradar=doradar)
+        for name in StormTable.columns + (StormTable.radar_columns if doradar else []) + ['extra_area']:
+            setattr(StormData, name, storms[name][start:stop])
+        for name in StormTable.lineage:
+            offsets = lineage[name][start:stop + 1]
+            setattr(StormData, name + '_offsets', offsets - offsets[0])
+            setattr(StormData, name + '_values', storms[name + '_values'][offsets[0]:offsets[-1]])
+        now_time = frames['time'][nf].astype(datetime.datetime)
+        yield str(frames['file_ID'][nf]), now_time, int(frames['newwas'][nf]), StormData
+
+
+###################################################
+# READERS FOR THE history_*.txt OUTPUT
+# Each file is tokenized in a single pass, the values of each field are
+# collected in a list and converted to a column in one go
+###################################################
+
+# Header lines written by write_storms and the keys they are read into
+history_header = {'missing_value': 'misval', 'Start date and time': 'init_time',
+                  'Current date and time': 'now_time', 'Label method': 'label_method',
+                  'Squarelength': 'squarelength', 'Rafraction': 'rafraction',
+                  'total number of tracked storms': 'numtracked'}
+
+
+def read_history(filename, as_storms=False):
+    """
+    Read a history file written by write_storms
+    :param filename: history_*.txt file
+    :type filename: str
+    :param as_storms: Return a list of StormS-compatible StormView objects instead of the table
+    :type as_storms: bool
+    :return:
+    header, dict Header information (misval, init_time, now_time, label_method, squarelength, rafraction,
+    newwas, the next new storm id)
+    StormData, StormTable of the storms (or list if as_storms)
+    :rtype: tuple
+    """
+    header = {}
+    fields = {'storm': []}
+    with open(filename) as fr:
+        for line in fr:
+            if line.startswith('storm '):
+                tokens = line.split()
+                fields['storm'].append(tokens[1])
+                for token in tokens[2:]:
+                    key, value = token.split('=', 1)
+                    fields.setdefault(key, []).append(value)
+            elif '=' in line:
+                key, value = line.rstrip('\r\n').split('=', 1)
+                header[history_header.get(key, key)] = value
+    header['misval'] = int(header['misval'])
+    header['init_time'] = datetime.datetime.strptime(header['init_time'], '%d/%m/%y-%H%M')
+    header['now_time'] = datetime.datetime.strptime(header['now_time'], '%d/%m/%y-%H%M')
+    header['squarelength'] = float(header['squarelength'])
+    header['rafraction'] = float(header['rafraction'])
+    header['newwas'] = int(header.pop('numtracked')) + 1
+
+    doradar = 'range' in fields
+    StormData = StormTable(len(fields['storm']), header['misval'], doradar=doradar)
+    if len(StormData) > 0:
+        StormData.was = number_array(fields['storm'])
+        StormData.area = number_array(fields['area'])
+        StormData.life = number_array(fields['life'])
+        # Integers for storms of a first image (dx=0 dy=0), so they are written back the same
+        StormData.dx = number_array(fields['dx'])
+        StormData.dy = number_array(fields['dy'])
+        StormData.meanvar = np.array(fields['meanv'], dtype=float)
+        StormData.extreme = np.array(fields['extreme'], dtype=float)
+        StormData.centroidx, StormData.centroidy = split_columns(fields['centroid'], 2, float)
+        StormData.boxleft, StormData.boxup, StormData.boxwidth, StormData.boxheight = split_columns(fields['box'], 4)
+        if doradar:
+            StormData.rangel, StormData.rangeu = split_columns(fields['range'], 2, float)
+            StormData.azimuthl, StormData.azimuthu = split_columns(fields['azimuth'], 2, float)
+        # parent= is the id of the storm this one split from, child= the ids of the storms that split off this one
+        StormData.child = number_array(fields['parent'])
+        StormData.accreted_offsets, StormData.accreted_values = lineage_arrays(fields['accreted'])
+        StormData.parent_offsets, StormData.parent_values = lineage_arrays(fields['child'])
+    if as_storms:
+        return header, list(StormData)
+    return header, StormData
+
+
+def read_history_dir(IMAGES_DIR, as_storms=False):
+    """
+    Read all history files in a directory, in order of file name
+    :param IMAGES_DIR: Directory with history_*.txt files
+    :type IMAGES_DIR: str
+    :param as_storms: Return lists of StormS-compatible StormView objects instead of tables
+    :type as_storms: bool
+    :return: List of (file_ID, header, StormData) for every file, see read_history
+    :rtype: list
+    """
+    histories = []
+    for filename in history_files(IMAGES_DIR):
+        header, StormData = read_history(os.path.join(IMAGES_DIR, filename), as_storms=as_storms)
+        histories.append((filename[len('history_'):-len('.txt')], header, StormData))
+    return histories
+
+
+def history_files(IMAGES_DIR, file_ID_prefix=''):
+    """
+    Sorted names of the history files in a directory
+    :param IMAGES_DIR: Directory with history_*.txt files
+    :type IMAGES_DIR: str
+    :param file_ID_prefix: Only files with file_ID starting with this (e.g. "S100_T3_A4_")
+    :type file_ID_prefix: str
+    :return: File names
+    :rtype: list
+    """
+    return sorted(filename for filename in os.listdir(IMAGES_DIR)
+                  if filename.startswith('history_' + file_ID_prefix) and filename.endswith('.txt'))
+
+
+def number_array(strings):
+    """Integer array from strings, or float array if any of them is not an integer"""
+    try:
+        return np.array(strings).astype(int)
+    except ValueError:
+        return np.array(strings).astype(float)
+
+
+def split_columns(strings, ncolumns, dtype=None):
+    """Columns of comma-separated strings with ncolumns values each"""
+    values = ','.join(strings).split(',')
+    values = number_array(values) if dtype is None else np.array(values, dtype=dtype)
+    return [values[nc::ncolumns] for nc in range(ncolumns)]
+
+
+def lineage_arrays(strings):
+    """Offsets and values of comma-separated lists of storm ids"""
+    counts = [value.count(',') + 1 for value in strings]
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    return offsets, number_array(','.join(strings).split(','))
+
+
+###################################################
+# CHECKPOINTS OF THE TRACKER STATE
+# The state carried from one image to the next is written to a compressed
+# .npz file, first to a temporary file which then replaces the checkpoint,
+# so an interrupted write never leaves a broken checkpoint behind
+###################################################
+
+def write_checkpoint(filename, nt, now_time, StormData, StormLabels, newwas, hourval, minval):
+    """
+    Write the tracker state after an image atomically
+    :param filename: Checkpoint file (.npz)
+    :type filename: str
+    :param nt: Index of the image in the file list
+    :type nt: int
+    :param now_time: Date and time of the image
+    :type now_time: datetime.datetime
+    :param StormData: Storms of the image
+    :type StormData: StormTable
+    :param StormLabels: Storm labels of the image
+    :type StormLabels: ndarray
+    :param newwas: Next new storm id
+    :type newwas: int
+    :param hourval: Hour of the image (see user_functions.loadfile)
+    :type hourval: float
+    :param minval: Minute of the image
+    :type minval: float
+    """
+    if dirname(filename) and not isdir(dirname(filename)):
+        os.makedirs(dirname(filename))
+    arrays = {'nt': nt, 'now_time': np.datetime64(now_time, 's'), 'StormLabels': StormLabels, 'newwas': newwas,
+              'hourval': hourval, 'minval': minval, 'misval': StormData.misval, 'doradar': StormData.doradar,
+              'extra_thresh': np.array(StormData.extra_thresh, dtype=float)}
+    columns = StormTable.columns + (StormTable.radar_columns if StormData.doradar else []) + ['extra_area']
+    for name in StormTable.lineage:
+        columns = columns + [name + '_offsets', name + '_values']
+    for name in columns:
+        arrays['table_' + name] = getattr(StormData, name)
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as fw:
+        np.savez_compressed(fw, **arrays)
+        fw.flush()
+        os.fsync(fw.fileno())
+    os.replace(tmpname, filename)
+
+
+def read_checkpoint(filename):
+    """
+    Read a checkpoint written by write_checkpoint
+    :param filename: Checkpoint file (.npz)
+    :type filename: str
+    :return: Tracker state with keys nt, now_time, StormData, StormLabels, newwas, hourval, minval
+    :rtype: dict
+    """
+    with np.load(filename) as npz:
+        arrays = {key: npz[key] for key in npz.files}
+    StormData = StormTable(0, arrays['misval'].item(), extra_thresh=arrays['extra_thresh'].tolist(),
+                           doradar=arrays['doradar'].item())
+    for key in arrays:
+        if key.startswith('table_'):
+            setattr(StormData, key[len('table_'):], arrays[key])
+    return {'nt': arrays['nt'].item(), 'now_time': arrays['now_time'].item(), 'StormData': StormData,
+            'StormLabels': arrays['StormLabels'], 'newwas': arrays['newwas'].item(),
+            'hourval': arrays['hourval'].item(), 'minval': arrays['minval'].item()}
+
+
+###################################################
+# RESUMING A RUN FROM ITS OUTPUT
+###################################################
+
+def resume_storms(StormData, StormLabels, var, xmat, ymat, under_threshold):
+    """
+    Prepare storms read back from the output as old storms for track_storms. The history files round the centroids,
+    so they are recalculated from the labels of the image they were written for, which must be labelled with the
+    same settings.
+    :param StormData: Storms of the last written image
+    :type StormData: StormTable
+    :param StormLabels: Storm labels of the last written image
+    :type StormLabels: ndarray
+    :param var: Variable of the last written image
+    :type var: ndarray
+    :param xmat: meshgrid of x-coordinates
+    :type xmat: ndarray
+    :param ymat: meshgrid of y-coordinates
+    :type ymat: ndarray
+    :param under_threshold: Is the variable of interest smaller than a threshold
+    :type under_threshold: bool
+    :return: Storm table
+    :rtype: StormTable
+    """
+    if np.max(StormLabels, initial=0) != len(StormData):
+        raise ValueError('Number of labelled storms (' + str(np.max(StormLabels, initial=0)) +
+                         ') does not match the number of storms in the output (' + str(len(StormData)) + ')')
+    properties = storm_properties(StormLabels, var, xmat, ymat, under_threshold)
+    StormData.centroidx = properties['centroidx']
+    StormData.centroidy = properties['centroidy']
+    return StormData
+
+
+def last_output(output_format, IMAGES_DIR, file_ID_prefix='', filename='storms.npz'):
+    """
+    Storms of the last image written by a run
+    :param output_format: 'text' or 'npz', see make_writer
+    :type output_format: str
+    :param IMAGES_DIR: Output directory
+    :type IMAGES_DIR: str
+    :param file_ID_prefix: Only history files with file_ID starting with this
+    :type file_ID_prefix: str
+    :param filename: Name of the .npz file
+    :type filename: str
+    :return: (file_ID, now_time, newwas, StormData), or None if nothing was written
+    :rtype: tuple
+    """
+    if output_format == 'text':
+        filenames = history_files(IMAGES_DIR, file_ID_prefix) if isdir(IMAGES_DIR) else []
+        if len(filenames) == 0:
+            return None
+        # File names need not sort in time (e.g. hhmm file identifiers), so use the last modified file
+        last = max(filenames, key=lambda filename: os.path.getmtime(os.path.join(IMAGES_DIR, filename)))
+        header, StormData = read_history(os.path.join(IMAGES_DIR, last))
+        return last[len('history_'):-len('.txt')], header['now_time'], header['newwas'], StormData
+    elif output_format == 'npz':
+        if not isfile(IMAGES_DIR + filename):
+            return None
+        last = None
+        for last in npz_tables(IMAGES_DIR + filename):
+            pass
+        return last
+    raise ValueError('Unknown output format: ' + str(output_format))
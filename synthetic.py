@@ -0,0 +1,170 @@
+import os
+import time
+import datetime
+import numpy as np
+from scipy import spatial
+
+
+###################################################
+# SYNTHETIC RAINFALL DATA
+# Storms are Gaussian cells moving with their own velocity, growing and decaying,
+# splitting and merging, on top of noise. synthetic_frames generates the fields
+# (also used by benchmark.py), write_frame stores a field as the example data read
+# by user_functions.loadfile, produce writes files at a fixed cadence as a stand-in
+# for a real-time data feed.
+###################################################
+
+def synthetic_frames(n, shape=(300, 400), nstorms=40, seed=0, noise=0.3, radius=(2., 7.), peak=(4., 20.),
+                     speed=(3., 2.), speed_spread=(3., 2.), growth=0.02, split_rate=0., merge_rate=0.):
+    """
+    Generate rainfall fields of moving storms
+    :param n: Number of frames
+    :type n: int
+    :param shape: Grid shape (rows, columns)
+    :type shape: tuple
+    :param nstorms: Number of storms
+    :type nstorms: int
+    :param seed: Seed of the random number generator
+    :type seed: int
+    :param noise: Standard deviation of the background noise
+    :type noise: float
+    :param radius: Range of storm radii in pixels (uniformly distributed)
+    :type radius: tuple
+    :param peak: Range of storm peak values (uniformly distributed)
+    :type peak: tuple
+    :param speed: Mean storm displacement (x, y) in pixels per frame
+    :type speed: tuple
+    :param speed_spread: Standard deviation of the storm displacements (x, y)
+    :type speed_spread: tuple
+    :param growth: Standard deviation of the relative change of storm radius per frame
+    :type growth: float
+    :param split_rate: Probability per storm and frame that a storm splits off a smaller storm
+    :type split_rate: float
+    :param merge_rate: Probability per storm and frame that a storm turns towards its nearest storm to merge with it
+    :type merge_rate: float
+    :return: Generator of 2D fields
+    :rtype: generator
+    """
+    rng = np.random.default_rng(seed)
+    rows, cols = shape
+    cy = rng.uniform(0, rows, nstorms)
+    cx = rng.uniform(0, cols, nstorms)
+    radii = rng.uniform(radius[0], radius[1], nstorms)
+    peaks = rng.uniform(peak[0], peak[1], nstorms)
+    vy = rng.normal(speed[1], speed_spread[1], nstorms)
+    vx = rng.normal(speed[0], speed_spread[0], nstorms)
+    growths = rng.normal(0, growth, nstorms)
+    for nt in range(n):
+        if nt > 0:
+            cy, cx = cy + vy, cx + vx
+            radii = radii * (1. + growths)
+            if split_rate > 0:
+                # A split storm leaves a smaller storm behind, moving apart from it
+                split = np.flatnonzero(rng.random(np.size(cy)) < split_rate)
+                cy, cx = np.append(cy, cy[split]), np.append(cx, cx[split])
+                radii[split] = 0.8 * radii[split]
+                radii = np.append(radii, 0.8 * radii[split])
+                peaks, growths = np.append(peaks, peaks[split]), np.append(growths, growths[split])
+                vy = np.append(vy, vy[split] + rng.normal(0, speed_spread[1] + 1., np.size(split)))
+                vx = np.append(vx, vx[split] + rng.normal(0, speed_spread[0] + 1., np.size(split)))
+            if merge_rate > 0 and np.size(cy) > 1:
+                # A merging storm moves to its nearest storm in three frames
+                merge = np.flatnonzero(rng.random(np.size(cy)) < merge_rate)
+                nearest = spatial.cKDTree(np.column_stack((cy, cx))).query(
+                    np.column_stack((cy[merge], cx[merge])), k=2)[1][:, 1]
+                vy[merge] = vy[nearest] + (cy[nearest] - cy[merge]) / 3.
+                vx[merge] = vx[nearest] + (cx[nearest] - cx[merge]) / 3.
+        field = rng.normal(0, noise, shape)
+        for ns in range(np.size(cy)):
+            # Each storm only changes the grid within 4 radii of its centre
+            y0, x0, r = cy[ns], cx[ns], radii[ns]
+            if r <= 0:
+                continue
+            rowbox = slice(max(0, int(y0 - 4 * r)), min(rows, int(y0 + 4 * r) + 1))
+            colbox = slice(max(0, int(x0 - 4 * r)), min(cols, int(x0 + 4 * r) + 1))
+            if rowbox.start >= rowbox.stop or colbox.start >= colbox.stop:
+                continue
+            yy, xx = np.ogrid[rowbox, colbox]
+            field[rowbox, colbox] += peaks[ns] * np.exp(-((yy - y0) ** 2 + (xx - x0) ** 2) / (2 * r ** 2))
+        yield field
+
+
+def write_frame(filename, field, when=None, scale=32., full_shape=(600, 550), corner=(200, 250)):
+    """
+    Write a field as the example NetCDF data, so that user_functions.loadfile returns it.
+    The file is written under a hidden name and then renamed, so it appears complete.
+    :param filename: NetCDF file
+    :type filename: str
+    :param field: 2D field on the tracking grid
+    :type field: ndarray
+    :param when: Time stamp written to the time variable, none if not given
+    :type when: datetime.datetime
+    :param scale: The field is stored multiplied by scale
+    :type scale: float
+    :param full_shape: Shape of the stored variable
+    :type full_shape: tuple
+    :param corner: First indices of the window read by loadfile
+    :type corner: tuple
+    """
+    # Imported here so that the generator (and benchmark.py) does not need netCDF4
+    from netCDF4 import Dataset as ncfile
+    from netCDF4 import date2num
+
+    stored = np.zeros(full_shape, dtype=np.float32)
+    rows, cols = np.shape(field)
+    stored[corner[0]:corner[0] + cols, corner[1]:corner[1] + rows] = np.transpose(np.flipud(field)) * scale
+    tmpname = os.path.join(os.path.dirname(filename), '.' + os.path.basename(filename))
+    nc = ncfile(tmpname, 'w')
+    nc.createDimension('x', full_shape[0])
+    nc.createDimension('y', full_shape[1])
+    nc.createVariable('var', 'f4', ('x', 'y'))[:] = stored
+    if when is not None:
+        times = nc.createVariable('time', 'f8', ())
+        times.units = 'seconds since 1970-01-01 00:00:00'
+        times[...] = date2num(when, times.units)
+    nc.close()
+    os.replace(tmpname, filename)
+
+
+def produce(DATA_DIR, n, cadence, start_time, dt=5., seed=0, name='%Y%m%d_%H%M_s.nc', **kwargs):
+    """
+    Write synthetic frames at a fixed cadence
+    :param DATA_DIR: Directory to write the files to
+    :type DATA_DIR: str
+    :param n: Number of frames
+    :type n: int
+    :param cadence: Seconds between files
+    :type cadence: float
+    :param start_time: Time stamp of the first frame
+    :type start_time: datetime.datetime
+    :param dt: Minutes between time stamps of frames
+    :type dt: float
+    :param seed: Seed of the random number generator
+    :type seed: int
+    :param name: strftime format of the file names (loadfile reads the time identifier at [-9:-5])
+    :type name: str
+    :param kwargs: Passed to synthetic_frames
+    """
+    os.makedirs(DATA_DIR, exist_ok=True)
+    next_time = time.time()
+    for nt, field in enumerate(synthetic_frames(n, seed=seed, **kwargs)):
+        when = start_time + datetime.timedelta(minutes=dt * nt)
+        # Sleep until the file is due, a slow frame is written at once without moving later frames
+        time.sleep(max(0., next_time - time.time()))
+        write_frame(os.path.join(DATA_DIR, when.strftime(name)), field, when=when)
+        next_time = next_time + cadence
+
+
+if __name__ == '__main__':
+    ##################################################################
+    # STAND-IN PRODUCER OF A REAL-TIME DATA FEED FOR wrapper.py WITH watch_data
+    ##################################################################
+
+    # Directory the files are written to (DATA_DIR in wrapper.py)
+    DATA_DIR = './data/'
+
+    # Number of files and seconds between files
+    numfiles = 24
+    cadence = 5.
+
+    produce(DATA_DIR, numfiles, cadence, datetime.datetime(2012, 8, 25, 14, 5, 0))
@@ -0,0 +1,66 @@
+import os
+import sys
+import datetime
+import numpy as np
+import scipy.ndimage as ndimage
+
+# The modules of the repository are imported from its top directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import object_tracking
+import synthetic
+
+###################################################
+# SHARED TEST FIXTURES: STORM FIELDS AND LABELS, AND TRACKING
+# WITH THE EXAMPLE SETTINGS OF wrapper.py
+###################################################
+
+misval = -999
+settings = dict(squarelength=100., rafraction=0.01, dd_tolerance=3., halopixel=5., lapthresh=0.6, minpixel=4.,
+                threshold=3.)
+
+
+def storm_fields(n, shape=(300, 400), nstorms=60, seed=0, split_rate=0.05):
+    """
+    Rainfall fields of storms that move, split and merge (see synthetic.synthetic_frames)
+    :return: Generator of 2D fields
+    :rtype: generator
+    """
+    return synthetic.synthetic_frames(n, shape=shape, nstorms=nstorms, seed=seed, split_rate=split_rate,
+                                      merge_rate=0.05)
+
+
+def random_storms(rng, xmat, ymat):
+    """
+    Labels of random blobs and a storm table with their centroids
+    :return: Labels and storm table
+    :rtype: tuple
+    """
+    labels, numstorms = ndimage.label(ndimage.gaussian_filter(rng.random(xmat.shape), 1.5) > 0.55)
+    labels = labels.astype(np.int32)
+    StormData = object_tracking.StormTable(numstorms, misval)
+    for ns in range(numstorms):
+        pixels = labels == ns + 1
+        StormData.centroidx[ns] = np.mean(xmat[pixels])
+        StormData.centroidy[ns] = np.mean(ymat[pixels])
+    return labels, StormData
+
+
+def track_fields(fields, xmat, ymat, halopixel=settings['halopixel'], doradar=False, state=None):
+    """
+    Track consecutive fields 5 minutes apart with a Tracker, as wrapper.py does, continuing from
+    state (StormData, StormLabels, newwas) if given
+    :return: Generator of the tracking steps of every field, see Tracker.step
+    :rtype: generator
+    """
+    tracker = object_tracking.Tracker(xmat, ymat, squarelength=settings['squarelength'],
+                                      rafraction=settings['rafraction'], dd_tolerance=settings['dd_tolerance'],
+                                      halopixel=halopixel, lapthresh=settings['lapthresh'], misval=misval,
+                                      doradar=doradar)
+    start_time = datetime.datetime(2012, 8, 25, 14, 0)
+    if state is not None:
+        tracker.restore(*state, start_time - datetime.timedelta(minutes=5))
+    for nt, var in enumerate(fields):
+        labels = object_tracking.label_storms(var, settings['minpixel'], settings['threshold'], np.ones((3, 3)),
+                                              False)
+        yield tracker.step(var, labels, start_time + datetime.timedelta(minutes=5 * nt))
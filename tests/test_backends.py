@@ -0,0 +1,122 @@
+import datetime
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal
+import benchmark
+import kernels
+import object_tracking
+from conftest import misval, random_storms, storm_fields
+
+
+###################################################
+# THE LOOPS OF kernels (backend='numba') COMPARED WITH THE NUMPY CODE OF track_storms.
+# Without numba, jit leaves the kernels as plain Python functions, so the same
+# code paths are checked uncompiled. Tracker resolves 'numba' to 'numpy' if numba
+# is not installed, so the backend is set on the trackers after they are built.
+###################################################
+
+@pytest.mark.parametrize('seed', range(20))
+def test_advect_storms_backends(seed):
+    rng = np.random.default_rng(seed)
+    xmat, ymat = np.meshgrid(np.arange(rng.integers(20, 60)), np.arange(rng.integers(20, 60)))
+    labels, OldStormData = random_storms(rng, xmat, ymat)
+    if seed % 3 == 0:
+        # Integer centroids give exact ties between storms landing on the same pixel
+        OldStormData.centroidx = np.round(OldStormData.centroidx)
+        OldStormData.centroidy = np.round(OldStormData.centroidy)
+    newumat = rng.normal(0, 4, xmat.shape)
+    newvmat = rng.normal(0, 4, xmat.shape)
+    for jj in rng.choice(np.arange(1, len(OldStormData) + 1), size=min(len(OldStormData), 3), replace=False):
+        newumat[labels == jj] = 0.
+        newvmat[labels == jj] = 0.
+    QuvL, AdvectedStorms = object_tracking.advect_storms(OldStormData, labels, newumat, newvmat, xmat, ymat,
+                                                         backend='numpy')
+    numbaQuvL, numbaAdvected = object_tracking.advect_storms(OldStormData, labels, newumat, newvmat, xmat, ymat,
+                                                             backend='numba')
+    assert_array_equal(QuvL, numbaQuvL)
+    assert_array_equal(AdvectedStorms, numbaAdvected)
+
+
+def halo_reference(QuvL, xmat, ymat, centroidx, centroidy, orphans, halosq):
+    """(orphan storm, advected old storm label) of every pixel within a halo, with the strict test of track_storms"""
+    pairs = []
+    for ns in orphans:
+        inside = (QuvL > 0) & ((xmat - centroidx[ns]) ** 2 + (ymat - centroidy[ns]) ** 2 < halosq)
+        pairs.extend((ns, label) for label in QuvL[inside])
+    return sorted(pairs)
+
+
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('flipx', [False, True])
+@pytest.mark.parametrize('flipy', [False, True])
+def test_halo_search_descending_grid(seed, flipx, flipy):
+    rng = np.random.default_rng(seed)
+    xmat, ymat = np.meshgrid(np.arange(40) * 2., np.arange(30) * 2.)
+    if flipx:
+        xmat = xmat[:, ::-1]
+    if flipy:
+        ymat = ymat[::-1]
+    QuvL, StormData = random_storms(rng, xmat, ymat)
+    orphans = np.arange(len(StormData))
+    for halosq in [25., 100.]:
+        pairstorm, pairlabel = kernels.halo_search(QuvL, xmat, ymat, StormData.centroidx, StormData.centroidy,
+                                                   orphans, halosq)
+        assert sorted(zip(pairstorm, pairlabel)) == halo_reference(QuvL, xmat, ymat, StormData.centroidx,
+                                                                   StormData.centroidy, orphans, halosq)
+
+
+def test_tracker_rejects_descending_grid():
+    xmat, ymat = np.meshgrid(range(-200, 200), range(-150, 150))
+    with pytest.raises(ValueError, match='increasing'):
+        object_tracking.Tracker(xmat, ymat[::-1])
+    with pytest.raises(ValueError, match='increasing'):
+        object_tracking.Tracker(xmat[:, ::-1], ymat)
+
+
+def track_both(frames, halopixel):
+    """Track the same frames with a numpy and a numba tracker, yielding both TrackSteps of every image"""
+    xmat, ymat = np.meshgrid(range(-200, 200), range(-150, 150))
+    trackers = [object_tracking.Tracker(xmat, ymat, halopixel=halopixel),
+                object_tracking.Tracker(xmat, ymat, halopixel=halopixel)]
+    trackers[1].backend = 'numba'
+    init_time = datetime.datetime(2012, 8, 25, 14, 5)
+    for nt, var in enumerate(frames):
+        var = var.astype(np.float32)
+        labels = object_tracking.label_storms(var, 4., 3., np.ones((3, 3)), False)
+        now_time = init_time + datetime.timedelta(minutes=5 * nt)
+        yield [tracker.step(var, labels.copy(), now_time) for tracker in trackers]
+
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('halopixel', [5., 15.])
+def test_track_storms_backends(seed, halopixel):
+    names = object_tracking.StormTable.columns + [name + suffix for name in object_tracking.StormTable.lineage
+                                                  for suffix in ['_offsets', '_values']]
+    merged, split = False, False
+    frames = storm_fields(6, seed=seed)
+    for full, other in track_both(frames, halopixel):
+        for name in names:
+            assert_array_equal(getattr(full.StormData, name), getattr(other.StormData, name), err_msg=name)
+        for name in ['wasarray', 'lifearray', 'newwas', 'newumat', 'newvmat']:
+            assert_array_equal(getattr(full, name), getattr(other, name), err_msg=name)
+        merged = merged or np.any(full.StormData.accreted_values != misval)
+        split = split or np.any(full.StormData.child != misval)
+    # The lineage loops (clean_accreted, split_storms) were used
+    assert merged and split
+
+
+def test_resolve_backend(monkeypatch):
+    assert kernels.resolve_backend('numpy') == 'numpy'
+    with pytest.raises(ValueError):
+        kernels.resolve_backend('cython')
+    monkeypatch.setattr(kernels, 'numba', None)
+    assert kernels.resolve_backend('numba') == 'numpy'
+    assert kernels.resolve_backend('auto') == 'numpy'
+
+
+@pytest.mark.skipif(kernels.numba is None, reason='numba is not installed')
+def test_compare_backends_compiled():
+    frames = storm_fields(6, seed=0)
+    result = benchmark.compare_backends(frames)
+    assert result['storms'] > 0
+    assert result['difference'] is None
@@ -0,0 +1,31 @@
+import datetime
+import numpy as np
+from numpy.testing import assert_array_equal
+import object_tracking
+import storm_io
+from conftest import storm_fields, track_fields
+
+
+def test_checkpoint_resumes_identically(tmp_path):
+    xmat, ymat = np.meshgrid(range(-200, 200), range(-150, 150))
+    fields = list(storm_fields(7, seed=3))
+    steps = list(track_fields(fields, xmat, ymat, doradar=True))
+    filename = str(tmp_path / 'checkpoint.npz')
+    now_time = datetime.datetime(2012, 8, 25, 14, 20)
+    saved = steps[3]
+    storm_io.write_checkpoint(filename, 3, now_time, saved.StormData, saved.StormLabels, saved.newwas, 14., 20.)
+
+    state = storm_io.read_checkpoint(filename)
+    assert (state['nt'], state['now_time'], state['newwas'], state['hourval'], state['minval']) == \
+           (3, now_time, saved.newwas, 14., 20.)
+    assert_array_equal(state['StormLabels'], saved.StormLabels)
+    resumed = track_fields(fields[4:], xmat, ymat, doradar=True,
+                           state=(state['StormData'], state['StormLabels'], state['newwas']))
+    names = object_tracking.StormTable.columns + object_tracking.StormTable.radar_columns + \
+        [name + suffix for name in object_tracking.StormTable.lineage for suffix in ['_offsets', '_values']]
+    for step, continued in zip(steps[4:], resumed):
+        # Storms of the next images, with their ids and lineage, are the same as without the checkpoint
+        assert step.newwas == continued.newwas
+        assert_array_equal(step.wasarray, continued.wasarray)
+        for name in names:
+            assert_array_equal(getattr(step.StormData, name), getattr(continued.StormData, name), err_msg=name)
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from numpy.lib.stride_tricks import sliding_window_view
+import benchmark
+import object_tracking
+from conftest import storm_fields
+
+
+###################################################
+# THE FLOAT32 (COMPACT) DISPLACEMENT CALCULATION
+# COMPARED WITH FLOAT64
+###################################################
+
+def square_displacements(field1, field2, dtype, squarelength=100, fftpixels=100.):
+    """Displacements (buu, bvv) of the squares of two storm masks that pass fftpixels, as in track_storms"""
+    masks = [(object_tracking.label_storms(field, 4., 3., np.ones((3, 3)), False) >= 1).astype(np.uint8)
+             for field in [field1, field2]]
+    squarehalf = squarelength // 2
+    squares = [sliding_window_view(mask, (squarelength, squarelength))[::squarehalf, ::squarehalf].reshape(
+        -1, squarelength, squarelength) for mask in masks]
+    passed = (np.sum(squares[0], axis=(1, 2)) >= fftpixels) & (np.sum(squares[1], axis=(1, 2)) >= fftpixels)
+    spec1, energy1 = object_tracking.tile_spectra(squares[0][passed], 1, dtype=dtype)
+    spec2, energy2 = object_tracking.tile_spectra(squares[1][passed], 1, dtype=dtype)
+    buu, bvv, bww = object_tracking.correlate_spectra(spec1, energy1, spec2, energy2, (squarelength, squarelength))
+    return buu, bvv, bww
+
+
+def test_compact_square_displacements():
+    numsquares, numdiffer = 0, 0
+    for seed in range(4):
+        frames = list(storm_fields(4, nstorms=80, seed=seed))
+        for field1, field2 in zip(frames[:-1], frames[1:]):
+            buu, bvv, bww = square_displacements(field1, field2, np.float64)
+            cuu, cvv, cww = square_displacements(field1, field2, np.float32)
+            assert cww.dtype == np.float32
+            difference = np.maximum(np.abs(buu - cuu), np.abs(bvv - cvv))
+            # Only near-equal correlation peaks can resolve differently, to a neighbouring pixel
+            assert np.max(difference, initial=0) <= 1
+            assert np.allclose(bww, cww, atol=1e-5)
+            numsquares += np.size(difference)
+            numdiffer += np.count_nonzero(difference)
+    assert numsquares > 100
+    assert numdiffer <= 0.01 * numsquares
+
+
+@pytest.mark.parametrize('case', [dict(shape=(300, 400), nstorms=40, seed=0),
+                                  dict(shape=(300, 400), nstorms=60, seed=1, split_rate=0.05, merge_rate=0.05),
+                                  dict(shape=(600, 800), nstorms=200, seed=2, split_rate=0.03, merge_rate=0.03)])
+def test_compact_tracks(case):
+    result = benchmark.compare_compact(frames=6, **case)
+    assert result['storms'] > 100
+    # Displacement fields in pixels on the full grid
+    assert result['mean_field_difference'] < 0.01
+    assert result['max_field_difference'] < 2.
+    # Displacements written to the histories (dx, dy) and links to previous storms
+    assert result['max_storm_difference'] < 1.5
+    assert result['same_links'] >= 0.99
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+import scipy.fft as fft
+import scipy.ndimage as ndimage
+import object_tracking
+
+
+###################################################
+# DISPLACEMENTS FROM THE BATCHED FFT CORRELATION OF SQUARES
+###################################################
+
+def exact_displacement(s1, s2):
+    """First maximum in row-major order of the correlation of two squares, computed in long double precision"""
+    leno = np.size(s1, 0)
+    window = object_tracking.square_window(leno, 1).astype(np.longdouble)
+    a, b = s1 * window, s2 * window
+    a, b = a - np.mean(a), b - np.mean(b)
+    ffv = fft.irfft2(fft.rfft2(b) * fft.rfft2(a).conj(), s=np.shape(s1))
+    # Equal maxima differ by long double rounding only
+    dy, dx = np.unravel_index(np.argmax(ffv.ravel() >= np.max(ffv) * (1 - 1e-15)), np.shape(s1))
+    return dx - leno if dx > leno / 2 else dx, dy - leno if dy > leno / 2 else dy
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_batched_displacements_match_exact(seed):
+    # Masks of blobs often have several equal correlation maxima, the first one is taken as in exact arithmetic
+    rng = np.random.default_rng(seed)
+    squares1, squares2 = [], []
+    for nn in range(60):
+        s1 = (ndimage.gaussian_filter(rng.random((100, 100)), rng.uniform(1, 4)) > rng.uniform(0.5, 0.6)) * 1.
+        s2 = np.roll(s1, tuple(rng.integers(-8, 8, 2)), axis=(0, 1))
+        s2 = np.where(rng.random((100, 100)) < 0.01, 1. - s2, s2)
+        squares1.append(s1)
+        squares2.append(s2)
+    spec1, energy1 = object_tracking.tile_spectra(np.array(squares1), 1)
+    spec2, energy2 = object_tracking.tile_spectra(np.array(squares2), 1)
+    dx, dy, amp = object_tracking.correlate_spectra(spec1, energy1, spec2, energy2, (100, 100))
+    assert list(zip(dx, dy)) == [exact_displacement(s1, s2) for s1, s2 in zip(squares1, squares2)]
+
+
+@pytest.mark.parametrize('dtype, gap', [(np.float64, 0.), (np.float64, 1e-9), (np.float32, 0.),
+                                        (np.float32, 1e-4)])
+def test_near_equal_peaks(dtype, gap):
+    # Two peaks of the correlation at dx = 5 (first in row-major order) and dx = -5, the second larger by gap.
+    # Only values within the rounding of the FFT (in the precision of the spectra) count as equal.
+    s1 = np.zeros((100, 100))
+    s1[50, 50] = 1.
+    s2 = np.zeros((100, 100))
+    s2[50, 55] = 1.
+    s2[50, 45] = 1. + gap
+    spec1, energy1 = object_tracking.tile_spectra(s1[np.newaxis], 1, dtype=dtype)
+    spec2, energy2 = object_tracking.tile_spectra(s2[np.newaxis], 1, dtype=dtype)
+    dx, dy, amp = object_tracking.correlate_spectra(spec1, energy1, spec2, energy2, (100, 100))
+    assert (dx[0], dy[0]) == ((5, 0) if gap == 0. else (-5, 0))
@@ -0,0 +1,59 @@
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+import object_tracking
+
+
+def test_fill_single_gap_with_mean_of_neighbours():
+    buu = np.array([[1., 2., 3.],
+                    [4., np.nan, 6.],
+                    [7., 8., 9.]])
+    filled = object_tracking.fill_speeds(buu)
+    assert_allclose(filled[1, 1], 5.)
+    # Valid displacements are kept, the input is not changed
+    assert_array_equal(np.delete(filled.ravel(), 4), np.delete(buu.ravel(), 4))
+    assert np.isnan(buu[1, 1])
+
+
+def test_fill_corner_has_fewer_neighbours():
+    buu = np.array([[np.nan, 2., 3.],
+                    [4., 5., 6.],
+                    [7., 8., 9.]])
+    assert_allclose(object_tracking.fill_speeds(buu)[0, 0], (2. + 4. + 5.) / 3.)
+
+
+def test_fill_repeats_until_no_gaps():
+    buu = np.array([[2., 4., np.nan, np.nan],
+                    [6., 10., np.nan, np.nan]])
+    # The third column is filled from the first two, the last column from the filled third column
+    expected = np.array([[2., 4., 7., 7.],
+                         [6., 10., 7., 7.]])
+    assert_allclose(object_tracking.fill_speeds(buu), expected)
+
+
+def test_fill_too_few_displacements_gives_zeros():
+    buu = np.full((3, 4), np.nan)
+    buu[0, 0], buu[1, 2], buu[2, 3] = 1., 2., 3.
+    assert_array_equal(object_tracking.fill_speeds(buu), np.zeros((3, 4)))
+
+
+def test_neighbour_mean_ignores_missing_values():
+    buu = np.array([[np.nan, 1., np.nan],
+                    [3., np.nan, np.nan],
+                    [np.nan, np.nan, np.nan]])
+    mean = object_tracking.neighbour_mean(buu)
+    assert_allclose(mean[1, 1], 2.)
+    assert_allclose(mean[0, 0], 2.)
+    assert_allclose(mean[2, 2], np.nan)
+
+
+def test_interpolate_constant_speeds():
+    # Displacement grid of the example in wrapper.py, the spline weights reproduce constant fields
+    xmat, ymat = np.meshgrid(range(-200, 200), range(-150, 150))
+    xint, yint = np.meshgrid(range(-150, 200, 50), range(-100, 150, 50))
+    buu = np.full(xint.shape, 3.)
+    bvv = np.full(xint.shape, -2.)
+    buu[1, 2] = bvv[0, 0] = np.nan
+    newumat, newvmat = object_tracking.interpolate_speeds(xint, yint, xmat, ymat, buu, bvv)
+    assert newumat.shape == xmat.shape
+    assert_allclose(newumat, 3., atol=1e-12)
+    assert_allclose(newvmat, -2., atol=1e-12)
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+import scipy.ndimage as ndimage
+from numpy.testing import assert_array_equal
+import object_tracking
+
+
+###################################################
+# label_storms COMPARED WITH LABELLING TWICE (THE PREVIOUS IMPLEMENTATION)
+###################################################
+
+def two_pass_labels(bt, minarea, threshold, struct, under_threshold):
+    """Label, remove features smaller than minarea and label again"""
+    binbt = np.zeros_like(bt)
+    if under_threshold:
+        binbt[np.where(bt < threshold)] = 1
+    else:
+        binbt[np.where(bt > threshold)] = 1
+    id_regions, num_ids = ndimage.label(binbt, structure=struct)
+    id_sizes = np.array(ndimage.sum(binbt, id_regions, range(num_ids + 1)))
+    binbt[(id_sizes < minarea)[id_regions]] = 0
+    return ndimage.label(binbt, structure=struct)[0]
+
+
+def random_field(rng, shape=(120, 150)):
+    return ndimage.gaussian_filter(rng.random(shape), rng.uniform(0.5, 3.)) * 10.
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('struct', [np.ones((3, 3)), ndimage.generate_binary_structure(2, 1)], ids=['8', '4'])
+@pytest.mark.parametrize('under_threshold', [False, True])
+def test_label_storms_matches_two_passes(seed, struct, under_threshold):
+    rng = np.random.default_rng(seed)
+    bt = random_field(rng)
+    threshold = np.quantile(bt, 0.3 if under_threshold else 0.7)
+    if seed % 4 == 0:
+        # Missing data are never part of a storm
+        bt[rng.random(bt.shape) < 0.05] = np.nan
+    labels = object_tracking.label_storms(bt, 20, threshold, struct, under_threshold)
+    assert labels.dtype == np.int32
+    assert_array_equal(labels, two_pass_labels(bt, 20, threshold, struct, under_threshold))
+
+
+def test_label_storms_reuses_buffers():
+    # As in wrapper.py, two buffers alternate so that the labels of the previous image stay intact
+    rng = np.random.default_rng(0)
+    buffers = [np.empty((120, 150), dtype=np.int32) for nn in range(2)]
+    previous = None
+    for nt in range(6):
+        bt = random_field(rng)
+        threshold = np.quantile(bt, 0.7)
+        labels = object_tracking.label_storms(bt, 20, threshold, np.ones((3, 3)), False, output=buffers[nt % 2])
+        assert labels is buffers[nt % 2]
+        assert_array_equal(labels, two_pass_labels(bt, 20, threshold, np.ones((3, 3)), False))
+        if previous is not None:
+            assert_array_equal(buffers[(nt - 1) % 2], previous)
+        previous = labels.copy()
+
+
+def seam_field(nrows=60, ncols=80):
+    """Storms cut by the seams between strips: a storm crossing every strip, a U that is only joined below a seam,
+    a storm touching a seam diagonally and a storm of minimum area split by a seam"""
+    bt = np.zeros((nrows, ncols))
+    bt[:, 5:7] = 10.
+    bt[10:40, 20:22] = 10.
+    bt[10:40, 30:32] = 10.
+    bt[38:40, 20:32] = 10.
+    for row in range(0, nrows):
+        bt[row, 40 + row % 20] = 10.
+    bt[28:32, 70:72] = 10.
+    bt[29:31, 75] = 10.
+    return bt
+
+
+@pytest.mark.parametrize('tiles', [2, 3, 7, 50, 100])
+@pytest.mark.parametrize('struct', [np.ones((3, 3)), ndimage.generate_binary_structure(2, 1),
+                                    np.array([[0, 0, 1], [0, 1, 0], [1, 0, 0]])], ids=['8', '4', 'diagonal'])
+def test_label_strips_join_storms_across_seams(tiles, struct):
+    bt = seam_field()
+    labels = object_tracking.label_storms(bt, 5, 5., struct, False, tiles=tiles, workers=3)
+    assert_array_equal(labels, object_tracking.label_storms(bt, 5, 5., struct, False))
+    if struct.sum() > 3:
+        # One storm through all strips, the U is a single storm
+        assert np.unique(labels[:, 5]).tolist() == [labels[0, 5]]
+        assert labels[10, 20] == labels[10, 30]
+
+
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('tiles', [2, 3, 7])
+def test_label_strips_match_whole_grid(seed, tiles):
+    rng = np.random.default_rng(seed)
+    bt = random_field(rng)
+    threshold = np.quantile(bt, 0.6)
+    for struct in [np.ones((3, 3)), ndimage.generate_binary_structure(2, 1)]:
+        labels = object_tracking.label_storms(bt, 20, threshold, struct, False, tiles=tiles, workers=2)
+        assert_array_equal(labels, object_tracking.label_storms(bt, 20, threshold, struct, False))
@@ -0,0 +1,152 @@
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose, assert_array_equal
+import object_tracking
+from conftest import settings, storm_fields, random_storms, track_fields
+
+
+###################################################
+# THE VECTORISED ADVECTION, OVERLAP AND MATCHING OF track_storms
+# COMPARED WITH THE PER-STORM LOOPS THEY REPLACED
+###################################################
+
+def loop_advect(OldStormData, OldStormLabels, newumat, newvmat, xmat, ymat):
+    """Advection of the old storm labels, moving one pixel at a time (the loop of track_storms before advect_storms)"""
+    newlabel = np.zeros(OldStormLabels.shape)
+    for ns in range(len(OldStormData)):
+        jj = OldStormData[ns].storm
+        labelind = np.where(OldStormLabels == jj)
+        dx = np.mean(newumat[labelind])
+        dy = np.mean(newvmat[labelind])
+        if dx == 0.0 and dy == 0.0:
+            newlabel[labelind] = jj
+        else:
+            for ii in range(np.size(labelind, 1)):
+                newyind = labelind[1][ii] + int(np.around(dx))
+                newxind = labelind[0][ii] + int(np.around(dy))
+                if newxind > np.size(newlabel, 0) - 1 \
+                        or newyind > np.size(newlabel, 1) - 1 or newxind < 0 or newyind < 0:
+                    continue
+                elif newlabel[newxind, newyind] > 0:
+                    nq = int(newlabel[newxind, newyind] - 1)
+                    olddist = (xmat[newxind, newyind] - OldStormData[nq].centroidx) ** 2 + (
+                            ymat[newxind, newyind] - OldStormData[nq].centroidy) ** 2
+                    newdist = (xmat[newxind, newyind] - OldStormData[ns].centroidx) ** 2 + (
+                            ymat[newxind, newyind] - OldStormData[ns].centroidy) ** 2
+                    if newdist < olddist:
+                        newlabel[newxind, newyind] = jj
+                else:
+                    newlabel[newxind, newyind] = jj
+
+    QuvL = newlabel
+    AdvectedStorms = np.zeros([len(OldStormData), 3])
+    for ns in range(len(OldStormData)):
+        jj = OldStormData[ns].storm
+        centrind = np.where(QuvL == jj)
+        if np.size(centrind, 1) == 0:
+            continue
+        AdvectedStorms[ns][0] = np.mean(xmat[centrind])
+        AdvectedStorms[ns][1] = np.mean(ymat[centrind])
+        AdvectedStorms[ns][2] = int(np.size(centrind, 1))
+    return QuvL, AdvectedStorms
+
+
+def loop_matches(OldStormLabels, StormLabels, StormData, QuvL, AdvectedStorms, xmat, ymat, halosq, lapthresh):
+    """
+    Old storm continued by each new storm, found with a histogram of the advected labels over each new storm
+    (and its halo if the overlap is too small), as the matching loop of track_storms did before overlap_matrix
+    :return: Index of the old storm each new storm continues, -1 for new storms
+    :rtype: list
+    """
+    qbins = range(int(np.max(OldStormLabels)) + 2)
+    qarea = np.ones([int(np.max(OldStormLabels)) + 1])
+    for qq in range(np.size(AdvectedStorms, 0)):
+        if AdvectedStorms[qq, 2] > 0:
+            qarea[qq + 1] = AdvectedStorms[qq, 2]
+    matches = []
+    for ns in range(int(np.max(StormLabels))):
+        jj = ns + 1
+        counts = np.histogram(QuvL[np.where(StormLabels == jj)], qbins)[0]
+        qhist = counts / float(StormData.area[ns]) + counts / qarea
+        if np.max(qhist[1:]) < lapthresh:
+            blobind = np.where((xmat - StormData.centroidx[ns]) ** 2 + (ymat - StormData.centroidy[ns]) ** 2 < halosq)
+            counts = np.histogram(QuvL[blobind], qbins)[0]
+            qhist = counts / float(StormData.area[ns]) + counts / qarea
+        if np.max(qhist[1:]) < lapthresh:
+            matches.append(-1)
+            continue
+        numlaps = np.flatnonzero(qhist[1:] >= lapthresh)
+        if np.size(numlaps) == 1:
+            matches.append(numlaps[0])
+            continue
+        lapdist = np.sqrt((StormData.centroidx[ns] - AdvectedStorms[numlaps, 0]) ** 2 +
+                          (StormData.centroidy[ns] - AdvectedStorms[numlaps, 1]) ** 2)
+        sectlap = np.array([np.count_nonzero((QuvL == qq + 1) & (StormLabels == jj)) for qq in numlaps])
+        kmax = np.flatnonzero(sectlap == np.max(sectlap))
+        if np.size(kmax) > 1:
+            kkmax = kmax[np.flatnonzero(lapdist[kmax] == np.min(lapdist[kmax]))]
+            kkmax = kmax[kkmax[0]] if np.size(kkmax) > 1 else kkmax[0]
+        else:
+            kkmax = kmax[0]
+        matches.append(numlaps[kkmax])
+    return matches
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('spacing', [1., 0.5])
+def test_advect_storms_matches_loop(seed, spacing):
+    rng = np.random.default_rng(seed)
+    xmat, ymat = np.meshgrid(np.arange(rng.integers(20, 60)) * spacing, np.arange(rng.integers(20, 60)))
+    labels, OldStormData = random_storms(rng, xmat, ymat)
+    if seed % 3 == 0:
+        # Integer centroids give exact ties between storms landing on the same pixel
+        OldStormData.centroidx = np.round(OldStormData.centroidx)
+        OldStormData.centroidy = np.round(OldStormData.centroidy)
+    newumat = rng.normal(0, 4, xmat.shape)
+    newvmat = rng.normal(0, 4, xmat.shape)
+    # Some storms do not move
+    for jj in rng.choice(np.arange(1, len(OldStormData) + 1), size=min(len(OldStormData), 3), replace=False):
+        newumat[labels == jj] = 0.
+        newvmat[labels == jj] = 0.
+
+    QuvL, AdvectedStorms = object_tracking.advect_storms(OldStormData, labels, newumat, newvmat, xmat, ymat)
+    loopQuvL, loopAdvected = loop_advect(OldStormData, labels, newumat, newvmat, xmat, ymat)
+    assert_array_equal(QuvL, loopQuvL)
+    # Centroids are summed in a different order
+    assert_allclose(AdvectedStorms, loopAdvected, rtol=1e-13, atol=1e-13)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_overlap_matrix_matches_histograms(seed):
+    rng = np.random.default_rng(seed)
+    xmat, ymat = np.meshgrid(np.arange(50), np.arange(40))
+    QuvL, _ = random_storms(rng, xmat, ymat)
+    StormLabels, _ = random_storms(rng, xmat, ymat)
+    numold, numnew = int(np.max(QuvL)), int(np.max(StormLabels))
+    overlap = object_tracking.overlap_matrix(QuvL, StormLabels, numold, numnew).toarray()
+    for jj in range(1, numnew + 1):
+        counts = np.histogram(QuvL[StormLabels == jj], range(numold + 2))[0]
+        # Row 0 (no advected storm) is not stored
+        assert_array_equal(overlap[1:, jj], counts[1:])
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_track_storms_matches_loop(seed):
+    xmat, ymat = np.meshgrid(range(-200, 200), range(-150, 150))
+    previous = None
+    matched = 0
+    for tracked in track_fields(storm_fields(6, seed=seed), xmat, ymat):
+        StormData, labels = tracked.StormData, tracked.StormLabels
+        if previous is not None:
+            OldStormData, OldLabels = previous
+            QuvL, AdvectedStorms = loop_advect(OldStormData, OldLabels, tracked.newumat, tracked.newvmat, xmat, ymat)
+            matches = loop_matches(OldLabels, labels, StormData, QuvL, AdvectedStorms, xmat, ymat,
+                                   settings['halopixel'] ** 2, settings['lapthresh'])
+            # Storms that split off keep the id of the old storm as child, the others continue its id
+            oldwas = {was: qq for qq, was in enumerate(OldStormData.was.tolist())}
+            links = [oldwas.get(was, oldwas.get(child, -1))
+                     for was, child in zip(StormData.was.tolist(), StormData.child.tolist())]
+            assert links == [int(qq) for qq in matches]
+            matched += sum(qq >= 0 for qq in links)
+        previous = (StormData, labels)
+    assert matched > 0
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal
+import object_tracking
+from conftest import random_storms
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_extents_match_radar_extents(seed):
+    rng = np.random.default_rng(seed)
+    xmat, ymat = np.meshgrid(np.arange(-40, 41), np.arange(-30, 51))
+    labels = random_storms(rng, xmat, ymat)[0]
+    # A storm at the radar, rings around it (one with its centroid south of the radar) and a storm crossing north,
+    # apart from the random storms
+    labels[(xmat ** 2 + ymat ** 2 < 15 ** 2) | ((np.abs(xmat) < 8) & (ymat > 23) & (ymat < 34))] = 0
+    labels[(xmat ** 2 + ymat ** 2 <= 4)] = np.max(labels) + 1
+    labels[(np.abs(np.sqrt(xmat ** 2 + ymat ** 2) - 7) < 1 + (ymat < 0))] = np.max(labels) + 1
+    labels[(np.abs(np.sqrt(xmat ** 2 + ymat ** 2) - 12) < 1)] = np.max(labels) + 1
+    labels[(np.abs(xmat) < 6) & (ymat > 25) & (ymat < 32)] = np.max(labels) + 1
+    labels = object_tracking.label_storms(labels, 1, 0, np.ones((3, 3)), False)
+    numstorms = int(np.max(labels))
+    centroidx = np.array([np.mean(xmat[labels == ns + 1]) for ns in range(numstorms)])
+    centroidy = np.array([np.mean(ymat[labels == ns + 1]) for ns in range(numstorms)])
+    radar = object_tracking.RadarGeometry(xmat, ymat)
+
+    extents = radar.extents(labels, centroidx, centroidy)
+    expected = np.array([object_tracking.radar_extents(ns + 1, labels, xmat, ymat, centroidx[ns], centroidy[ns],
+                                                       radar.rarray, radar.azarray) for ns in range(numstorms)])
+    for nn in range(4):
+        assert_array_equal(extents[nn], expected[:, nn])
+    rangel, rangeu, azimuthl, azimuthu = extents
+    # Storms crossing north have azimuthl > azimuthu, the storm at the radar and the open ring cover all azimuths
+    assert np.count_nonzero(azimuthl > azimuthu) >= 2
+    assert np.any((rangel == 0) & (azimuthl == 0) & (azimuthu == 360))
+    assert np.any((rangel > 0) & (azimuthl == 0) & (azimuthu == 360))
+
+
+def test_extents_without_storms():
+    xmat, ymat = np.meshgrid(np.arange(-10, 11), np.arange(-10, 11))
+    extents = object_tracking.RadarGeometry(xmat, ymat).extents(np.zeros(xmat.shape, dtype=np.int32), [], [])
+    assert [np.size(values) for values in extents] == [0, 0, 0, 0]
@@ -0,0 +1,37 @@
+import os
+import time
+import realtime
+
+
+def touch(path, age):
+    with open(path, 'w') as fw:
+        fw.write('data')
+    modified = time.time() - age
+    os.utime(path, (modified, modified))
+
+
+def test_watch_directory_waits_for_unsettled_files(tmp_path):
+    touch(tmp_path / 'a.nc', 100.)
+    touch(tmp_path / 'b.nc', 0.)
+    touch(tmp_path / 'c.nc', 100.)
+    touch(tmp_path / '.d.nc', 100.)
+    arrivals = realtime.watch_directory(str(tmp_path), poll_interval=0.01, settle=10., idle_timeout=0.2)
+    assert next(arrivals) == 'a.nc'
+    # b.nc is still being written, so c.nc waits for it
+    touch(tmp_path / 'b.nc', 100.)
+    assert next(arrivals) == 'b.nc'
+    assert next(arrivals) == 'c.nc'
+    touch(tmp_path / 'e.nc', 100.)
+    assert next(arrivals) == 'e.nc'
+    assert list(arrivals) == []
+
+
+def test_watch_directory_reports_late_files(tmp_path, capsys):
+    touch(tmp_path / 'a.nc', 100.)
+    touch(tmp_path / 'c.nc', 100.)
+    arrivals = realtime.watch_directory(str(tmp_path), poll_interval=0.01, settle=10., idle_timeout=0.2)
+    assert [next(arrivals), next(arrivals)] == ['a.nc', 'c.nc']
+    touch(tmp_path / 'b.nc', 100.)
+    touch(tmp_path / 'd.nc', 100.)
+    assert list(arrivals) == ['d.nc']
+    assert capsys.readouterr().out.count('b.nc arrived after c.nc') == 1
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal
+import object_tracking
+import segments
+from conftest import misval, settings, storm_fields, track_fields
+
+
+def timediff(oldh, oldm, newh, newm):
+    return 60. * (newh - oldh) + newm - oldm
+
+
+def segment_settings(fields, times, xmat, ymat):
+    """Settings of track_segment as in conftest.track_fields, loadfile looks up the fields by file name"""
+    images = {'%04d' % nt: (fields[nt], '%04d' % nt) + times[nt] for nt in range(len(fields))}
+    tracker = object_tracking.Tracker(xmat, ymat, squarelength=settings['squarelength'],
+                                      rafraction=settings['rafraction'], dd_tolerance=settings['dd_tolerance'],
+                                      halopixel=settings['halopixel'], lapthresh=settings['lapthresh'], misval=misval,
+                                      dt=5., dt_tolerance=15., timediff=timediff)
+    return dict(loadfile=images.get, minpixel=settings['minpixel'], threshold=settings['threshold'],
+                struct2d=np.ones((3, 3)), under_t=False, tracker=tracker)
+
+
+def stitched_run(filenames, times, segment_settings, max_length):
+    """Track and stitch the segments one after the other, as run_segments does in a pool of processes"""
+    frames, newwas, last = [], 1, None
+    for start, stop, overlap in segments.split_segments(times, timediff, segment_settings['tracker'].dt_tolerance,
+                                                        max_length=max_length):
+        stitched, newwas = segments.stitch_segment(segments.track_segment(filenames[start:stop], segment_settings),
+                                                   newwas, misval, overlap=last if overlap else None)
+        frames.extend(stitched)
+        last = stitched[-1][2]
+    return frames
+
+
+def assert_same_storms(StormData, continuous):
+    assert len(StormData) == len(continuous)
+    for name in ['was', 'life', 'child', 'area', 'centroidx', 'centroidy', 'dx', 'dy']:
+        assert_array_equal(getattr(StormData, name), getattr(continuous, name), err_msg=name)
+    for name in object_tracking.StormTable.lineage:
+        for ns in range(len(continuous)):
+            assert StormData.get_lineage(name, ns) == continuous.get_lineage(name, ns)
+
+
+def test_split_segments():
+    times = [(14, 5 * nt) for nt in range(7)] + [(15, 5 * nt) for nt in range(3)]
+    assert segments.split_segments(times, timediff, 15.) == [(0, 7, False), (7, 10, False)]
+    assert segments.split_segments(times, timediff, 15., max_length=3) == [(0, 3, False), (2, 5, True),
+                                                                           (4, 7, True), (7, 10, False)]
+    with pytest.raises(ValueError):
+        segments.split_segments(times, timediff, 15., max_length=1)
+
+
+@pytest.mark.parametrize('max_length', [2, 3, 5])
+def test_stitched_segments_match_continuous_run(max_length):
+    xmat, ymat = np.meshgrid(range(-200, 200), range(-150, 150))
+    fields = list(storm_fields(8, seed=3))
+    times = [(14., 5. * nt) for nt in range(len(fields))]
+    filenames = ['%04d' % nt for nt in range(len(fields))]
+    frames = stitched_run(filenames, times, segment_settings(fields, times, xmat, ymat), max_length)
+    continuous = list(track_fields(fields, xmat, ymat))
+    assert any(np.any(step.StormData.child != misval) for step in continuous)
+    assert [file_ID for file_ID, newwas, StormData in frames] == filenames
+    for (file_ID, newwas, StormData), step in zip(frames, continuous):
+        assert newwas == step.newwas
+        assert_same_storms(StormData, step.StormData)
+
+
+def test_data_gap_starts_new_tracks():
+    # Unlike the loop in wrapper.py, the image after the gap is tracked and ids keep counting up
+    xmat, ymat = np.meshgrid(range(-200, 200), range(-150, 150))
+    fields = list(storm_fields(7, seed=4))
+    times = [(14., 5. * nt) for nt in range(4)] + [(15., 5. * nt) for nt in range(3)]
+    filenames = ['%04d' % nt for nt in range(len(fields))]
+    frames = stitched_run(filenames, times, segment_settings(fields, times, xmat, ymat), 3)
+    before = list(track_fields(fields[:4], xmat, ymat))
+    after = list(track_fields(fields[4:], xmat, ymat))
+    offset = before[-1].newwas - 1
+    expected = [(step.newwas, step.StormData) for step in before]
+    for step in after:
+        StormData = step.StormData
+        StormData.was = StormData.was + offset
+        StormData.child = np.where(StormData.child != misval, StormData.child + offset, misval)
+        for name in StormData.lineage:
+            values = getattr(StormData, name + '_values')
+            setattr(StormData, name + '_values', np.where(values != misval, values + offset, misval))
+        expected.append((step.newwas + offset, StormData))
+    for (file_ID, newwas, StormData), (continuous_newwas, continuous) in zip(frames, expected):
+        assert newwas == continuous_newwas
+        assert_same_storms(StormData, continuous)
+
+
+def test_segment_with_gap_in_loaded_times_raises():
+    xmat, ymat = np.meshgrid(range(-200, 200), range(-150, 150))
+    fields = list(storm_fields(3, seed=5))
+    loaded = [(14., 0.), (14., 5.), (15., 0.)]
+    with pytest.raises(ValueError, match='too far apart'):
+        segments.track_segment(['0000', '0001', '0002'], segment_settings(fields, loaded, xmat, ymat))
@@ -0,0 +1,158 @@
+import os
+import filecmp
+import datetime
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose, assert_array_equal
+import object_tracking
+import storm_io
+from conftest import misval, storm_fields, track_fields
+
+init_time = datetime.datetime(2012, 8, 25, 14, 5)
+
+
+@pytest.fixture(scope='module', params=[False, True], ids=['grid', 'radar'])
+def tracked(request):
+    """(file_ID, now_time, newwas, StormData) of synthetic storms that move, split and merge, and an image without
+    storms"""
+    doradar = request.param
+    xmat, ymat = np.meshgrid(range(-200, 200), range(-150, 150))
+    fields = list(storm_fields(6, nstorms=60, seed=1))
+    fields.insert(3, np.zeros(xmat.shape))
+    tables = []
+    for nt, step in enumerate(track_fields(fields, xmat, ymat, doradar=doradar)):
+        now_time = init_time + datetime.timedelta(minutes=5 * nt)
+        tables.append(('S100_T3_A4_%02d' % nt, now_time, step.newwas, step.StormData))
+    return doradar, tables
+
+
+@pytest.fixture(scope='module')
+def histories(tracked, tmp_path_factory):
+    """History files of the tracked storms, written by write_storms"""
+    doradar, tables = tracked
+    IMAGES_DIR = str(tmp_path_factory.mktemp('histories')) + os.sep
+    for file_ID, now_time, newwas, StormData in tables:
+        object_tracking.write_storms(file_ID, init_time, now_time, 'Rainfall rate > 3mm/hr', 100., 0.01, newwas,
+                                     StormData, doradar, misval, IMAGES_DIR)
+    return IMAGES_DIR
+
+
+def assert_same_table(StormData, written):
+    assert len(StormData) == len(written)
+    for name in object_tracking.StormTable.columns + (object_tracking.StormTable.radar_columns
+                                                      if written.doradar else []):
+        assert_array_equal(getattr(StormData, name), getattr(written, name), err_msg=name)
+    for name in object_tracking.StormTable.lineage:
+        for ns in range(len(written)):
+            assert StormData.get_lineage(name, ns) == written.get_lineage(name, ns)
+
+
+def test_tables_have_lineage(tracked):
+    doradar, tables = tracked
+    assert any(np.any(StormData.child != misval) for file_ID, now_time, newwas, StormData in tables)
+    assert any(np.any(StormData.parent_values != misval) for file_ID, now_time, newwas, StormData in tables)
+    assert any(np.any(StormData.accreted_values != misval) for file_ID, now_time, newwas, StormData in tables)
+
+
+def test_npz_round_trip_across_appending_runs(tracked, tmp_path):
+    # A run is continued (e.g. resumed) by a second writer that appends to the same file
+    doradar, tables = tracked
+    filename = str(tmp_path / 'storms.npz')
+    for first, last, append in [(0, 4, False), (4, len(tables), True)]:
+        writer = storm_io.NpzWriter(filename, init_time, 'Rainfall rate > 3mm/hr', 100., 0.01, doradar, misval,
+                                    chunk_size=3, append=append)
+        for file_ID, now_time, newwas, StormData in tables[first:last]:
+            writer.write(file_ID, now_time, newwas, StormData)
+        writer.close()
+
+    meta, frames, storms = storm_io.read_npz(filename)
+    assert meta['init_time'] == np.datetime64(init_time, 's')
+    assert meta['doradar'] == doradar
+    assert frames['numstorms'].tolist() == [len(StormData) for file_ID, now_time, newwas, StormData in tables]
+    read = list(storm_io.npz_tables(filename))
+    assert len(read) == len(tables)
+    assert any(len(StormData) == 0 for file_ID, now_time, newwas, StormData in read)
+    for (file_ID, now_time, newwas, StormData), written in zip(read, tables):
+        assert (file_ID, now_time, newwas) == written[:3]
+        assert StormData.doradar == doradar
+        assert_same_table(StormData, written[3])
+
+
+def test_text_writer_writes_histories(tracked, tmp_path):
+    doradar, tables = tracked
+    IMAGES_DIR = str(tmp_path) + '/'
+    writer = storm_io.make_writer('text', init_time, 'Rainfall rate > 3mm/hr', 100., 0.01, doradar, misval,
+                                  IMAGES_DIR)
+    for file_ID, now_time, newwas, StormData in tables:
+        writer.write(file_ID, now_time, newwas, StormData)
+    writer.close()
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['history_' + table[0] + '.txt' for table in tables]
+    with pytest.raises(ValueError):
+        storm_io.make_writer('parquet', init_time, '', 100., 0.01, doradar, misval, IMAGES_DIR)
+
+
+def test_read_history_table(tracked, histories):
+    doradar, tables = tracked
+    for file_ID, now_time, newwas, written in tables:
+        header, StormData = storm_io.read_history(histories + 'history_' + file_ID + '.txt')
+        assert header['misval'] == misval
+        assert header['init_time'] == init_time
+        assert header['now_time'] == now_time
+        assert header['squarelength'] == 100.
+        assert header['rafraction'] == 0.01
+        assert header['newwas'] == newwas
+        # Radar extents are found from the storm lines, so only if there are storms
+        assert StormData.doradar == (doradar and len(written) > 0)
+        assert len(StormData) == len(written)
+        for name in ['was', 'area', 'life', 'child']:
+            assert_array_equal(getattr(StormData, name), getattr(written, name))
+        columns = ['centroidx', 'centroidy', 'boxleft', 'boxup', 'boxwidth', 'boxheight', 'dx', 'dy', 'meanvar',
+                   'extreme'] + (object_tracking.StormTable.radar_columns if StormData.doradar else [])
+        for name in columns:
+            # Written rounded to 2 decimals
+            assert_allclose(getattr(StormData, name), getattr(written, name), atol=0.005 + 1e-9, err_msg=name)
+        for name in object_tracking.StormTable.lineage:
+            for ns in range(len(written)):
+                assert StormData.get_lineage(name, ns) == written.get_lineage(name, ns)
+
+
+def test_read_history_round_trip(tracked, histories, tmp_path):
+    doradar, tables = tracked
+    for as_storms in [False, True]:
+        rewritten = str(tmp_path / str(as_storms)) + os.sep
+        for file_ID, header, StormData in storm_io.read_history_dir(histories, as_storms=as_storms):
+            assert isinstance(StormData, list) == as_storms
+            object_tracking.write_storms(file_ID, header['init_time'], header['now_time'], header['label_method'],
+                                         header['squarelength'], header['rafraction'], header['newwas'], StormData,
+                                         doradar, header['misval'], rewritten)
+        names = sorted(name for name in os.listdir(histories) if name.startswith('history_'))
+        assert names == sorted(os.listdir(rewritten))
+        for name in names:
+            assert filecmp.cmp(histories + name, rewritten + name, shallow=False), name
+
+
+def test_storms_from_history_lines(tracked, histories, tmp_path):
+    # StormS(string=...) reads the fields in the order write_storms writes them
+    doradar, tables = tracked
+    rewritten = str(tmp_path) + os.sep
+    for file_ID, now_time, newwas, written in tables:
+        with open(histories + 'history_' + file_ID + '.txt') as fr:
+            lines = [line for line in fr if line.startswith('storm ')]
+        storms = [object_tracking.StormS(ns + 1, None, None, None, None, newwas, None, None, 1, misval, doradar,
+                                         False, string=line) for ns, line in enumerate(lines)]
+        for ns, storm in enumerate(storms):
+            assert storm.was == written.was[ns]
+            assert storm.child == written.child[ns]
+            assert storm.parent == written.get_lineage('parent', ns)
+            assert storm.accreted == written.get_lineage('accreted', ns)
+            box = [storm.boxleft, storm.boxup, storm.boxwidth, storm.boxheight]
+            assert_allclose(box, [written.boxleft[ns], written.boxup[ns], written.boxwidth[ns],
+                                  written.boxheight[ns]], atol=0.005 + 1e-9)
+            if doradar:
+                assert_allclose([storm.rangel, storm.rangeu, storm.azimuthl, storm.azimuthu],
+                                [written.rangel[ns], written.rangeu[ns], written.azimuthl[ns], written.azimuthu[ns]],
+                                atol=0.005 + 1e-9)
+        object_tracking.write_storms(file_ID, init_time, now_time, 'Rainfall rate > 3mm/hr', 100., 0.01, newwas,
+                                     storms, doradar, misval, rewritten)
+        name = 'history_' + file_ID + '.txt'
+        assert filecmp.cmp(histories + name, rewritten + name, shallow=False), name
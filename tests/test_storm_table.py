@@ -0,0 +1,50 @@
+import datetime
+import numpy as np
+from numpy.testing import assert_array_equal
+import object_tracking
+from conftest import misval, storm_fields, track_fields
+
+
+def test_storm_view_reads_and_writes_table():
+    StormData = object_tracking.StormTable(3, misval)
+    storm = StormData[1]
+    storm.was = 7
+    storm.centroidx = 2.5
+    storm.parent = [4, 5]
+    assert StormData.was.tolist() == [0, 7, 0]
+    assert StormData.centroidx[1] == 2.5
+    assert StormData.get_lineage('parent', 1) == [4, 5]
+    assert StormData.get_lineage('parent', 2) == [misval]
+    assert (StormData[-1].storm, StormData[1].was) == (3, 7)
+
+
+def test_storm_view_keeps_other_attributes():
+    # Attributes that are not columns can be set as on StormS objects, they stay on the view
+    StormData = object_tracking.StormTable(2, misval)
+    storm = StormData[0]
+    storm.note = 'checked'
+    assert storm.note == 'checked'
+    assert 'note' not in StormData.__dict__
+
+
+def test_first_image_written_as_integer_displacements(tmp_path):
+    xmat, ymat = np.meshgrid(range(-200, 200), range(-150, 150))
+    StormData = next(track_fields(storm_fields(1), xmat, ymat)).StormData
+    now_time = datetime.datetime(2012, 8, 25, 14, 5)
+    object_tracking.write_storms('first', now_time, now_time, 'Rainfall rate > 3mm/hr', 100., 0.01,
+                                 len(StormData) + 1, StormData, False, misval, str(tmp_path) + '/')
+    with open(tmp_path / 'history_first.txt') as fr:
+        lines = [line for line in fr if line.startswith('storm ')]
+    assert len(lines) == len(StormData) > 0
+    assert all(' dx=0 dy=0 ' in line for line in lines)
+
+
+def test_table_from_storms():
+    xmat, ymat = np.meshgrid(range(-200, 200), range(-150, 150))
+    StormData = list(track_fields(storm_fields(3, seed=2), xmat, ymat))[-1].StormData
+    copied = object_tracking.StormTable.from_storms(list(StormData), misval)
+    for name in object_tracking.StormTable.columns:
+        assert_array_equal(getattr(copied, name), getattr(StormData, name), err_msg=name)
+    for name in object_tracking.StormTable.lineage:
+        assert [copied.get_lineage(name, ns) for ns in range(len(copied))] == \
+               [StormData.get_lineage(name, ns) for ns in range(len(StormData))]
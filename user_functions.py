@@ -1,10 +1,21 @@
-from netCDF4 import Dataset as ncfile
+import os
+import collections
+import multiprocessing
 import numpy as np
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+from os.path import isdir
+from loaders import NetCDFLoader
 
 
 ###################################################
 # loadfile IS A USER SPECIFIED FUNCTION TO LOAD THE DATA AND TIME STAMP INFORMATION
+# The example data are read through a NetCDFLoader (see loaders.py), which keeps
+# recently used files open. The time stamp is taken from the time variable of the
+# file if it has one, otherwise from the file name.
+# INPUT
+# out = float32 array to load the data into, so it can be reused (optional)
+# index = frame of a file with a time dimension (optional)
 # OUTPUT
 # datad = data (2D array)
 # fidd = file time identifier yyyymmdd
@@ -12,15 +23,50 @@ import matplotlib.pyplot as plt
 # mm = file minute stamp
 ###################################################
 
-def loadfile(filename):
-    nc = ncfile(filename)
-    datad = nc.variables['var'][200:600, 250:550] / 32
-    datad = np.flipud(np.transpose(datad))
+example_loader = NetCDFLoader('var', window=(slice(200, 600), slice(250, 550)), scale=32.)
+
+
+def loadfile(filename, out=None, index=0):
+    datad, when = example_loader.load(filename, index=index, out=out)
+    if when is None:
+        fidd = filename[-9:-5]
+        hh, mm = filetime(filename)
+    else:
+        fidd = when.strftime('%H%M')
+        hh, mm = float(when.hour), float(when.minute)
+
+    return datad, fidd, hh, mm
+
+
+###################################################
+# numframes IS A USER SPECIFIED FUNCTION TO GET THE NUMBER OF IMAGES IN A FILE
+# The wrapper tracks every frame of a file with a time dimension in turn, loaded
+# with loadfile(filename, index=frame). The frames need the time variable of the
+# file for their time stamps.
+# OUTPUT
+# nframes = number of images in the file
+###################################################
+
+def numframes(filename):
+    nframes = example_loader.num_frames(filename)
+
+    return nframes
+
+
+###################################################
+# filetime IS A USER SPECIFIED FUNCTION TO GET THE TIME STAMP OF A FILE
+# WITHOUT LOADING IT (USED TO SPLIT THE FILE LIST AT DATA GAPS, SEE segments.py)
+# OUTPUT
+# hh = file hour
+# mm = file minute stamp
+###################################################
+
+def filetime(filename):
     fidd = filename[-9:-5]
     hh = float(fidd[0:2])
     mm = float(fidd[2:4])
 
-    return datad, fidd, hh, mm
+    return hh, mm
 
 
 ###################################################
@@ -40,81 +86,159 @@ def timediff(oldh, oldm, newh, newm):
 ###################################################
 # plot_example IS ONLY USED AS AN ILLUSTRATION
 # OF THE EXAMPLE DATA
+# ExamplePlotter draws the figures once and only updates their data for each frame,
+# AsyncPlotter renders frames in a pool of processes, away from the tracking
 ###################################################
 
+class ExamplePlotter():
+    """Plots rainfall rate, storm ids, lifetimes and displacement vectors of a frame (see plot_example).
+    Figures, meshes and colorbars are created for the first frame and reused for the following frames."""
+
+    def __init__(self, xmat, ymat, threshold, IMAGES_DIR):
+        """
+
+        :param xmat: meshgrid of x-coordinates
+        :type xmat: ndarray
+        :param ymat: meshgrid of y-coordinates
+        :type ymat: ndarray
+        :param threshold: Threshold used to identify objects, contoured in the vector plot
+        :type threshold: float
+        :param IMAGES_DIR: Directory to output images
+        :type IMAGES_DIR: str
+        """
+        self.xmat = xmat
+        self.ymat = ymat
+        self.threshold = threshold
+        self.IMAGES_DIR = IMAGES_DIR
+        self.figures = {}
+
+    def matches(self, xmat, ymat, threshold, IMAGES_DIR):
+        return (np.array_equal(self.xmat, xmat) and np.array_equal(self.ymat, ymat) and self.threshold == threshold
+                and self.IMAGES_DIR == IMAGES_DIR)
+
+    def new_axes(self):
+        figa = plt.figure(figsize=(6, 7))
+        plt_ax = figa.add_subplot(111)
+        left, bottom, width, height = plt_ax.get_position().bounds
+        plt_ax.set_position([left, bottom + height / 7, width, width * 6 / 7])
+        plt_ax.set_xlabel('Distance from Chilbolton [km]')
+        plt_ax.set_ylabel('Distance from Chilbolton [km]')
+        return figa, plt_ax, [left, bottom, width, 0.01]
+
+    def mesh(self, name, vmin, vmax, label):
+        # Figure with a coloured mesh of the grid and a colourbar, created on first use
+        if name not in self.figures:
+            figa, plt_ax, colorbar_position = self.new_axes()
+            con = plt_ax.pcolormesh(self.xmat, self.ymat, np.zeros(np.shape(self.xmat)), vmin=vmin, vmax=vmax,
+                                    shading='auto')
+            cbar = figa.colorbar(con, figa.add_axes(colorbar_position), orientation='horizontal')
+            cbar.set_label(label)
+            self.figures[name] = (figa, con)
+        return self.figures[name]
+
+    def plot(self, write_file_ID, nt, rain, newumat, newvmat, num_dt, wasarray, lifearray, do_vectors):
+        """
+        Save the figures of one frame, see plot_example
+        """
+        lrain = rain + 0.0
+        lrain[np.where(lrain <= 0.)] = 0.01
+
+        figa, con = self.mesh('Rainrate', -1, 5, 'Rainfall rate [log2 mm hr^{-1}]')
+        con.set_array(np.log2(lrain))
+        figa.savefig(self.IMAGES_DIR + 'Rainrate_' + write_file_ID + '.png')
+
+        figb, con = self.mesh('Stormid', -10, 200, 'Storm ID')
+        con.set_array(wasarray)
+        figb.savefig(self.IMAGES_DIR + 'Stormid_' + write_file_ID + '.png')
+
+        figc, con = self.mesh('Lifetime', -30, 60, 'Life time [mins]')
+        con.set_array(5 * np.where(lifearray == 0, -6, lifearray))
+        figc.savefig(self.IMAGES_DIR + 'Lifetime_' + write_file_ID + '.png')
+
+        if do_vectors == True:
+            if 'Vectors' not in self.figures:
+                figd, plt_ax, colorbar_position = self.new_axes()
+                self.figures['Vectors'] = (figd, [])
+            figd, artists = self.figures['Vectors']
+            # Contours and arrows (scaled to each frame) are drawn again on the same axes
+            for artist in artists:
+                artist.remove()
+            plt_ax = figd.axes[0]
+            artists[:] = [plt_ax.contour(self.xmat, self.ymat, lrain, levels=[self.threshold]),
+                          plt_ax.quiver(self.xmat[::10, ::10], self.ymat[::10, ::10], newumat[::10, ::10] / num_dt,
+                                        newvmat[::10, ::10] / num_dt, pivot='mid', units='width')]
+            figd.savefig(self.IMAGES_DIR + 'Vectors_' + write_file_ID + '.png')
+
+
+# Plotter of plot_example and of the processes of AsyncPlotter
+example_plotter = None
+
+
 def plot_example(write_file_ID, nt, rain, xmat, ymat, newumat, newvmat, num_dt, wasarray, lifearray, threshold,
                  IMAGES_DIR, do_vectors):
     '''
     PLOT FIGURES WITH RAINFALL RATE AND STORM LABELS
     FOR ILLUSTRATIVE AND TESTING PURPOSES
     '''
+    global example_plotter
+    if example_plotter is None or not example_plotter.matches(xmat, ymat, threshold, IMAGES_DIR):
+        example_plotter = ExamplePlotter(xmat, ymat, threshold, IMAGES_DIR)
+    example_plotter.plot(write_file_ID, nt, rain, newumat, newvmat, num_dt, wasarray, lifearray, do_vectors)
 
-    lrain = rain + 0.0
-    lrain[np.where(lrain <= 0.)] = 0.01
-
-    figa = plt.figure(figsize=(6, 7))
-    # ax = figa.add_subplot(111)
-    # con = ax.imshow(f, cmap=cm.jet, interpolation='nearest')
-    con = plt.pcolor(xmat, ymat, np.log2(lrain), vmin=-1, vmax=5, shading='auto')
-    plt_ax = plt.gca()
-    left, bottom, width, height = plt_ax.get_position().bounds
-    posnew = [left, bottom + height / 7, width, width * 6 / 7]
-    plt_ax.set_position(posnew)
-    plt.xlabel('Distance from Chilbolton [km]')
-    plt.ylabel('Distance from Chilbolton [km]')
-    colorbar_axes = figa.add_axes([left, bottom, width, 0.01])
-    # add a colourbar with a label
-    cbar = plt.colorbar(con, colorbar_axes, orientation='horizontal')
-    cbar.set_label('Rainfall rate [log2 mm hr^{-1}]')
-    plt.savefig(IMAGES_DIR + 'Rainrate_' + write_file_ID + '.png')
-    plt.close()
-
-    figb = plt.figure(figsize=(6, 7))
-    # ax = figa.add_subplot(111)
-    # con = ax.imshow(f, cmap=cm.jet, interpolation='nearest')
-    con = plt.pcolor(xmat, ymat, wasarray, vmin=-10, vmax=200, shading='auto')
-    plt_ax = plt.gca()
-    left, bottom, width, height = plt_ax.get_position().bounds
-    posnew = [left, bottom + height / 7, width, width * 6 / 7]
-    plt_ax.set_position(posnew)
-    plt.xlabel('Distance from Chilbolton [km]')
-    plt.ylabel('Distance from Chilbolton [km]')
-    colorbar_axes = figb.add_axes([left, bottom, width, 0.01])
-    # add a colourbar with a label
-    cbar = plt.colorbar(con, colorbar_axes, orientation='horizontal')
-    cbar.set_label('Storm ID')
-    plt.savefig(IMAGES_DIR + 'Stormid_' + write_file_ID + '.png')
-    plt.close()
-
-    lifearray[np.where(lifearray == 0)] = -6
-    figc = plt.figure(figsize=(6, 7))
-    # ax = figa.add_subplot(111)
-    # con = ax.imshow(f, cmap=cm.jet, interpolation='nearest')
-    con = plt.pcolor(xmat, ymat, 5 * lifearray, vmin=-30, vmax=60, shading='auto')
-    plt_ax = plt.gca()
-    left, bottom, width, height = plt_ax.get_position().bounds
-    posnew = [left, bottom + height / 7, width, width * 6 / 7]
-    plt_ax.set_position(posnew)
-    plt.xlabel('Distance from Chilbolton [km]')
-    plt.ylabel('Distance from Chilbolton [km]')
-    colorbar_axes = figc.add_axes([left, bottom, width, 0.01])
-    # add a colourbar with a label
-    cbar = plt.colorbar(con, colorbar_axes, orientation='horizontal')
-    cbar.set_label('Life time [mins]')
-    plt.savefig(IMAGES_DIR + 'Lifetime_' + write_file_ID + '.png')
-    plt.close()
-    if do_vectors == True:
-        figd = plt.figure(figsize=(6, 7))
-        # ax = figa.add_subplot(111)
-        # con = ax.imshow(f, cmap=cm.jet, interpolation='nearest')
-        con = plt.contour(xmat, ymat, lrain, levels=[threshold])
-        plt.quiver(xmat[::10, ::10], ymat[::10, ::10], newumat[::10, ::10] / num_dt, newvmat[::10, ::10] / num_dt,
-                   pivot='mid', units='width')
-        plt_ax = plt.gca()
-        left, bottom, width, height = plt_ax.get_position().bounds
-        posnew = [left, bottom + height / 7, width, width * 6 / 7]
-        plt_ax.set_position(posnew)
-        plt.xlabel('Distance from Chilbolton [km]')
-        plt.ylabel('Distance from Chilbolton [km]')
-        plt.savefig(IMAGES_DIR + 'Vectors_' + write_file_ID + '.png')
-        plt.close()
+
+def start_plotter(xmat, ymat, threshold, IMAGES_DIR):
+    # Initialise a plotting process of AsyncPlotter
+    global example_plotter
+    plt.switch_backend('Agg')
+    example_plotter = ExamplePlotter(xmat, ymat, threshold, IMAGES_DIR)
+
+
+def plot_frame(write_file_ID, nt, rain, newumat, newvmat, num_dt, wasarray, lifearray, do_vectors):
+    # Plot a frame in a plotting process of AsyncPlotter
+    example_plotter.plot(write_file_ID, nt, rain, newumat, newvmat, num_dt, wasarray, lifearray, do_vectors)
+
+
+class AsyncPlotter():
+    """Renders the plot_example figures of each frame in a pool of processes. The arrays of a frame are copied to
+    the plotting process, so they can be reused once submit returns. submit only waits when maxsize frames
+    are being plotted."""
+
+    def __init__(self, xmat, ymat, threshold, IMAGES_DIR, workers=2, maxsize=None):
+        """
+
+        :param xmat: meshgrid of x-coordinates
+        :type xmat: ndarray
+        :param ymat: meshgrid of y-coordinates
+        :type ymat: ndarray
+        :param threshold: Threshold used to identify objects
+        :type threshold: float
+        :param IMAGES_DIR: Directory to output images
+        :type IMAGES_DIR: str
+        :param workers: Number of plotting processes
+        :type workers: int
+        :param maxsize: Maximum number of frames waiting to be plotted, default 2 * workers
+        :type maxsize: int
+        """
+        if not isdir(IMAGES_DIR):
+            os.makedirs(IMAGES_DIR)
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=start_plotter, initargs=(xmat, ymat, threshold, IMAGES_DIR))
+        self.maxsize = 2 * workers if maxsize is None else maxsize
+        self.pending = collections.deque()
+
+    def submit(self, write_file_ID, nt, rain, newumat, newvmat, num_dt, wasarray, lifearray, do_vectors):
+        """
+        Plot a frame, arguments as plot_example
+        """
+        while len(self.pending) >= self.maxsize:
+            self.pending.popleft().result()
+        # Copies, in case the arrays are changed before the frame is sent to a plotting process
+        self.pending.append(self.pool.submit(plot_frame, write_file_ID, nt, rain.copy(), np.copy(newumat),
+                                             np.copy(newvmat), num_dt, np.copy(wasarray), np.copy(lifearray),
+                                             do_vectors))
+
+    def close(self):
+        """Wait for all frames to be plotted"""
+        while len(self.pending) > 0:
+            self.pending.popleft().result()
+        self.pool.shutdown()
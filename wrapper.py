@@ -1,8 +1,17 @@
+import matplotlib
+
+matplotlib.use('Agg')  # Figures are only saved to files
 import object_tracking
 import numpy as np
 import datetime
 import os
 import user_functions
+import storm_io
+import pipeline
+import segments
+import realtime
+import stats
+import itertools
 
 if __name__ == '__main__':
     ##################################################################
@@ -52,6 +61,67 @@ if __name__ == '__main__':
     # If False, then no text files with object information is included in the output. [Default should be True]
     flagwrite = True
 
+    # output_format: How storm information is written if flagwrite
+    # 'text' writes a history_*.txt file for every image, 'npz' appends all images to a single storms.npz file
+    # (read with storm_io.read_npz or storm_io.npz_tables) [Default should be 'text']
+    output_format = 'text'
+
+    # resume: Continue tracking after the last image written to the output by a previous run with the same settings,
+    # instead of starting again from the first image. The last written image is labelled again.
+    # [Default should be False]
+    resume = False
+
+    # checkpoint_every: Write the tracker state to a checkpoint file every this many images. With resume, tracking
+    # continues from the checkpoint if there is one, with identical storm ids. 0 for no checkpoints [Default is 0]
+    checkpoint_every = 0
+
+    # prefetch_depth: Number of images loaded and labelled in a background thread ahead of the image being tracked
+    prefetch_depth = 2
+
+    # segment_length: If larger than 0, the file list is split into segments of at most this many images
+    # (and at data gaps), which are tracked in parallel by segment_workers processes (None for all CPUs).
+    # Storm ids are stitched across segments. Unlike sequential tracking, the image after a data gap starts new
+    # tracks and ids keep counting up. Requires resume = False, checkpoint_every = 0 and flagplot = False [Default is 0]
+    segment_length = 0
+    segment_workers = None
+
+    # label_tiles: Number of strips of rows labelled in parallel by label_workers threads, for very large grids.
+    # Storms crossing the strips are joined, so the labels are identical to labelling the whole grid.
+    # Only labelling is split, tracking runs on the whole grid [Default is 1]
+    label_tiles = 1
+    label_workers = 1
+
+    # compact_dtypes: Calculate the displacement vectors (square spectra, correlations and displacement fields) in
+    # float32 instead of float64, halving their memory on large grids. Data are loaded as float32 and labels are int32
+    # either way. Storm tracks agree with float64 up to rounding of the displacements (see
+    # benchmark.compare_compact) [Default should be False]
+    compact_dtypes = False
+
+    # tracking_backend: 'numba' runs the loops of the tracking (advection, matching, splitting) compiled with numba,
+    # with the same results as 'numpy' (see kernels.py and benchmark.compare_backends). Falls back to 'numpy' if numba
+    # is not installed, 'auto' uses numba if it is installed [Default should be 'numpy']
+    tracking_backend = 'numpy'
+
+    # watch_data: Keep watching DATA_DIR and track new images as they arrive (e.g. real-time radar data),
+    # instead of tracking the files listed at the start. Watching stops after idle_timeout seconds without new files
+    # (None to run until stopped). Files are used when they have not been modified for settle_time seconds.
+    # The latency from the arrival of a file to its output is reported if over latency_target seconds.
+    # Requires segment_length = 0 [Default should be False]
+    watch_data = False
+    poll_interval = 1.
+    settle_time = 0.
+    idle_timeout = None
+    latency_target = 60.
+
+    # log_stats: Write the time of each stage of loading, labelling and tracking, and counts of storms, squares,
+    # orphans, splits and merges, of every image as a JSON line to IMAGES_DIR + 'stats.jsonl' (see stats.FrameStats)
+    # [Default should be False]
+    log_stats = False
+
+    # output_queue: Number of output tasks (writing, plotting) that can wait for the output thread
+    # before tracking waits for them
+    output_queue = 8
+
     # doradar: For calculating radar range and azimuth if real-time tracking with a single site radar
     # If True, then calculate range and azimuth for real-time tracking with radar (e.g. Chilbolton).
     # False for any other use, radar coordinates not relevant [Default should be False]
@@ -70,6 +140,9 @@ if __name__ == '__main__':
     # [Trials should set this to True, long runs could set it to False to save time]
     flagplot = True
 
+    # plot_workers: Number of processes plotting images in the background if flagplot (see user_functions.AsyncPlotter)
+    plot_workers = 2
+
     # flagplottest: For plotting fft correlations (testing only, very slow, lots of plots)
     # If True, numerous test images are included to check the displacement vector calculations [Default should be False]
     flagplottest = False
@@ -143,6 +216,7 @@ if __name__ == '__main__':
     # TODO: Change DATA_DIR and IMAGES_DIR!
     DATA_DIR = './data/'
     IMAGES_DIR = './output/'
+    CHECKPOINT_FILE = IMAGES_DIR + 'checkpoint.npz'
     filelist = os.listdir(DATA_DIR)
     filelist = np.sort(filelist)
     if doradar:
@@ -155,87 +229,174 @@ if __name__ == '__main__':
         # azarray[np.where(ymat < 0)] = azarray[np.where(ymat < 0)] + np.pi
         # azarray = 180 * azarray / np.pi
         azarray[np.where(np.isnan(azarray) == 1)] = 0
+    else:
+        rarray, azarray = None, None
+
+    # The tracker precomputes the geometry of the grid (displacement squares, interpolation weights, radar extents)
+    # and keeps the storms of the previous image. Time stamps are (hour, minute) as returned by loadfile.
+    tracker = object_tracking.Tracker(xmat, ymat, squarelength=squarelength, rafraction=rafraction,
+                                      dd_tolerance=dd_tolerance, halopixel=halopixel, lapthresh=lapthresh,
+                                      misval=misval, under_threshold=under_t, dt=dt, dt_tolerance=dt_tolerance,
+                                      timediff=user_functions.timediff, doradar=doradar, rarray=rarray,
+                                      azarray=azarray, IMAGES_DIR=IMAGES_DIR, flagplot=flagplottest,
+                                      compact=compact_dtypes, backend=tracking_backend)
 
     #   Initialise variables
-    OldData, OldLabels, oldvar, newvar, prev_time = [], [], [], [], []
-    newwas = 1
     plot_vectors = False
 
     start_time = datetime.datetime(2012, 8, 25, 14, 5, 0, 0)
-    oldhourval = []
-    oldminval = []
-    oldmask = []
-    newmask = []
-    num_dt = []
-
-    for nt in range(len(filelist)):
-        # Load new image
-        # TODO: Time interval is currently hardcoded
-        now_time = start_time + datetime.timedelta(seconds=300. * nt)
-        var, file_ID, hourval, minval = user_functions.loadfile(DATA_DIR + filelist[nt])
-        print(file_ID)
-        write_file_ID = f"S{sql_str}_T{thr_str}_A{areastr}_{file_ID}"
-        NewLabels = object_tracking.label_storms(var, minpixel, threshold, struct2d, under_t)
-        # oldmask, newmask, USED FOR DERIVING (dx,dy)
-        # THESE CAN BE CHANGED USING EXPERT KNOWLEDGE
-        # e.g. use raw data rather than binary masks,
-        # if displacement information is contained in structures within objects
-        # NB If raw data are used (i.e. not zeros and ones) then fftpixels needs to be changed to remain sensible
-        if len(OldLabels) > 1:
-            # CHECK TIME DIFFERENCE BETWEEN CONSECUTIVE IMAGES
-            dtnow = user_functions.timediff(oldhourval, oldminval, hourval, minval)
-            num_dt = dtnow / dt
-            if dtnow > dt_tolerance:
+    # Label arrays used in turn: for the images labelled ahead, the image being tracked and the previous image
+    labelbuffers = [np.zeros(np.shape(xmat), dtype=np.int32) for ii in range(prefetch_depth + 2)]
+    # Data arrays used in turn in the same way, the loaded data must fit the grid
+    varbuffers = [np.zeros(np.shape(xmat), dtype=np.float32) for ii in range(prefetch_depth + 2)]
+    if watch_data and segment_length > 0:
+        raise ValueError('Watching DATA_DIR requires sequential tracking (segment_length = 0)')
+    if segment_length > 0 and (resume or checkpoint_every > 0 or flagplot):
+        raise ValueError('resume, checkpoint_every and flagplot require sequential tracking (segment_length = 0)')
+
+    if flagwrite:
+        writer = storm_io.make_writer(output_format, start_time, label_method, squarelength, rafraction, doradar,
+                                      misval, IMAGES_DIR, append=resume)
+
+    if segment_length > 0:
+        # Track segments of the file list in parallel processes (see segments.py), write the stitched storms in order
+        if any(user_functions.numframes(DATA_DIR + filename) > 1 for filename in filelist):
+            raise ValueError('Files with several frames require sequential tracking (segment_length = 0)')
+        settings = dict(loadfile=user_functions.loadfile, minpixel=minpixel, threshold=threshold, struct2d=struct2d,
+                        under_t=under_t, label_tiles=label_tiles, label_workers=label_workers, tracker=tracker)
+        for nt, file_ID, newwas, NewData in segments.run_segments([DATA_DIR + filename for filename in filelist],
+                                                                  settings, user_functions.filetime,
+                                                                  max_length=segment_length, workers=segment_workers):
+            # TODO: Time interval is currently hardcoded
+            now_time = start_time + datetime.timedelta(seconds=300. * nt)
+            print(file_ID)
+            if flagwrite:
+                writer.write(f"S{sql_str}_T{thr_str}_A{areastr}_{file_ID}", now_time, newwas, NewData)
+        if flagwrite:
+            writer.close()
+
+    else:
+        # Images to track, every frame of every file in turn (see user_functions.numframes)
+        imagelist = [(filename, index) for filename in filelist
+                     for index in range(user_functions.numframes(DATA_DIR + filename))]
+
+        # Resume from the last checkpoint, otherwise from the storms of the last written image
+        first_nt = 0
+        last_output = None
+        if resume and os.path.isfile(CHECKPOINT_FILE):
+            state = storm_io.read_checkpoint(CHECKPOINT_FILE)
+            nt = state['nt']
+            print('Resuming from checkpoint after ' + imagelist[nt][0])
+            OldLabels = labelbuffers[nt % len(labelbuffers)]
+            OldLabels[...] = state['StormLabels']
+            tracker.restore(state['StormData'], OldLabels, state['newwas'], (state['hourval'], state['minval']))
+            plot_vectors = True
+            first_nt = nt + 1
+        elif resume:
+            last_output = storm_io.last_output(output_format, IMAGES_DIR,
+                                               file_ID_prefix=f"S{sql_str}_T{thr_str}_A{areastr}_")
+        if last_output is not None:
+            last_ID, last_time, newwas, OldData = last_output
+            # TODO: Time interval is currently hardcoded
+            nt = int(round((last_time - start_time).total_seconds() / 300.))
+            filename, index = imagelist[nt]
+            oldvar, file_ID, oldhourval, oldminval = user_functions.loadfile(DATA_DIR + filename,
+                                                                              out=varbuffers[nt % len(varbuffers)],
+                                                                              index=index)
+            print('Resuming after ' + file_ID)
+            OldLabels = object_tracking.label_storms(oldvar, minpixel, threshold, struct2d, under_t,
+                                                     output=labelbuffers[nt % len(labelbuffers)], tiles=label_tiles,
+                                                     workers=label_workers)
+            OldData = storm_io.resume_storms(OldData, OldLabels, oldvar, xmat, ymat, under_t)
+            tracker.restore(OldData, OldLabels, newwas, (oldhourval, oldminval))
+            plot_vectors = True
+            first_nt = nt + 1
+
+        latency = realtime.LatencyMonitor(latency_target)
+
+        def load_and_label(image):
+            # Load and label new image, run ahead of the tracking by pipeline.prefetch
+            nt, (filename, index) = image
+            if watch_data:
+                latency.arrived(nt, DATA_DIR + filename)
+            framestats = stats.FrameStats(enabled=log_stats)
+            with framestats.stage('load'):
+                var, file_ID, hourval, minval = user_functions.loadfile(DATA_DIR + filename,
+                                                                        out=varbuffers[nt % len(varbuffers)],
+                                                                        index=index)
+            with framestats.stage('label'):
+                NewLabels = object_tracking.label_storms(var, minpixel, threshold, struct2d, under_t,
+                                                         output=labelbuffers[nt % len(labelbuffers)],
+                                                         tiles=label_tiles, workers=label_workers)
+            return nt, var, file_ID, hourval, minval, NewLabels, framestats
+
+        # Writing runs in order in an output thread, unless tracking plots too. Images are plotted by other processes.
+        output = pipeline.OutputWorker(maxsize=output_queue, threaded=not flagplottest)
+        if flagplot:
+            plotter = user_functions.AsyncPlotter(xmat, ymat, threshold, IMAGES_DIR, workers=plot_workers)
+
+        if watch_data:
+            # Images are tracked as soon as they arrive, so they are not loaded ahead
+            arrivals = realtime.watch_directory(DATA_DIR, poll_interval=poll_interval, settle=settle_time,
+                                                idle_timeout=idle_timeout)
+            frames = ((filename, index) for filename in arrivals
+                      for index in range(user_functions.numframes(DATA_DIR + filename)))
+            images = map(load_and_label, enumerate(itertools.islice(frames, first_nt, None), start=first_nt))
+        else:
+            images = pipeline.prefetch(load_and_label, enumerate(imagelist[first_nt:], start=first_nt),
+                                       depth=prefetch_depth)
+
+        if log_stats:
+            statslog = stats.StatsLog(IMAGES_DIR + 'stats.jsonl', append=resume)
+
+        for nt, var, file_ID, hourval, minval, NewLabels, framestats in images:
+            # TODO: Time interval is currently hardcoded
+            now_time = start_time + datetime.timedelta(seconds=300. * nt)
+            print(file_ID)
+            write_file_ID = f"S{sql_str}_T{thr_str}_A{areastr}_{file_ID}"
+            # Call object tracking routine (see object_tracking.Tracker.step)
+            # NewData: list of objects and properties
+            # newwas: final label number
+            # NewLabels: array with object IDs from [1, nummax] as found by label_storms
+            # newumat, newvmat: arrays with (dx,dy) displacement between two images (NB not displacement per dt!!!)
+            # wasarray: array with object IDs consistent across images (i.e. tracked IDs)
+            # lifearray: array with object lifetime consistent across images
+            tracked = tracker.step(var, NewLabels, (hourval, minval), write_file_ID=write_file_ID, stats=framestats)
+            if tracked is None:
                 print('Data are too far apart in time --- Re-initialise objects')
-                OldData, OldLabels, oldvar, newvar, prev_time = [], [], [], [], []
-                newwas = 1
                 plot_vectors = False
+                if watch_data:
+                    output.submit(latency.done, nt)
                 continue
-            oldmask = np.where(OldLabels >= 1, 1, 0)
-            newmask = np.where(NewLabels >= 1, 1, 0)
-
-        # Call object tracking routine
-        # NewData: list of objects and properties
-        # newwas: final label number
-        # NewLabels: array with object IDs from [1, nummax] as found by label_storms
-        # newumat, newvmat: arrays with (dx,dy) displacement between two images (NB not displacement per dt!!!)
-        # wasarray: array with object IDs consistent across images (i.e. tracked IDs)
-        # lifearray: array with object lifetime consistent across images
-        NewData, newwas, NewLabels, newumat, newvmat, wasarray, lifearray = object_tracking.track_storms(OldData,
-                                                                                                         var,
-                                                                                                         newwas,
-                                                                                                         NewLabels,
-                                                                                                         OldLabels,
-                                                                                                         xmat,
-                                                                                                         ymat,
-                                                                                                         fftpixels,
-                                                                                                         dd_tolerance,
-                                                                                                         halosq,
-                                                                                                         squarehalf,
-                                                                                                         oldmask,
-                                                                                                         newmask,
-                                                                                                         num_dt,
-                                                                                                         lapthresh,
-                                                                                                         misval,
-                                                                                                         doradar,
-                                                                                                         under_t,
-                                                                                                         IMAGES_DIR,
-                                                                                                         write_file_ID,
-                                                                                                         flagplottest)
-        # Write tracked storm information
-        if flagwrite:
-            object_tracking.write_storms(write_file_ID, start_time, now_time, label_method, squarelength, rafraction,
-                                         newwas, NewData, doradar, misval, IMAGES_DIR)
+            NewData, newwas, NewLabels, newumat, newvmat, wasarray, lifearray, num_dt = tracked
+            # Write tracked storm information
+            if flagwrite:
+                output.submit(writer.write, write_file_ID, now_time, newwas, NewData)
+
+            # Plot tracked storm information in the background (see user_functions.plot_example)
+            if flagplot:
+                plotter.submit(write_file_ID, nt, var, newumat, newvmat, num_dt, wasarray, lifearray, plot_vectors)
+            if watch_data:
+                output.submit(latency.done, nt)
+            if log_stats:
+                output.submit(statslog.write, framestats.record(image=nt, file_ID=file_ID, time=now_time))
+
+            plot_vectors = True
+
+            # Checkpoint, after writing all output of the images so far
+            if checkpoint_every > 0 and (nt + 1) % checkpoint_every == 0:
+                if flagwrite:
+                    output.submit(writer.flush)
+                # The label array is reused for a later image, so the checkpoint gets a copy
+                output.submit(storm_io.write_checkpoint, CHECKPOINT_FILE, nt, now_time, NewData, NewLabels.copy(),
+                              newwas, hourval, minval)
 
-        # Plot tracked storm information (see user_functions.plot_example)
+        if flagwrite:
+            output.submit(writer.close)
+        if log_stats:
+            output.submit(statslog.close)
+        output.close()
         if flagplot:
-            user_functions.plot_example(write_file_ID, nt, var, xmat, ymat, newumat, newvmat, num_dt, wasarray,
-                                        lifearray, threshold, IMAGES_DIR, plot_vectors)
-
-        # Save tracking information in preparation for next image
-        OldData = NewData
-        OldLabels = NewLabels
-        oldvar = var
-        oldhourval = hourval
-        oldminval = minval
-        plot_vectors = True
+            plotter.close()
+        if watch_data:
+            print('Latency (s):', latency.summary())